@@ -16,6 +16,7 @@
 
 __author__ = 'psimakov@google.com (Pavel Simakov)'
 
+import collections
 import datetime
 import importlib
 import logging
@@ -49,6 +50,11 @@ DEFAULT_NAMESPACE_NAME = ''
 # registration time.
 MODULE_REGISTRATION_IN_PROGRESS = False
 
+# Milliseconds each module named in app.yaml took to import, register and
+# enable at startup, keyed by module name in the order modules were loaded.
+# Import times include dependencies not already imported by earlier modules.
+MODULE_STARTUP_MILLIS = collections.OrderedDict()
+
 # Name for the core module.  We don't actually have any code in modules/core,
 # since having a core module is pretty well a contradiction in terms.  However,
 # there are a few things that want module and module-like-things to register
@@ -159,20 +165,44 @@ def _import_and_enable_modules(env_var, reraise=False):
         option = 'enabled'
         if module_name.count('='):
             module_name, option = module_name.split('=', 1)
+        millis = MODULE_STARTUP_MILLIS.setdefault(module_name, {})
         try:
             operation = 'importing'
+            before = datetime.datetime.utcnow()
             module = importlib.import_module(module_name)
+            millis['import'] = time_delta_to_millis(
+                datetime.datetime.utcnow() - before)
             operation = 'registering'
+            before = datetime.datetime.utcnow()
             custom_module = module.register_module()
+            millis['register'] = time_delta_to_millis(
+                datetime.datetime.utcnow() - before)
             if option is 'enabled':
                 operation = 'enabling'
+                before = datetime.datetime.utcnow()
                 custom_module.enable()
+                millis['enable'] = time_delta_to_millis(
+                    datetime.datetime.utcnow() - before)
         except Exception, ex:  # pylint: disable=broad-except
             logging.exception('Problem %s module "%s"', operation, module_name)
             if reraise:
                 raise ex
 
 
+def log_module_startup_millis():
+    """Logs the startup cost of modules, most expensive first."""
+    def total(item):
+        return sum(item[1].values())
+
+    lines = ['%6dms %s (import %sms, register %sms, enable %sms)' % (
+        total(item), item[0], item[1].get('import', '-'),
+        item[1].get('register', '-'), item[1].get('enable', '-'))
+             for item in sorted(
+                 MODULE_STARTUP_MILLIS.items(), key=total, reverse=True)]
+    logging.info('Module startup costs:\n%s', '\n'.join(lines))
+    log_appstats_event('modules.startup', dict(MODULE_STARTUP_MILLIS))
+
+
 def import_and_enable_modules():
     global MODULE_REGISTRATION_IN_PROGRESS  # pylint: disable=global-statement
     MODULE_REGISTRATION_IN_PROGRESS = True
@@ -180,6 +210,7 @@ def import_and_enable_modules():
     _import_and_enable_modules('GCB_REGISTERED_MODULES_CUSTOM')
     _import_and_enable_modules('GCB_THIRD_PARTY_MODULES')
     MODULE_REGISTRATION_IN_PROGRESS = False
+    log_module_startup_millis()
 
 
 def time_delta_to_millis(delta):
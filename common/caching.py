@@ -18,10 +18,13 @@ __author__ = 'Pavel Simakov (psimakov@google.com)'
 
 
 import collections
+import copy
 import datetime
 import logging
+import random
 import sys
 import threading
+import time
 import unittest
 
 import appengine_config
@@ -126,37 +129,127 @@ class RequestScopedSingleton(AbstractScopedSingleton):
 
 
 class LRUCache(object):
-    """A dict that supports capped size and LRU eviction of items."""
+    """A dict that supports capped size and LRU eviction of items.
+
+    The size of each item is computed once, when it is put, and kept along
+    with it, so that the total size stays exact as items come and go. Items
+    may also be grouped into namespaces, each with its own size quota, by
+    overriding get_namespace(). The quota only applies while items of more
+    than one namespace are cached, so a lone namespace may fill the cache.
+    """
+
+    # Counters of evicted items by the reason of eviction, by cache name.
+    _EVICTION_COUNTERS = {}
 
     def __init__(
         self, max_item_count=None,
-        max_size_bytes=None, max_item_size_bytes=None):
+        max_size_bytes=None, max_item_size_bytes=None,
+        max_namespace_size_bytes=None, name=None):
         assert max_item_count or max_size_bytes
         if max_item_count:
             assert max_item_count > 0
         if max_size_bytes:
             assert max_size_bytes > 0
+        if max_namespace_size_bytes:
+            assert max_namespace_size_bytes > 0
         self.total_size = 0
         self.max_item_count = max_item_count
         self.max_size_bytes = max_size_bytes
         self.max_item_size_bytes = max_item_size_bytes
+        self.max_namespace_size_bytes = max_namespace_size_bytes
         self.items = collections.OrderedDict([])
+        self._sizes = {}
+        self._namespace_keys = {}
+        self._namespace_sizes = {}
+        self._counters = self._get_eviction_counters(name) if name else None
+
+    @classmethod
+    def _get_eviction_counters(cls, name):
+        if name not in cls._EVICTION_COUNTERS:
+            cls._EVICTION_COUNTERS[name] = {
+                'count': PerfCounter(
+                    'gcb-%s-lru-evict-count' % name,
+                    'A number of items evicted because %s had too many '
+                    'items.' % name),
+                'size': PerfCounter(
+                    'gcb-%s-lru-evict-size' % name,
+                    'A number of items evicted because %s was full.' % name),
+                'quota': PerfCounter(
+                    'gcb-%s-lru-evict-quota' % name,
+                    'A number of items evicted because their namespace used '
+                    'up its quota in %s.' % name),
+                'too-big': PerfCounter(
+                    'gcb-%s-lru-reject-too-big' % name,
+                    'A number of items not put into %s because they were '
+                    'too big.' % name)}
+        return cls._EVICTION_COUNTERS[name]
+
+    def _count(self, reason):
+        if self._counters:
+            self._counters[reason].inc()
 
     def get_entry_size(self, key, value):
         """Computes item size. Override and compute properly for your items."""
         return sys.getsizeof(key) + sys.getsizeof(value)
 
+    def get_namespace(self, unused_key):
+        """Returns the namespace of a key. Override to use namespace quotas."""
+        return None
+
+    def get_namespace_size(self, namespace):
+        return self._namespace_sizes.get(namespace, 0)
+
     def _compute_current_size(self):
+        """Adds up the sizes of all items; total_size must be the same."""
         total = 0
         for key, item in self.items.iteritems():
-            total += sys.getsizeof(key) + self.get_item_size(item)
+            total += self.get_entry_size(key, item)
         return total
 
-    def _allocate_space(self, key, value):
-        """Remove items in FIFO order until size constraints are met."""
-        entry_size = self.get_entry_size(key, value)
+    def _remove(self, key):
+        del self.items[key]
+        size = self._sizes.pop(key)
+        self.total_size -= size
+        assert self.total_size >= 0
+        namespace = self.get_namespace(key)
+        if namespace is not None:
+            keys = self._namespace_keys[namespace]
+            del keys[key]
+            if keys:
+                self._namespace_sizes[namespace] -= size
+            else:
+                del self._namespace_keys[namespace]
+                del self._namespace_sizes[namespace]
+
+    def _is_shared(self, namespace):
+        """Checks if items of namespaces other than this one are cached."""
+        return len(self._namespace_keys) > 1 or (
+            self._namespace_keys and namespace not in self._namespace_keys)
+
+    def _evict_from_namespace(self, namespace, entry_size):
+        """Remove items of namespace in LRU order until it has entry_size."""
+        if entry_size > self.max_namespace_size_bytes:
+            return False
+        keys = self._namespace_keys.get(namespace)
+        while keys and (
+                self._namespace_sizes[namespace] + entry_size >
+                self.max_namespace_size_bytes):
+            self._count('quota')
+            self._remove(next(iter(keys)))
+            keys = self._namespace_keys.get(namespace)
+        return True
+
+    def _allocate_space(self, key, entry_size):
+        """Remove items in LRU order until size constraints are met."""
         if self.max_item_size_bytes and entry_size > self.max_item_size_bytes:
+            self._count('too-big')
             return False
+        namespace = self.get_namespace(key)
+        if (namespace is not None and self.max_namespace_size_bytes and
+            self._is_shared(namespace)):
+            if not self._evict_from_namespace(namespace, entry_size):
+                self._count('too-big')
+                return False
         while True:
             over_count = False
             over_size = False
@@ -165,23 +258,22 @@ class LRUCache(object):
             if self.max_size_bytes:
                 over_size = self.total_size + entry_size >= self.max_size_bytes
             if not (over_count or over_size):
-                if self.max_size_bytes:
-                    self.total_size += entry_size
-                    assert self.total_size < self.max_size_bytes
                 return True
-            if self.items:
-                _key, _value = self.items.popitem(last=False)
-                if self.max_size_bytes:
-                    self.total_size -= self.get_entry_size(_key, _value)
-                    assert self.total_size >= 0
-            else:
+            if not self.items:
                 break
+            self._count('count' if over_count else 'size')
+            self._remove(next(iter(self.items)))
         return False
 
     def _record_access(self, key):
         """Pop and re-add the item."""
         item = self.items.pop(key)
         self.items[key] = item
+        namespace = self.get_namespace(key)
+        if namespace is not None:
+            keys = self._namespace_keys[namespace]
+            del keys[key]
+            keys[key] = True
 
     def contains(self, key):
         """Checks if item is contained without accessing it."""
@@ -190,10 +282,21 @@ class LRUCache(object):
 
     def put(self, key, value):
         assert key
-        if self._allocate_space(key, value):
-            self.items[key] = value
-            return True
-        return False
+        if key in self.items:
+            self._remove(key)
+        entry_size = self.get_entry_size(key, value)
+        if not self._allocate_space(key, entry_size):
+            return False
+        self.items[key] = value
+        self._sizes[key] = entry_size
+        self.total_size += entry_size
+        namespace = self.get_namespace(key)
+        if namespace is not None:
+            self._namespace_keys.setdefault(
+                namespace, collections.OrderedDict())[key] = True
+            self._namespace_sizes[namespace] = (
+                self._namespace_sizes.get(namespace, 0) + entry_size)
+        return True
 
     def get(self, key):
         """Accessing item makes it less likely to be evicted."""
@@ -206,11 +309,101 @@ class LRUCache(object):
     def delete(self, key):
         assert key
         if key in self.items:
-            del self.items[key]
+            self._remove(key)
             return True
         return False
 
 
+# Values of these types can't be changed and are shared by frozen containers.
+_IMMUTABLE_TYPES = (
+    basestring, int, long, float, bool, type(None),
+    datetime.date, datetime.time, datetime.timedelta)
+
+
+def _read_only(self, *unused_args, **unused_kwargs):
+    raise TypeError('%s is read-only.' % self.__class__.__name__)
+
+
+class FrozenDict(dict):
+    """A dict that can't be changed; its copies are regular dicts."""
+
+    __setitem__ = __delitem__ = _read_only
+    clear = pop = popitem = setdefault = update = _read_only
+
+    def __copy__(self):
+        return dict(self)
+
+    def __deepcopy__(self, memo):
+        return dict([
+            (copy.deepcopy(key, memo), copy.deepcopy(value, memo))
+            for key, value in self.iteritems()])
+
+    def __reduce__(self):
+        return (dict, (dict(self),))
+
+
+class FrozenList(list):
+    """A list that can't be changed; its copies are regular lists."""
+
+    __setitem__ = __delitem__ = __setslice__ = __delslice__ = _read_only
+    __iadd__ = __imul__ = _read_only
+    append = extend = insert = pop = remove = reverse = sort = _read_only
+
+    def __copy__(self):
+        return list(self)
+
+    def __deepcopy__(self, memo):
+        return [copy.deepcopy(item, memo) for item in self]
+
+    def __reduce__(self):
+        return (list, (list(self),))
+
+
+def freeze(value):
+    """Returns a read-only copy of value made of FrozenDict and FrozenList.
+
+    Only values built from dicts, lists, tuples, sets and immutable scalars
+    can be frozen; callers that need to change such a value must copy it,
+    e.g., with copy.deepcopy(). Subclasses of dict and list, e.g.,
+    OrderedDict, are not frozen, since their frozen copies would lose what
+    the subclass adds.
+
+    Raises:
+        TypeError: if value contains objects of any other type.
+    """
+    if isinstance(value, _IMMUTABLE_TYPES + (FrozenDict, FrozenList)):
+        return value
+    if type(value) is dict:
+        result = dict.__new__(FrozenDict)
+        for key, item in value.iteritems():
+            dict.__setitem__(result, freeze(key), freeze(item))
+        return result
+    if type(value) is list:
+        result = list.__new__(FrozenList)
+        list.extend(result, [freeze(item) for item in value])
+        return result
+    if isinstance(value, tuple) and type(value) is tuple:
+        return tuple([freeze(item) for item in value])
+    if isinstance(value, (set, frozenset)):
+        return frozenset([freeze(item) for item in value])
+    raise TypeError('Unable to freeze %s.' % type(value))
+
+
+def thaw(value):
+    """Returns a copy of a frozen value made of regular dicts and lists.
+
+    This is a faster copy.deepcopy() for the values freeze() returns.
+    """
+    if isinstance(value, dict):
+        return dict([
+            (key, thaw(item)) for key, item in value.iteritems()])
+    if isinstance(value, list):
+        return [thaw(item) for item in value]
+    if isinstance(value, tuple) and type(value) is tuple:
+        return tuple([thaw(item) for item in value])
+    return value
+
+
 class NoopCacheConnection(object):
     """Connection to no-op cache that provides no caching."""
 
@@ -488,6 +681,170 @@ class LRUCacheTests(unittest.TestCase):
         found, _ = cache.get('a')
         self.assertTrue(found)
 
+    def test_delete_frees_space(self):
+        cache = LRUCache(max_size_bytes=5000)
+        self.assertTrue(cache.put('a', bytearray(3000)))
+        self.assertTrue(cache.delete('a'))
+        self.assertEquals(0, cache.total_size)
+        self.assertTrue(cache.put('b', bytearray(3000)))
+        self.assertEquals(cache.get_entry_size('b', bytearray(3000)),
+                          cache.total_size)
+
+    def test_put_replaces_size_of_existing_item(self):
+        cache = LRUCache(max_size_bytes=5000)
+        self.assertTrue(cache.put('a', bytearray(3000)))
+        self.assertTrue(cache.put('a', bytearray(100)))
+        self.assertEquals(cache._compute_current_size(), cache.total_size)
+        self.assertTrue(cache.put('b', bytearray(3000)))
+        self.assertTrue(cache.contains('a'))
+
+    def test_evict_by_namespace_quota(self):
+        cache = LRUCache(
+            max_size_bytes=100000, max_namespace_size_bytes=5000,
+            name='test-cache')
+        cache.get_namespace = lambda key: key.split(':')[0]
+        evicted_before = cache._counters['quota'].value
+        self.assertTrue(cache.put('ns_a:1', bytearray(2000)))
+        self.assertTrue(cache.put('ns_a:2', bytearray(2000)))
+        self.assertTrue(cache.put('ns_b:1', bytearray(2000)))
+        self.assertEquals(cache.get('ns_a:1')[0], True)
+        self.assertTrue(cache.put('ns_a:3', bytearray(2000)))
+        self.assertTrue(cache.contains('ns_a:1'))
+        self.assertFalse(cache.contains('ns_a:2'))
+        self.assertTrue(cache.contains('ns_b:1'))
+        self.assertEquals(evicted_before + 1, cache._counters['quota'].value)
+        self.assertFalse(cache.put('ns_b:2', bytearray(6000)))
+        self.assertEquals(
+            cache.get_namespace_size('ns_a') + cache.get_namespace_size('ns_b'),
+            cache.total_size)
+
+    def test_namespace_quota_applies_only_when_shared(self):
+        cache = LRUCache(max_size_bytes=100000, max_namespace_size_bytes=5000)
+        cache.get_namespace = lambda key: key.split(':')[0]
+        for key in ['ns_a:1', 'ns_a:2', 'ns_a:3']:
+            self.assertTrue(cache.put(key, bytearray(2000)))
+        self.assertTrue(cache.put('ns_a:big', bytearray(6000)))
+        self.assertEquals(4, len(cache.items))
+
+        self.assertTrue(cache.put('ns_b:1', bytearray(2000)))
+        self.assertEquals(5, len(cache.items))
+        self.assertTrue(cache.put('ns_a:4', bytearray(2000)))
+        self.assertLessEqual(
+            cache.get_namespace_size('ns_a'), cache.max_namespace_size_bytes)
+        self.assertTrue(cache.contains('ns_a:4'))
+        self.assertTrue(cache.contains('ns_b:1'))
+
+    def test_evictions_are_counted_by_reason(self):
+        cache = LRUCache(max_item_count=2, name='test-cache')
+        counters = cache._counters
+        count_before = counters['count'].value
+        size_before = counters['size'].value
+        for key in 'abc':
+            cache.put(key, key)
+        self.assertEquals(count_before + 1, counters['count'].value)
+        self.assertEquals(size_before, counters['size'].value)
+
+        cache = LRUCache(
+            max_size_bytes=5000, max_item_size_bytes=4000, name='test-cache')
+        too_big_before = counters['too-big'].value
+        self.assertTrue(cache.put('a', bytearray(3000)))
+        self.assertTrue(cache.put('b', bytearray(3000)))
+        self.assertFalse(cache.put('c', bytearray(4500)))
+        self.assertEquals(size_before + 1, counters['size'].value)
+        self.assertEquals(too_big_before + 1, counters['too-big'].value)
+
+    def test_stress(self):
+        """Checks the accounting over many random operations, and times them."""
+        rand = random.Random(0)
+        cache = LRUCache(
+            max_item_count=500, max_size_bytes=200000,
+            max_item_size_bytes=20000, max_namespace_size_bytes=50000)
+        cache.get_namespace = lambda key: key[0]
+        operations = 50000
+        before = time.time()
+        for unused in xrange(operations):
+            key = (rand.randint(0, 9), rand.randint(0, 199))
+            action = rand.random()
+            if action < 0.5:
+                cache.get(key)
+            elif action < 0.9:
+                cache.put(key, bytearray(rand.randint(0, 25000)))
+            else:
+                cache.delete(key)
+        millis = (time.time() - before) * 1000
+        logging.info(
+            'LRUCache: %s random operations in %dms.', operations, millis)
+        self.assertEquals(cache._compute_current_size(), cache.total_size)
+        self.assertLessEqual(len(cache.items), cache.max_item_count)
+        self.assertLess(cache.total_size, cache.max_size_bytes)
+        for namespace in xrange(10):
+            self.assertLessEqual(
+                cache.get_namespace_size(namespace),
+                cache.max_namespace_size_bytes)
+
+
+class FreezeTests(unittest.TestCase):
+
+    def test_freeze_immutable_values(self):
+        for value in ['a', u'b', 1, 2L, 3.0, True, None, datetime.date.today()]:
+            self.assertIs(value, freeze(value))
+        self.assertEqual((1, 'a'), freeze((1, 'a')))
+        self.assertEqual(frozenset([1, 2]), freeze(set([1, 2])))
+
+    def test_frozen_containers_can_not_be_changed(self):
+        value = freeze({'a': [1, {'b': 2}]})
+        self.assertEqual({'a': [1, {'b': 2}]}, value)
+        with self.assertRaises(TypeError):
+            value['c'] = 3
+        with self.assertRaises(TypeError):
+            value.update({'c': 3})
+        with self.assertRaises(TypeError):
+            value['a'].append(3)
+        with self.assertRaises(TypeError):
+            value['a'] += [3]
+        with self.assertRaises(TypeError):
+            del value['a'][1]['b']
+
+    def test_dict_and_list_subclasses_are_not_frozen(self):
+        with self.assertRaises(TypeError):
+            freeze(collections.OrderedDict([('b', 1), ('a', 2)]))
+        with self.assertRaises(TypeError):
+            freeze({'a': collections.defaultdict(list)})
+
+    def test_freeze_copies_value(self):
+        original = {'a': [1]}
+        value = freeze(original)
+        original['a'].append(2)
+        self.assertEqual([1], value['a'])
+
+    def test_copy_of_frozen_value_can_be_changed(self):
+        value = copy.deepcopy(freeze({'a': [1, {'b': 2}]}))
+        self.assertIs(dict, type(value))
+        self.assertIs(list, type(value['a']))
+        self.assertIs(dict, type(value['a'][1]))
+        value['a'].append(3)
+        self.assertEqual([1, {'b': 2}, 3], value['a'])
+
+    def test_thaw_returns_changeable_copy(self):
+        frozen = freeze({'a': [1, {'b': 2}], 'c': (3, [4])})
+        value = thaw(frozen)
+        self.assertEqual({'a': [1, {'b': 2}], 'c': (3, [4])}, value)
+        self.assertIs(dict, type(value))
+        self.assertIs(dict, type(value['a'][1]))
+        value['a'][1]['b'] = 5
+        value['c'][1].append(5)
+        self.assertEqual(2, frozen['a'][1]['b'])
+        self.assertEqual([4], frozen['c'][1])
+
+    def test_freeze_returns_frozen_values_as_is(self):
+        frozen = freeze({'a': [1]})
+        self.assertIs(frozen, freeze(frozen))
+        self.assertIs(frozen['a'], freeze(frozen['a']))
+
+    def test_freeze_rejects_objects(self):
+        with self.assertRaises(TypeError):
+            freeze({'a': object()})
+
 
 class SingletonTests(unittest.TestCase):
 
@@ -546,7 +903,7 @@ class SingletonTests(unittest.TestCase):
 def run_all_unit_tests():
     """Runs all unit tests in this module."""
     suites_list = []
-    for test_class in [LRUCacheTests, SingletonTests]:
+    for test_class in [LRUCacheTests, FreezeTests, SingletonTests]:
         suite = unittest.TestLoader().loadTestsFromTestCase(test_class)
         suites_list.append(suite)
     unittest.TextTestRunner().run(unittest.TestSuite(suites_list))
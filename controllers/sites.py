@@ -126,6 +126,7 @@ from models import messages
 from models import models
 from models import custom_modules
 from models import transforms
+from models import vfs
 from models.config import ConfigProperty
 from models.config import ConfigPropertyEntity
 from models.config import Registry
@@ -487,6 +488,10 @@ def make_css_combo_zip_handler(zipfilename, static_file_handler):
     return CustomCssComboZipHandler
 
 
+# A Range header asking for a single range of bytes, e.g., 'bytes=0-499'.
+_BYTE_RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
 class AssetHandler(utils.BaseHandler):
     """Handles serving of static resources located on the file system."""
 
@@ -506,6 +511,34 @@ class AssetHandler(utils.BaseHandler):
         public = not fs.is_draft(stream)
         return public or Roles.is_course_admin(self.app_context)
 
+    def _get_range(self, size):
+        """Returns the requested (start, stop) bytes, or None for all bytes.
+
+        Only a single range is supported; requests for several ranges, or
+        with a malformed Range header, get the whole file, as HTTP allows.
+
+        Raises:
+            ValueError: if the range starts past the end of the file, or is a
+                suffix range of an empty file.
+        """
+        match = _BYTE_RANGE_RE.match(self.request.headers.get('Range', ''))
+        if not match or match.groups() == ('', ''):
+            return None
+        first, last = match.groups()
+        if not first:
+            suffix_length = int(last)
+            if not suffix_length or not size:
+                raise ValueError()
+            return max(size - suffix_length, 0), size
+        start = int(first)
+        if start >= size:
+            raise ValueError()
+        if not last:
+            return start, size
+        if int(last) < start:
+            return None
+        return start, min(int(last) + 1, size)
+
     def get(self):
         """Handles GET requests."""
         models.MemcacheManager.begin_readonly()
@@ -517,10 +550,28 @@ class AssetHandler(utils.BaseHandler):
             if not self._can_view(self.app_context.fs, stream):
                 self.error(403)
                 return
+            if not hasattr(stream, 'iter_chunks'):
+                stream = vfs.FileStreamWrapped(None, stream.read())
+            size = stream.size
+            try:
+                byte_range = self._get_range(size)
+            except ValueError:
+                self.error(416)
+                self.response.headers['Content-Range'] = 'bytes */%s' % size
+                return
             set_static_resource_cache_control(self)
             self.response.headers['Content-Type'] = self.get_mime_type(
                self.filename)
-            self.response.write(stream.read())
+            self.response.headers['Accept-Ranges'] = 'bytes'
+            if byte_range:
+                start, stop = byte_range
+                self.response.status = 206
+                self.response.headers['Content-Range'] = 'bytes %s-%s/%s' % (
+                    start, stop - 1, size)
+            else:
+                start, stop = 0, size
+            for chunk in stream.iter_chunks(start, stop):
+                self.response.write(chunk)
         finally:
             models.MemcacheManager.end_readonly()
 
@@ -1323,6 +1374,7 @@ class ApplicationRequestHandler(webapp2.RequestHandler):
 
     def is_star_route(self, handler):
         return isinstance(handler, utils.StarRouteHandlerMixin) or (
+            isinstance(handler, type) and
             issubclass(handler, utils.StarRouteHandlerMixin))
 
     def _get_handler_factory_for_path(self, path):
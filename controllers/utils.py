@@ -682,6 +682,42 @@ class _ExtensionSwitcher(ApplicationHandler):
         self._invoke_http_verb('DELETE')
 
 
+class LazyHandlerFactory(object):
+    """Makes handlers of a class that is not imported until first needed.
+
+    Modules may bind namespaced routes to handlers living in costly imports
+    without paying for them at startup, e.g.:
+
+        ('/report', LazyHandlerFactory('modules.foo.reports.ReportHandler'))
+
+    Global routes need no help: webapp2 imports a handler given by its dotted
+    name on first dispatch. A lazy handler can't be a '*' route or provide
+    child routes, since neither is known before its class is imported.
+    """
+
+    def __init__(self, handler_class_name):
+        self._handler_class_name = handler_class_name
+        self._handler_class = None
+
+    @property
+    def handler_class(self):
+        if self._handler_class is None:
+            before = datetime.datetime.utcnow()
+            self._handler_class = webapp2.import_string(
+                self._handler_class_name)
+            logging.info('Imported handler %s: duration=%sms',
+                         self._handler_class_name,
+                         appengine_config.time_delta_to_millis(
+                             datetime.datetime.utcnow() - before))
+        return self._handler_class
+
+    def __call__(self, *args, **kwargs):
+        return self.handler_class(*args, **kwargs)
+
+    def __repr__(self):
+        return 'LazyHandlerFactory(%r)' % self._handler_class_name
+
+
 class ApplicationHandlerSwitcher(object):
     """A utility which allows URI bindings to be switched dynamically."""
 
@@ -19,13 +19,18 @@ __author__ = 'Pavel Simakov (psimakov@google.com)'
 import collections
 import copy
 from datetime import datetime
+import hashlib
 import logging
 import os
 import pickle
 import re
+import struct
 import sys
 import threading
+import time
+import zlib
 import config
+from counters import PerfCounter
 import custom_units
 
 import messages
@@ -38,6 +43,7 @@ import vfs
 import yaml
 
 import appengine_config
+from common import caching
 from common import locales
 from common import safe_dom
 from common import schema_fields
@@ -86,6 +92,62 @@ COURSES_CAN_USE_GOOGLE_APIS = config.ConfigProperty(
     'gcb_courses_can_use_google_apis', bool, messages.SITE_SETTINGS_GOOGLE_APIS,
     default_value=False, label='Google APIs')
 
+# How many memcache records a cached course may span.
+MAX_COURSE_CACHE_SHARDS = 32
+COURSE_CACHE_SHARDS = config.ConfigProperty(
+    'gcb_course_cache_shards', int, messages.SITE_SETTINGS_COURSE_CACHE_SHARDS,
+    default_value=4, label='Course Cache Shards',
+    validator=config.ValidateIntegerRange(1, MAX_COURSE_CACHE_SHARDS).validate)
+
+COURSE_CACHE_SAVE = PerfCounter(
+    'gcb-models-course-cache-save',
+    'A number of times a course was saved to memcache.')
+COURSE_CACHE_SAVE_BYTES = PerfCounter(
+    'gcb-models-course-cache-save-bytes',
+    'A number of bytes of serialized courses before compression.')
+COURSE_CACHE_SAVE_COMPRESSED_BYTES = PerfCounter(
+    'gcb-models-course-cache-save-compressed-bytes',
+    'A number of bytes of serialized courses saved to memcache.')
+COURSE_CACHE_SAVE_TOO_BIG = PerfCounter(
+    'gcb-models-course-cache-save-too-big',
+    'A number of times a course was too big to save to memcache.')
+COURSE_CACHE_LOAD = PerfCounter(
+    'gcb-models-course-cache-load',
+    'A number of times a course was loaded from memcache.')
+COURSE_CACHE_LOAD_MSEC = PerfCounter(
+    'gcb-models-course-cache-load-msec',
+    'A number of milliseconds spent loading courses from memcache.')
+COURSE_CACHE_LOAD_CORRUPT = PerfCounter(
+    'gcb-models-course-cache-load-corrupt',
+    'A number of times a course in memcache had a bad version or checksum.')
+
+ENVIRON_READ_SHARED = PerfCounter(
+    'gcb-models-course-environ-read-shared',
+    'A number of times course settings were read without making a copy.')
+ENVIRON_READ_COPY = PerfCounter(
+    'gcb-models-course-environ-read-copy',
+    'A number of times course settings were copied for a caller.')
+
+COURSE_PROCESS_CACHE_HIT = PerfCounter(
+    'gcb-models-course-process-cache-hit',
+    'A number of times a course was found in process cache.')
+COURSE_PROCESS_CACHE_MISS = PerfCounter(
+    'gcb-models-course-process-cache-miss',
+    'A number of times a course was not found in process cache.')
+COURSE_PROCESS_CACHE_STALE = PerfCounter(
+    'gcb-models-course-process-cache-stale',
+    'A number of times a course in process cache had an old version.')
+
+# How much memory the parsed components of lessons may take in each process.
+COMPONENTS_CACHE_MAX_SIZE_BYTES = 4 * 1024 * 1024
+
+COMPONENTS_CACHE_HIT = PerfCounter(
+    'gcb-models-course-components-cache-hit',
+    'A number of times parsed lesson components were found in process cache.')
+COMPONENTS_CACHE_MISS = PerfCounter(
+    'gcb-models-course-components-cache-miss',
+    'A number of times lesson components had to be parsed from HTML.')
+
 # The config key part under which course info lives.
 _CONFIG_KEY_PART_COURSE = 'course'
 # The config key part under which google info lives.
@@ -359,12 +421,32 @@ def has_only_new_style_activities(course):
 
 
 class AbstractCachedObject(object):
-    """Abstract serializable versioned object that can stored in memcache."""
+    """Abstract serializable versioned object that can stored in memcache.
+
+    The serialized object is compressed with zlib and split into shards of
+    at most one memcache record each. Shard 0 starts with a header holding
+    the format version, the number of shards, whether the data is compressed
+    and a CRC-32 checksum of the data; a mismatch of any of these makes
+    load() return None, so the caller rebuilds the object.
+    """
+
+    # Version of the layout of the cached shards; bump when changing it.
+    FORMAT_VERSION = 2
+
+    # The zlib compression level; 0 stores the data uncompressed.
+    COMPRESSION_LEVEL = 6
+
+    # Format version, number of shards, is compressed, checksum.
+    _HEADER = struct.Struct('!BBBI')
 
     @classmethod
-    def _max_size(cls):
+    def _max_shards(cls):
         # By default, max out at one cache record.
-        return models.MEMCACHE_MAX
+        return 1
+
+    @classmethod
+    def _max_size(cls):
+        return models.MEMCACHE_MAX * cls._max_shards()
 
     @classmethod
     def _make_keys(cls):
@@ -374,16 +456,14 @@ class AbstractCachedObject(object):
         # application can put/get its own version of the course and the
         # deployment.
 
-        # Generate the maximum number of cache shard keys indicated by the max
-        # allowed size of the derived type.  Not all of these will necessarily
-        # be used, but the number of shards is typically very small (max of 4)
-        # so pre-generating these is not a big burden.
-        num_shards = (
-            (cls._max_size() + models.MEMCACHE_MAX - 1) // models.MEMCACHE_MAX)
+        # Generate the maximum number of cache shard keys allowed for the
+        # derived type.  Not all of these will necessarily be used, but the
+        # number of shards is small, so pre-generating these is not a big
+        # burden.
         return [
             'course:model:pickle:%s:%s:%d' % (
                 cls.VERSION, os.environ.get('CURRENT_VERSION_ID'), shard)
-            for shard in xrange(num_shards)]
+            for shard in xrange(cls._max_shards())]
 
     @classmethod
     def new_memento(cls):
@@ -400,31 +480,54 @@ class AbstractCachedObject(object):
         """Creates serializable memento from instance."""
         raise Exception('Not implemented')
 
+    @classmethod
+    def _checksum(cls, data_bytes):
+        return zlib.crc32(data_bytes) & 0xffffffff
+
     @classmethod
     def load(cls, app_context):
         """Loads instance from memcache; does not fail on errors."""
         shard_keys = cls._make_keys()
-        shard_contents = {}
+        start = time.time()
         try:
             shard_0 = MemcacheManager.get(
                 shard_keys[0], namespace=app_context.get_namespace_name())
             if not shard_0:
                 return None
 
-            num_shards = ord(shard_0[0])
-            shard_contents[shard_keys[0]] = shard_0[1:]
+            format_version, num_shards, is_compressed, checksum = (
+                cls._HEADER.unpack(shard_0[:cls._HEADER.size]))
+            if format_version != cls.FORMAT_VERSION:
+                COURSE_CACHE_LOAD_CORRUPT.inc()
+                return None
+            if num_shards > len(shard_keys):
+                return None
+
+            data = [shard_0[cls._HEADER.size:]]
             if num_shards > 1:
-                shard_contents.update(MemcacheManager.get_multi(
-                    shard_keys[1:], namespace=app_context.get_namespace_name()))
-            if len(shard_contents) != num_shards:
+                shard_contents = MemcacheManager.get_multi(
+                    shard_keys[1:num_shards],
+                    namespace=app_context.get_namespace_name())
+                if len(shard_contents) != num_shards - 1:
+                    return None
+                for shard_key in shard_keys[1:num_shards]:
+                    data.append(shard_contents[shard_key])
+            data_bytes = ''.join(data)
+            if cls._checksum(data_bytes) != checksum:
+                COURSE_CACHE_LOAD_CORRUPT.inc()
+                logging.error(
+                    'Bad checksum of object \'%s\' in memcache.', shard_keys)
                 return None
+            if is_compressed:
+                data_bytes = zlib.decompress(data_bytes)
 
-            data = []
-            for shard_key in sorted(shard_contents.keys()):
-                data.append(shard_contents[shard_key])
             memento = cls.new_memento()
-            memento.deserialize(''.join(data))
-            return cls.instance_from_memento(app_context, memento)
+            memento.deserialize(data_bytes)
+            instance = cls.instance_from_memento(app_context, memento)
+            COURSE_CACHE_LOAD.inc()
+            COURSE_CACHE_LOAD_MSEC.inc(
+                increment=int((time.time() - start) * 1000))
+            return instance
 
         except Exception as e:  # pylint: disable=broad-except
             logging.error(
@@ -434,13 +537,25 @@ class AbstractCachedObject(object):
     @classmethod
     def save(cls, app_context, instance):
         """Saves instance to memcache."""
+        data_bytes = cls.memento_from_instance(instance).serialize()
+        COURSE_CACHE_SAVE.inc()
+        COURSE_CACHE_SAVE_BYTES.inc(increment=len(data_bytes))
+        is_compressed = cls.COMPRESSION_LEVEL > 0
+        if is_compressed:
+            data_bytes = zlib.compress(data_bytes, cls.COMPRESSION_LEVEL)
+        COURSE_CACHE_SAVE_COMPRESSED_BYTES.inc(increment=len(data_bytes))
+
+        num_shards_required = (
+            cls._HEADER.size + len(data_bytes) + models.MEMCACHE_MAX - 1
+            ) // models.MEMCACHE_MAX
+        data_bytes = cls._HEADER.pack(
+            cls.FORMAT_VERSION, num_shards_required, is_compressed,
+            cls._checksum(data_bytes)) + data_bytes
 
         # If item to cache is too large, clear the old cached value for this
         # item, and don't send the new, too-large item to cache.
-        data_bytes = cls.memento_from_instance(instance).serialize()
-        num_shards_required = (len(data_bytes) // models.MEMCACHE_MAX) + 1
-        data_bytes = chr(num_shards_required) + data_bytes
         if len(data_bytes) > cls._max_size():
+            COURSE_CACHE_SAVE_TOO_BIG.inc()
             logging.warning(
                 'Not sending %d bytes for %s to Memcache; this is more '
                 'than the maximum limit of %d bytes.',
@@ -467,7 +582,7 @@ class AbstractCachedObject(object):
 
     def serialize(self):
         """Saves instance to a pickle representation."""
-        return pickle.dumps(self.__dict__)
+        return pickle.dumps(self.__dict__, pickle.HIGHEST_PROTOCOL)
 
     def deserialize(self, binary_data):
         """Loads instance from a pickle representation."""
@@ -1134,7 +1249,8 @@ class CachedCourse13(AbstractCachedObject):
 
     def __init__(
         self, next_id=None, units=None, lessons=None,
-        unit_id_to_lesson_ids=None):
+        unit_id_to_lesson_ids=None, unit_by_id=None, lesson_by_id=None,
+        parent_unit_by_id=None):
 
         self.version = self.VERSION
         self.next_id = next_id
@@ -1146,12 +1262,15 @@ class CachedCourse13(AbstractCachedObject):
         # is no need to persist these indexes in durable storage, but it is
         # nice to have them in memcache.
         self.unit_id_to_lesson_ids = unit_id_to_lesson_ids
+        self.unit_by_id = unit_by_id
+        self.lesson_by_id = lesson_by_id
+        self.parent_unit_by_id = parent_unit_by_id
 
     @classmethod
-    def _max_size(cls):
-        # Cap at approximately 4M to avoid 1M single-cache-element limit,
+    def _max_shards(cls):
+        # Span several records to avoid 1M single-cache-element limit,
         # which is too small for larger courses.
-        return models.MEMCACHE_MAX * 4
+        return COURSE_CACHE_SHARDS.value
 
     @classmethod
     def new_memento(cls):
@@ -1162,14 +1281,20 @@ class CachedCourse13(AbstractCachedObject):
         return CourseModel13(
             app_context, next_id=memento.next_id,
             units=memento.units, lessons=memento.lessons,
-            unit_id_to_lesson_ids=memento.unit_id_to_lesson_ids)
+            unit_id_to_lesson_ids=memento.unit_id_to_lesson_ids,
+            unit_by_id=getattr(memento, 'unit_by_id', None),
+            lesson_by_id=getattr(memento, 'lesson_by_id', None),
+            parent_unit_by_id=getattr(memento, 'parent_unit_by_id', None))
 
     @classmethod
     def memento_from_instance(cls, course):
         return CachedCourse13(
             next_id=course.next_id,
             units=course.units, lessons=course.lessons,
-            unit_id_to_lesson_ids=course.unit_id_to_lesson_ids)
+            unit_id_to_lesson_ids=course.unit_id_to_lesson_ids,
+            unit_by_id=course.unit_by_id,
+            lesson_by_id=course.lesson_by_id,
+            parent_unit_by_id=course.parent_unit_by_id)
 
 
 class CourseModel13(object):
@@ -1198,9 +1323,30 @@ class CourseModel13(object):
             unit_id_to_lesson_ids[key].append(str(lesson.lesson_id))
         return unit_id_to_lesson_ids
 
+    @classmethod
+    def _make_unit_lookup_dicts(cls, units):
+        """Creates indexes of unit.unit_id and pre/post assessment to unit."""
+        unit_by_id = {}
+        parent_unit_by_id = {}
+        for unit in units:
+            unit_by_id.setdefault(str(unit.unit_id), unit)
+            for assessment_id in (unit.pre_assessment, unit.post_assessment):
+                if assessment_id is not None:
+                    parent_unit_by_id.setdefault(str(assessment_id), unit)
+        return unit_by_id, parent_unit_by_id
+
+    @classmethod
+    def _make_lesson_lookup_dict(cls, lessons):
+        """Creates an index of lesson.lesson_id to lesson."""
+        lesson_by_id = {}
+        for lesson in lessons:
+            lesson_by_id.setdefault(str(lesson.lesson_id), lesson)
+        return lesson_by_id
+
     def __init__(
         self, app_context, next_id=None, units=None, lessons=None,
-        unit_id_to_lesson_ids=None):
+        unit_id_to_lesson_ids=None, unit_by_id=None, lesson_by_id=None,
+        parent_unit_by_id=None):
 
         # Init default values.
         self._app_context = app_context
@@ -1208,6 +1354,14 @@ class CourseModel13(object):
         self._units = []
         self._lessons = []
         self._unit_id_to_lesson_ids = {}
+        self._unit_by_id = {}
+        self._lesson_by_id = {}
+        self._parent_unit_by_id = {}
+
+        # The unit and lesson lists the lookup dicts above were built from;
+        # lookups fall back to a linear scan when these are swapped out.
+        self._indexed_units = None
+        self._indexed_lessons = None
 
         # These array keep dirty object in current transaction.
         self._dirty_units = []
@@ -1222,8 +1376,18 @@ class CourseModel13(object):
             self._units = units
         if lessons:
             self._lessons = lessons
-        if unit_id_to_lesson_ids:
+        if (unit_id_to_lesson_ids and unit_by_id is not None and
+            lesson_by_id is not None and parent_unit_by_id is not None):
             self._unit_id_to_lesson_ids = unit_id_to_lesson_ids
+            self._unit_by_id = unit_by_id
+            self._lesson_by_id = lesson_by_id
+            self._parent_unit_by_id = parent_unit_by_id
+            self._indexed_units = self._units
+            self._indexed_lessons = self._lessons
+        elif unit_id_to_lesson_ids:
+            # Memento cached before the lookup dicts were added to it.
+            self._unit_id_to_lesson_ids = unit_id_to_lesson_ids
+            self._index_lookups()
         else:
             self._index()
 
@@ -1247,6 +1411,18 @@ class CourseModel13(object):
     def unit_id_to_lesson_ids(self):
         return self._unit_id_to_lesson_ids
 
+    @property
+    def unit_by_id(self):
+        return self._unit_by_id
+
+    @property
+    def lesson_by_id(self):
+        return self._lesson_by_id
+
+    @property
+    def parent_unit_by_id(self):
+        return self._parent_unit_by_id
+
     def _get_next_id(self):
         """Allocates next id in sequence."""
         next_id = self._next_id
@@ -1257,8 +1433,17 @@ class CourseModel13(object):
         """Indexes units and lessons."""
         self._unit_id_to_lesson_ids = self._make_unit_id_to_lessons_lookup_dict(
             self._lessons)
+        self._index_lookups()
         index_units_and_lessons(self)
 
+    def _index_lookups(self):
+        """Indexes units and lessons by id for find_*_by_id() lookups."""
+        self._unit_by_id, self._parent_unit_by_id = (
+            self._make_unit_lookup_dicts(self._units))
+        self._lesson_by_id = self._make_lesson_lookup_dict(self._lessons)
+        self._indexed_units = self._units
+        self._indexed_lessons = self._lessons
+
     def get_file_content(self, filename):
         fs = self.app_context.fs
         path = fs.impl.physical_to_logical(filename)
@@ -1414,6 +1599,8 @@ class CourseModel13(object):
         self._index()
         PersistentCourse13.save(self._app_context, self)
         CachedCourse13.delete(self._app_context)
+        models.CourseContentVersion.invalidate(
+            self._app_context.get_namespace_name())
 
     def get_units(self):
         return self._units[:]
@@ -1451,6 +1638,8 @@ class CourseModel13(object):
 
     def find_unit_by_id(self, unit_id):
         """Finds a unit given its id."""
+        if self._units is self._indexed_units:
+            return self._unit_by_id.get(str(unit_id))
         for unit in self._units:
             if str(unit.unit_id) == str(unit_id):
                 return unit
@@ -1458,6 +1647,8 @@ class CourseModel13(object):
 
     def find_lesson_by_id(self, unused_unit, lesson_id):
         """Finds a lesson given its id."""
+        if self._lessons is self._indexed_lessons:
+            return self._lesson_by_id.get(str(lesson_id))
         for lesson in self._lessons:
             if str(lesson.lesson_id) == str(lesson_id):
                 return lesson
@@ -1466,6 +1657,13 @@ class CourseModel13(object):
     def get_parent_unit(self, unit_id):
         # See if the unit is an assessment being used as a pre/post
         # unit lesson.
+        if self._units is self._indexed_units:
+            unit = self._parent_unit_by_id.get(str(unit_id))
+            if unit and (str(unit.pre_assessment) == str(unit_id) or
+                         str(unit.post_assessment) == str(unit_id)):
+                return unit
+            if not unit:
+                return None
         for unit in self.get_units():
             if (str(unit.pre_assessment) == str(unit_id) or
                 str(unit.post_assessment) == str(unit_id)):
@@ -1562,6 +1760,8 @@ class CourseModel13(object):
             self._app_context.fs.impl.delete(entity)
         assert not self._app_context.fs.impl.list(appengine_config.BUNDLE_ROOT)
         CachedCourse13.delete(self._app_context)
+        models.CourseContentVersion.invalidate(
+            self._app_context.get_namespace_name())
 
     def delete_lesson(self, lesson):
         """Delete a lesson."""
@@ -1612,6 +1812,7 @@ class CourseModel13(object):
         existing_unit.unit_header = unit.unit_header
         existing_unit.unit_footer = unit.unit_footer
         existing_unit.properties = unit.properties
+        self._index_lookups()
         existing_unit.custom_unit_type = unit.custom_unit_type
 
         if verify.UNIT_TYPE_LINK == existing_unit.type:
@@ -2285,6 +2486,97 @@ class Workflow(object):
             return False
 
 
+class ProcessScopedComponentsCache(caching.ProcessScopedSingleton):
+    """A process-scoped LRU cache of components parsed from lesson HTML.
+
+    Items are keyed by the lesson id, the parser used and a digest of the
+    HTML, so an edited lesson simply misses and is parsed again; the stale
+    entry ages out. Values are tuples of component dicts and must not be
+    changed; get() hands out copies.
+    """
+
+    def __init__(self):
+        self.cache = caching.LRUCache(
+            max_size_bytes=COMPONENTS_CACHE_MAX_SIZE_BYTES,
+            name='models-course-components-cache')
+        self.cache.get_entry_size = self._get_entry_size
+
+    def _get_entry_size(self, key, value):
+        size = sys.getsizeof(key) + sys.getsizeof(value)
+        for component in value:
+            size += sys.getsizeof(component)
+            for name, item in component.iteritems():
+                size += sys.getsizeof(name) + sys.getsizeof(item)
+        return size
+
+    @classmethod
+    def _make_key(cls, lesson_id, html, use_lxml):
+        if isinstance(html, unicode):
+            html = html.encode('utf-8')
+        return (str(lesson_id), bool(use_lxml), hashlib.md5(html).digest())
+
+    def get(self, lesson_id, html, use_lxml):
+        """Returns the components in the lesson HTML, parsing it on a miss."""
+        key = self._make_key(lesson_id, html, use_lxml)
+        found, components = self.cache.get(key)
+        if found:
+            COMPONENTS_CACHE_HIT.inc()
+        else:
+            COMPONENTS_CACHE_MISS.inc()
+            components = tuple(
+                common.tags.get_components_from_html(html, use_lxml))
+            self.cache.put(key, components)
+        return [dict(component) for component in components]
+
+
+class ProcessScopedCourseCache(caching.ProcessScopedSingleton):
+    """A process-scoped cache of Course objects shared by requests.
+
+    Items are keyed by namespace and remember the course content version
+    they were loaded at. A request reuses an item only if the version in
+    memcache still matches; this costs one small memcache get instead of
+    fetching and unpickling the whole course. Saving the course drops the
+    version, so every instance loads the course again on its next request.
+
+    Translation changes units and lessons in place, so only courses viewed
+    in their default locale are shared.
+    """
+
+    def __init__(self):
+        self.items = {}
+
+    @classmethod
+    def _is_shareable(cls, app_context):
+        locale = app_context.get_current_locale()
+        return not locale or locale == app_context.default_locale
+
+    @appengine_config.timeandlog(
+        'ProcessScopedCourseCache.lookup', duration_only=True)
+    def _lookup(self, app_context, namespace):
+        version = models.CourseContentVersion.get(namespace)
+        entry = self.items.get(namespace)
+        if not entry:
+            COURSE_PROCESS_CACHE_MISS.inc()
+            return version, None
+        _version, _app_context, course = entry
+        if _version != version or _app_context is not app_context:
+            COURSE_PROCESS_CACHE_STALE.inc()
+            return version, None
+        COURSE_PROCESS_CACHE_HIT.inc()
+        return version, course
+
+    def get(self, app_context):
+        """Returns a shared course, loading it if missing or out of date."""
+        if not self._is_shareable(app_context):
+            return Course(None, app_context)
+        namespace = app_context.get_namespace_name()
+        version, course = self._lookup(app_context, namespace)
+        if not course:
+            course = Course(None, app_context)
+            self.items[namespace] = (version, app_context, course)
+        return course
+
+
 class Course(object):
     """Manages a course and all of its components."""
 
@@ -2366,14 +2658,39 @@ class Course(object):
             os.environ.get('CURRENT_VERSION_ID'), locale)
 
     @classmethod
-    def get_environ(cls, app_context):
-        """Returns currently defined course settings as a dictionary."""
+    def _internalize_environ(cls, env):
+        """Freezes settings for the local cache, if they can be frozen."""
+        try:
+            return caching.freeze(env)
+        except TypeError:
+            return env
+
+    @classmethod
+    def _externalize_environ(cls, env, mutable):
+        """Returns cached settings as is if allowed, or a copy of them."""
+        if isinstance(env, caching.FrozenDict):
+            if not mutable:
+                ENVIRON_READ_SHARED.inc()
+                return env
+            ENVIRON_READ_COPY.inc()
+            return caching.thaw(env)
+        ENVIRON_READ_COPY.inc()
+        return copy.deepcopy(env)
+
+    @classmethod
+    def get_environ(cls, app_context, mutable=True):
+        """Returns currently defined course settings as a dictionary.
+
+        Callers get their own copy, which they may change. Callers that only
+        read settings may pass mutable=False to get the cached settings
+        without a copy; changing those raises TypeError.
+        """
         # pylint: disable=protected-access
 
         # get from local cache
         env = app_context._cached_environ
         if env:
-            return copy.deepcopy(env)
+            return cls._externalize_environ(env, mutable)
 
         # get from global cache
         _locale = app_context.get_current_locale()
@@ -2381,7 +2698,9 @@ class Course(object):
         env = models.MemcacheManager.get(
             _key, namespace=app_context.get_namespace_name())
         if env:
-            return env
+            env = cls._internalize_environ(env)
+            app_context._cached_environ = env
+            return cls._externalize_environ(env, mutable)
 
         models.MemcacheManager.begin_readonly()
         try:
@@ -2391,14 +2710,14 @@ class Course(object):
             # Monkey patch to defend against infinite recursion. Downstream
             # calls do not reload the env but just return the copy we have here.
             old_get_environ = cls.get_environ
-            cls.get_environ = classmethod(lambda cl, ac: env)
+            cls.get_environ = classmethod(lambda cl, ac, mutable=True: env)
             try:
                 # run hooks
                 for hook in cls.COURSE_ENV_POST_LOAD_HOOKS:
                     hook(env)
 
                 # put into local and global cache
-                app_context._cached_environ = env
+                app_context._cached_environ = cls._internalize_environ(env)
                 models.MemcacheManager.set(
                     _key, env, namespace=app_context.get_namespace_name())
             finally:
@@ -2407,7 +2726,7 @@ class Course(object):
         finally:
             models.MemcacheManager.end_readonly()
 
-        return copy.deepcopy(env)
+        return cls._externalize_environ(app_context._cached_environ, mutable)
 
     @classmethod
     def _load_environ(cls, app_context):
@@ -2754,7 +3073,8 @@ class Course(object):
         return reg
 
     def get_course_setting(self, name):
-        course_settings = self.get_environ(self._app_context).get('course')
+        course_settings = self.get_environ(
+            self._app_context, mutable=False).get('course')
         if not course_settings:
             return None
         return course_settings.get(name)
@@ -2813,6 +3133,9 @@ class Course(object):
         Course() when you are executing mutations and want to have the most up
         to date instance.
 
+        Instances returned here may also be shared with other requests served
+        by the same process; see ProcessScopedCourseCache.
+
         Args:
           app_context: an app_context of the Course, instance of which you need
         Returns:
@@ -2822,7 +3145,10 @@ class Course(object):
             _app_context, _course = cls.INSTANCE.current
             if _course and (app_context == _app_context or app_context is None):
                 return _course
-        _course = Course(None, app_context)
+        if app_context:
+            _course = ProcessScopedCourseCache.instance().get(app_context)
+        else:
+            _course = Course(None, app_context)
         cls.set_current(_course)
         return _course
 
@@ -3076,11 +3402,13 @@ class Course(object):
         # string.
         return 'pass' if score >= 70 else 'fail'
 
-    def get_all_scores(self, student):
+    def get_all_scores(self, student, student_progress=None):
         """Gets all score data for a student.
 
         Args:
             student: the student whose scores should be retrieved.
+            student_progress: the student's progress entity, if the caller
+                has already loaded it.
 
         Returns:
             an array of dicts, each representing an assessment. Each dict has
@@ -3093,7 +3421,8 @@ class Course(object):
         scores = transforms.loads(student.scores) if student.scores else {}
 
         progress_tracker = self.get_progress_tracker()
-        student_progress = progress_tracker.get_or_create_progress(student)
+        if student_progress is None:
+            student_progress = progress_tracker.get_or_create_progress(student)
 
         assessment_score_list = []
         for unit in unit_list:
@@ -3172,6 +3501,32 @@ class Course(object):
     def get_activity_filename(self, unit_id, lesson_id):
         return self._model.get_activity_filename(unit_id, lesson_id)
 
+    def prefetch_content_files(self, units=None, lessons=None):
+        """Reads assessment and activity files of units and lessons at once.
+
+        Pages that show several units or lessons can call this first so the
+        files they go on to read come from cache rather than from a datastore
+        call per file.
+
+        Args:
+            units: a list of units; files are read for the assessments that
+                are not written in HTML
+            lessons: a list of lessons; files are read for their activities
+        """
+        filenames = []
+        for unit in units or []:
+            # HTML assessments of 1.3 courses have no assessment file.
+            if unit.is_assessment() and not getattr(
+                    unit, 'html_content', None):
+                filenames.append(self.get_assessment_filename(unit.unit_id))
+        for lesson in lessons or []:
+            if lesson.activity:
+                filenames.append(self.get_activity_filename(
+                    lesson.unit_id, lesson.lesson_id))
+        self.app_context.fs.prefetch([
+            os.path.join(self.app_context.get_home(), filename)
+            for filename in filenames])
+
     def get_parent_unit(self, unit_id):
         return self._model.get_parent_unit(unit_id)
 
@@ -3193,8 +3548,8 @@ class Course(object):
         if not lesson.objectives:
             return []
 
-        return common.tags.get_components_from_html(
-            lesson.objectives, use_lxml)
+        return ProcessScopedComponentsCache.instance().get(
+            lesson.lesson_id, lesson.objectives, use_lxml)
 
     def get_content_as_dict_safe(self, unit, errors, kind='assessment'):
         """Validate the assessment or review script and return as a dict."""
@@ -3597,3 +3952,7 @@ course:
 
     def is_lesson_available(self, unit, lesson):
         return self._model.is_lesson_available(unit, lesson)
+
+
+# Course settings are read on every page.
+models.MemcacheManager.add_l1_key_prefix('course:environ:')
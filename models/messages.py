@@ -408,6 +408,11 @@ this setting to "False" so you can see your changes instantaneously. Otherwise,
 keep this setting at "True" to maximize performance.
 """
 
+SITE_SETTINGS_MAX_CACHED_CONTENT_SIZE = """
+Course content files larger than this many bytes are not cached. They are read
+from the datastore in parts of about 1 MB, as they are served.
+"""
+
 SITE_SETTINGS_COURSE_URLS = safe_dom.NodeList().append(
     safe_dom.Element('div').add_text("""
 Specify the URLs for your course(s). Specify only one course per line.""")
@@ -466,6 +471,18 @@ should turn this setting to "False" so you can see your changes instantaneously.
 Otherwise, keep this setting at "True" to maximize performance.
 """
 
+SITE_SETTINGS_COURSE_CACHE_SHARDS = """
+This is the number of memcache records, of about 1 MB each, that the compressed
+units and lessons of a course may use. Courses that need more records are not
+cached in memcache and are read from the datastore on every request.
+"""
+
+SITE_SETTINGS_MEMCACHE_L1 = """
+If "True", frequently read objects in memcache, such as course settings and
+labels, are also cached in the memory of each application instance. Changes to
+these objects may take a few seconds to appear on every instance.
+"""
+
 SITE_SETTINGS_QUEUE_NOTIFICATION = safe_dom.NodeList().append(
     safe_dom.Element('div').add_text("""
 Specify the number of queue failures before Course Builder sends a notification
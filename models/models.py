@@ -99,17 +99,152 @@ CACHE_MISS_LOCAL = PerfCounter(
     'gcb-models-cache-miss-local',
     'A number of times an object was not found in local memcache.')
 
+# Process-scoped L1 cache in front of memcache.
+CAN_USE_MEMCACHE_L1 = config.ConfigProperty(
+    'gcb_can_use_memcache_l1', bool, messages.SITE_SETTINGS_MEMCACHE_L1,
+    default_value=False, label='Memcache L1 Cache')
+
+# The default amount of time to cache the items for in the L1 cache.
+DEFAULT_L1_CACHE_TTL_SECS = 30
+
+# Size limits of the L1 cache; larger items are only kept in memcache.
+MEMCACHE_L1_MAX_SIZE_BYTES = 8 * 1024 * 1024
+MEMCACHE_L1_MAX_ITEM_SIZE_BYTES = 256 * 1024
+
+# Memcache key of the per-namespace L1 cache version.
+MEMCACHE_L1_VERSION_KEY = 'memcache-l1:version'
+
+# performance counters for copies of cached objects
+CACHE_READ_FROZEN = PerfCounter(
+    'gcb-models-cache-read-frozen',
+    'A number of times a frozen cached object was returned without a copy.')
+CACHE_READ_COPY = PerfCounter(
+    'gcb-models-cache-read-copy',
+    'A number of times a cached object was deep-copied before returning it.')
+
+# performance counters for process-scoped L1 cache
+CACHE_PUT_L1 = PerfCounter(
+    'gcb-models-cache-put-l1',
+    'A number of times an object was put into the L1 cache.')
+CACHE_HIT_L1 = PerfCounter(
+    'gcb-models-cache-hit-l1',
+    'A number of times an object was found in the L1 cache.')
+CACHE_MISS_L1 = PerfCounter(
+    'gcb-models-cache-miss-l1',
+    'A number of times an object was not found in the L1 cache.')
+CACHE_STALE_L1 = PerfCounter(
+    'gcb-models-cache-stale-l1',
+    'A number of times an object in the L1 cache had expired or had an '
+    'outdated version.')
+CACHE_INVALIDATE_L1 = PerfCounter(
+    'gcb-models-cache-invalidate-l1',
+    'A number of times the L1 cache version of a namespace was incremented.')
+
 # Intent for sending welcome notifications.
 WELCOME_NOTIFICATION_INTENT = 'welcome'
 
 
+class ProcessScopedMemcacheL1(caching.ProcessScopedSingleton):
+    """A process-scoped LRU cache of hot memcache items.
+
+    Items are keyed by (namespace, key) and stored with the time they expire
+    and the L1 version of their namespace at the time they were cached. An
+    item is only served if it has not expired and its version is current.
+    Values are the entries made by MemcacheManager._internalize().
+    """
+
+    def __init__(self):
+        self.cache = caching.LRUCache(
+            max_size_bytes=MEMCACHE_L1_MAX_SIZE_BYTES,
+            max_item_size_bytes=MEMCACHE_L1_MAX_ITEM_SIZE_BYTES)
+        self.cache.get_entry_size = self._get_entry_size
+
+    def _get_entry_size(self, key, value):
+        unused_namespace, _key = key
+        unused_version, unused_expires_on, entry = value
+        if isinstance(entry, _CopiedCacheEntry):
+            entry = entry.value
+        return sys.getsizeof(_key) + sys.getsizeof(entry)
+
+    def get(self, key, namespace, version):
+        found, entry = self.cache.get((namespace, key))
+        if not found:
+            return False, None
+        _version, expires_on, value = entry
+        if _version != version or expires_on < time.time():
+            CACHE_STALE_L1.inc()
+            self.cache.delete((namespace, key))
+            return False, None
+        return True, value
+
+    def put(self, key, namespace, version, value, ttl):
+        if self.cache.put(
+            (namespace, key), (version, time.time() + ttl, value)):
+            CACHE_PUT_L1.inc()
+
+    def delete(self, key, namespace):
+        self.cache.delete((namespace, key))
+
+
+class RequestScopedMemcacheL1Versions(caching.RequestScopedSingleton):
+    """The L1 cache versions of the namespaces used by the current request.
+
+    Each version is read from memcache once per request, so an item changed
+    by another instance is served from the L1 cache until the end of the
+    current request at most.
+    """
+
+    def __init__(self):
+        self.versions = {}
+
+    def get(self, namespace):
+        version = self.versions.get(namespace)
+        if version is None:
+            version = memcache.get(
+                MEMCACHE_L1_VERSION_KEY, namespace=namespace)
+            if version is None:
+                # Start from the current time, not 0, so that items cached
+                # before the version was evicted from memcache are stale.
+                version = int(time.time() * 1000)
+                if not memcache.add(
+                    MEMCACHE_L1_VERSION_KEY, version, namespace=namespace):
+                    version = memcache.get(
+                        MEMCACHE_L1_VERSION_KEY, namespace=namespace)
+            self.versions[namespace] = version
+        return version
+
+    def incr(self, namespace):
+        CACHE_INVALIDATE_L1.inc()
+        self.versions[namespace] = memcache.incr(
+            MEMCACHE_L1_VERSION_KEY, namespace=namespace,
+            initial_value=int(time.time() * 1000))
+
+
+class _CopiedCacheEntry(object):
+    """A cached value that can't be frozen, so it is copied on every read."""
+
+    __slots__ = ['value']
+
+    def __init__(self, value):
+        self.value = value
+
+
 class MemcacheManager(object):
-    """Class that consolidates all memcache operations."""
+    """Class that consolidates all memcache operations.
+
+    Objects kept in the local or L1 cache are returned as read-only values
+    built with caching.freeze(), so reading them does not need a deep copy.
+    Callers that change what they read must pass mutable=True to get() and
+    get_multi(). Objects that can't be frozen, e.g., entities, are always
+    deep-copied.
+    """
 
     _LOCAL_CACHE = None
     _IS_READONLY = False
     _READONLY_REENTRY_COUNT = 0
     _READONLY_APP_CONTEXT = None
+    _L1_KEY_PREFIXES = set()
+    _L1_TTL_SECS = {}
 
     @classmethod
     def _is_same_app_context_if_set(cls):
@@ -186,43 +321,128 @@ class MemcacheManager(object):
                 cls._LOCAL_CACHE[namespace] = _dict
             if key in _dict:
                 CACHE_HIT_LOCAL.inc()
-                value = _dict[key]
-                return True, value
+                entry = _dict[key]
+                return True, entry
             else:
                 CACHE_MISS_LOCAL.inc()
         return False, None
 
     @classmethod
-    def _local_cache_put(cls, key, namespace, value):
+    def _local_cache_put(cls, key, namespace, entry):
         if cls._IS_READONLY:
             assert cls._is_same_app_context_if_set()
             _dict = cls._LOCAL_CACHE.get(namespace)
             if not _dict:
                 _dict = {}
                 cls._LOCAL_CACHE[namespace] = _dict
-            _dict[key] = value
+            _dict[key] = entry
             CACHE_PUT_LOCAL.inc()
 
     @classmethod
     def _local_cache_get_multi(cls, keys, namespace):
         if cls._IS_READONLY:
             assert cls._is_same_app_context_if_set()
-            values = []
+            entries = {}
             for key in keys:
-                is_cached, value = cls._local_cache_get(key, namespace)
+                is_cached, entry = cls._local_cache_get(key, namespace)
                 if not is_cached:
-                    return False, []
+                    return False, {}
                 else:
-                    values.append(value)
-            return True, values
-        return False, []
+                    entries[key] = entry
+            return True, entries
+        return False, {}
 
     @classmethod
-    def _local_cache_put_multi(cls, values, namespace):
-        if cls._IS_READONLY:
-            assert cls._is_same_app_context_if_set()
-            for key, value in values.items():
-                cls._local_cache_put(key, namespace, value)
+    def _internalize(cls, value):
+        """Makes the entry kept in local or L1 cache: a frozen copy if we can."""
+        try:
+            return caching.freeze(value)
+        except TypeError:
+            return _CopiedCacheEntry(copy.deepcopy(value))
+
+    @classmethod
+    def _externalize(cls, entry, mutable):
+        """Returns the value of an entry; copies it unless frozen and shared."""
+        if isinstance(entry, _CopiedCacheEntry):
+            CACHE_READ_COPY.inc()
+            return copy.deepcopy(entry.value)
+        if mutable:
+            CACHE_READ_COPY.inc()
+            return copy.deepcopy(entry)
+        CACHE_READ_FROZEN.inc()
+        return entry
+
+    @classmethod
+    def _retain(cls, key, namespace, value, mutable):
+        """Keeps a value in local and L1 cache; returns the value to use.
+
+        The value passed in is owned by the caller: it was just read from
+        memcache or is about to be written there.
+        """
+        if not (cls._IS_READONLY or cls._is_l1_key(key)):
+            return value
+        entry = cls._internalize(value)
+        cls._local_cache_put(key, namespace, entry)
+        cls._l1_cache_put(key, namespace, entry)
+        if mutable or isinstance(entry, _CopiedCacheEntry):
+            return value
+        return entry
+
+    @classmethod
+    def add_l1_key_prefix(cls, prefix):
+        """Marks keys starting with prefix as hot, i.e., kept in L1 cache.
+
+        Only items that are read far more often than they change belong in
+        the L1 cache: every change of such an item makes all L1 items of its
+        namespace stale on all instances. Such items must be changed with
+        delete() and then filled again with set(); set() alone does not make
+        the copies other instances hold stale.
+        """
+        cls._L1_KEY_PREFIXES.add(prefix)
+
+    @classmethod
+    def set_l1_ttl(cls, ttl, namespace=None):
+        """Sets how long items of a namespace are kept in L1 cache."""
+        cls._L1_TTL_SECS[cls._get_namespace(namespace)] = ttl
+
+    @classmethod
+    def _is_l1_key(cls, key):
+        if not CAN_USE_MEMCACHE_L1.value or not isinstance(key, basestring):
+            return False
+        for prefix in cls._L1_KEY_PREFIXES:
+            if key.startswith(prefix):
+                return True
+        return False
+
+    @classmethod
+    def _l1_cache_get(cls, key, namespace):
+        if cls._is_l1_key(key):
+            version = RequestScopedMemcacheL1Versions.instance().get(namespace)
+            is_cached, entry = ProcessScopedMemcacheL1.instance().get(
+                key, namespace, version)
+            if is_cached:
+                CACHE_HIT_L1.inc()
+                return True, entry
+            CACHE_MISS_L1.inc()
+        return False, None
+
+    @classmethod
+    def _l1_cache_put(cls, key, namespace, entry):
+        if entry is not None and cls._is_l1_key(key):
+            version = RequestScopedMemcacheL1Versions.instance().get(namespace)
+            ProcessScopedMemcacheL1.instance().put(
+                key, namespace, version, entry,
+                cls._L1_TTL_SECS.get(namespace, DEFAULT_L1_CACHE_TTL_SECS))
+
+    @classmethod
+    def _l1_cache_invalidate(cls, keys, namespace):
+        """Drops the keys here and makes the L1 namespace stale elsewhere."""
+        l1_keys = [key for key in keys if cls._is_l1_key(key)]
+        if not l1_keys:
+            return
+        RequestScopedMemcacheL1Versions.instance().incr(namespace)
+        for key in l1_keys:
+            ProcessScopedMemcacheL1.instance().delete(key, namespace)
 
     @classmethod
     def get_namespace(cls):
@@ -239,15 +459,29 @@ class MemcacheManager(object):
         return cls.get_namespace()
 
     @classmethod
-    def get(cls, key, namespace=None):
-        """Gets an item from memcache if memcache is enabled."""
+    def get(cls, key, namespace=None, mutable=False):
+        """Gets an item from memcache if memcache is enabled.
+
+        Args:
+            key: string. The memcache key.
+            namespace: string. The memcache namespace; defaults to current.
+            mutable: bool. If True, the caller gets a private copy it can
+                change; otherwise the item may be a shared, read-only value.
+        Returns:
+            The item or None if not found.
+        """
         if not CAN_USE_MEMCACHE.value:
             return None
         _namespace = cls._get_namespace(namespace)
 
-        is_cached, value = cls._local_cache_get(key, _namespace)
+        is_cached, entry = cls._local_cache_get(key, _namespace)
         if is_cached:
-            return copy.deepcopy(value)
+            return cls._externalize(entry, mutable)
+
+        is_cached, entry = cls._l1_cache_get(key, _namespace)
+        if is_cached:
+            cls._local_cache_put(key, _namespace, entry)
+            return cls._externalize(entry, mutable)
 
         value = memcache.get(key, namespace=_namespace)
 
@@ -259,38 +493,51 @@ class MemcacheManager(object):
         else:
             CACHE_MISS.inc(context=key)
 
-        cls._local_cache_put(key, _namespace, value)
-        return copy.deepcopy(value)
+        return cls._retain(key, _namespace, value, mutable)
 
     @classmethod
-    def get_multi(cls, keys, namespace=None):
-        """Gets a set of items from memcache if memcache is enabled."""
+    def get_multi(cls, keys, namespace=None, mutable=False):
+        """Gets a set of items from memcache if memcache is enabled.
+
+        Items are returned as by get(); items not found are omitted.
+        """
         if not CAN_USE_MEMCACHE.value:
             return {}
 
         _namespace = cls._get_namespace(namespace)
 
-        is_cached, values = cls._local_cache_get_multi(keys, _namespace)
+        is_cached, entries = cls._local_cache_get_multi(keys, _namespace)
         if is_cached:
+            values = {}
+            for key, entry in entries.iteritems():
+                if entry is not None:
+                    values[key] = cls._externalize(entry, mutable)
             return values
 
-        values = memcache.get_multi(keys, namespace=_namespace)
-        for key, value in values.items():
-            if value is not None:
-                CACHE_HIT.inc()
+        values = {}
+        missing_keys = []
+        for key in keys:
+            is_cached, entry = cls._l1_cache_get(key, _namespace)
+            if is_cached:
+                cls._local_cache_put(key, _namespace, entry)
+                values[key] = cls._externalize(entry, mutable)
             else:
-                logging.info('Cache miss, key: %s. %s', key, Exception())
-                CACHE_MISS.inc(context=key)
+                missing_keys.append(key)
 
-        cls._local_cache_put_multi(values, _namespace)
+        if missing_keys:
+            found = memcache.get_multi(missing_keys, namespace=_namespace)
+            for key, value in found.items():
+                if value is not None:
+                    CACHE_HIT.inc()
+                else:
+                    logging.info('Cache miss, key: %s. %s', key, Exception())
+                    CACHE_MISS.inc(context=key)
+                values[key] = cls._retain(key, _namespace, value, mutable)
         return values
 
     @classmethod
     def set(cls, key, value, ttl=DEFAULT_CACHE_TTL_SECS, namespace=None):
         """Sets an item in memcache if memcache is enabled."""
-        # Ensure subsequent mods to value do not affect the cached copy.
-        value = copy.deepcopy(value)
-
         try:
             if CAN_USE_MEMCACHE.value:
                 size = sys.getsizeof(value)
@@ -300,7 +547,11 @@ class MemcacheManager(object):
                     CACHE_PUT.inc()
                     _namespace = cls._get_namespace(namespace)
                     memcache.set(key, value, ttl, namespace=_namespace)
-                    cls._local_cache_put(key, _namespace, value)
+
+                    # The cached copy is made here, so subsequent mods to
+                    # value do not affect it. It replaces any L1 copy of
+                    # this instance; see add_l1_key_prefix().
+                    cls._retain(key, _namespace, value, True)
         except:  # pylint: disable=bare-except
             logging.exception(
                 'Failed to set: %s, %s', key, cls._get_namespace(namespace))
@@ -322,7 +573,8 @@ class MemcacheManager(object):
                     CACHE_PUT.inc()
                     _namespace = cls._get_namespace(namespace)
                     memcache.set_multi(mapping, time=ttl, namespace=_namespace)
-                    cls._local_cache_put_multi(mapping, _namespace)
+                    for key, value in mapping.items():
+                        cls._retain(key, _namespace, value, True)
         except:  # pylint: disable=bare-except
             logging.exception(
                 'Failed to set_multi: %s, %s',
@@ -335,7 +587,9 @@ class MemcacheManager(object):
         assert not cls._IS_READONLY
         if CAN_USE_MEMCACHE.value:
             CACHE_DELETE.inc()
-            memcache.delete(key, namespace=cls._get_namespace(namespace))
+            _namespace = cls._get_namespace(namespace)
+            memcache.delete(key, namespace=_namespace)
+            cls._l1_cache_invalidate([key], _namespace)
 
     @classmethod
     def delete_multi(cls, key_list, namespace=None):
@@ -343,16 +597,17 @@ class MemcacheManager(object):
         assert not cls._IS_READONLY
         if CAN_USE_MEMCACHE.value:
             CACHE_DELETE.inc(increment=len(key_list))
-            memcache.delete_multi(
-                key_list, namespace=cls._get_namespace(namespace))
+            _namespace = cls._get_namespace(namespace)
+            memcache.delete_multi(key_list, namespace=_namespace)
+            cls._l1_cache_invalidate(key_list, _namespace)
 
     @classmethod
     def incr(cls, key, delta, namespace=None):
         """Incr an item in memcache if memcache is enabled."""
         if CAN_USE_MEMCACHE.value:
-            memcache.incr(
-                key, delta,
-                namespace=cls._get_namespace(namespace), initial_value=0)
+            _namespace = cls._get_namespace(namespace)
+            memcache.incr(key, delta, namespace=_namespace, initial_value=0)
+            cls._l1_cache_invalidate([key], _namespace)
 
 
 CAN_AGGREGATE_COUNTERS = config.ConfigProperty(
@@ -1702,11 +1957,51 @@ class StudentPropertyEntity(BaseEntity):
     # Each of the following is a string representation of a JSON dict.
     value = db.TextProperty()
 
+    # Attributes of the decoded view of value; see get_value_dict().
+    _VALUE_DICT_ATTRS = ('_value_dict', '_value_dict_source', '_value_dict_dirty')
+
     @classmethod
     def _memcache_key(cls, key):
         """Makes a memcache key from primary key."""
         return 'entity:student_property:%s' % key
 
+    def get_value_dict(self):
+        """Returns value decoded as a dict; it is parsed only once.
+
+        The dict may be changed in place; call mark_value_dict_changed() after
+        changing it and put() writes it back to value. Assigning value
+        directly discards the decoded dict and any unsaved changes to it.
+        """
+        value = self.value
+        if (getattr(self, '_value_dict', None) is None or
+            self._value_dict_source is not value):
+            value_dict = None
+            if value:
+                value_dict = transforms.loads(value)
+            self._value_dict = value_dict or {}
+            self._value_dict_source = value
+            self._value_dict_dirty = False
+        return self._value_dict
+
+    def mark_value_dict_changed(self):
+        self._value_dict_dirty = True
+
+    def _encode_value_dict(self):
+        """Serializes the decoded dict into value if it was changed."""
+        if (getattr(self, '_value_dict_dirty', False) and
+            self._value_dict_source is self.value):
+            self.value = transforms.dumps(self._value_dict)
+            self._value_dict_source = self.value
+            self._value_dict_dirty = False
+
+    def __getstate__(self):
+        # Only value itself is pickled, e.g., into memcache.
+        self._encode_value_dict()
+        state = self.__dict__.copy()
+        for attr in self._VALUE_DICT_ATTRS:
+            state.pop(attr, None)
+        return state
+
     @classmethod
     def create_key(cls, student_id, property_name):
         return '%s-%s' % (student_id, property_name)
@@ -1725,6 +2020,7 @@ class StudentPropertyEntity(BaseEntity):
 
     def put(self):
         """Do the normal put() and also add the object to memcache."""
+        self._encode_value_dict()
         result = super(StudentPropertyEntity, self).put()
         MemcacheManager.set(self._memcache_key(self.key().name()), self)
         return result
@@ -1749,6 +2045,42 @@ class StudentPropertyEntity(BaseEntity):
                 MemcacheManager.set(cls._memcache_key(key), NO_OBJECT)
         return value
 
+    @classmethod
+    def get_multi(cls, students, property_name):
+        """Loads a student property for many students in a few batched RPCs.
+
+        Returns:
+            A dict of user_id to StudentPropertyEntity; students without the
+            property are omitted.
+        """
+        keys = [cls.create_key(student.user_id, property_name)
+                for student in students]
+        cached = MemcacheManager.get_multi(
+            [cls._memcache_key(key) for key in keys])
+
+        result = {}
+        missing = []
+        for student, key in zip(students, keys):
+            value = cached.get(cls._memcache_key(key))
+            if value is None:
+                missing.append((student, key))
+            elif NO_OBJECT != value:
+                result[student.user_id] = value
+        if not missing:
+            return result
+
+        to_cache = {}
+        values = get(
+            [db.Key.from_path(cls.kind(), key) for _, key in missing])
+        for (student, key), value in zip(missing, values):
+            if value:
+                result[student.user_id] = value
+                to_cache[cls._memcache_key(key)] = value
+            else:
+                to_cache[cls._memcache_key(key)] = NO_OBJECT
+        MemcacheManager.set_multi(to_cache)
+        return result
+
 
 class BaseJsonDao(object):
     """Base DAO class for entities storing their data in a single JSON blob."""
@@ -1991,6 +2323,10 @@ class BaseJsonDao(object):
         return cls.DTO(None, copy.deepcopy(dto.dict))
 
 
+# The get_all_mapped() results, e.g., all labels, are read on most pages.
+MemcacheManager.add_l1_key_prefix('(entity-get-all:')
+
+
 class LastModfiedJsonDao(BaseJsonDao):
     """Base DAO that updates the last_modified field of entities on every save.
 
@@ -2397,6 +2733,39 @@ class QuestionGroupDAO(LastModfiedJsonDao):
                 'Non-unique question group description: %s' % description)
 
 
+class CourseContentVersion(object):
+    """A per-namespace number that changes whenever course content is saved.
+
+    Values derived from a walk over the whole course, e.g., the question
+    tables used by analytics, are cached in memcache under keys that include
+    this version. Saving the course, a question or a question group drops the
+    version, so the next reader starts a new one and rebuilds those values.
+    """
+
+    MEMCACHE_KEY = 'course:content-version'
+
+    @classmethod
+    def get(cls, namespace=None):
+        version = MemcacheManager.get(cls.MEMCACHE_KEY, namespace=namespace)
+        if version is None:
+            version = int(time.time() * 1000)
+            MemcacheManager.set(
+                cls.MEMCACHE_KEY, version, ttl=0, namespace=namespace)
+        return version
+
+    @classmethod
+    def invalidate(cls, namespace=None):
+        MemcacheManager.delete(cls.MEMCACHE_KEY, namespace=namespace)
+
+
+def _invalidate_course_content_version(unused_dtos):
+    CourseContentVersion.invalidate()
+
+
+QuestionDAO.POST_SAVE_HOOKS.append(_invalidate_course_content_version)
+QuestionGroupDAO.POST_SAVE_HOOKS.append(_invalidate_course_content_version)
+
+
 class LabelEntity(BaseEntity):
     """A class representing labels that can be applied to Student, Unit, etc."""
     data = db.TextProperty(indexed=False)
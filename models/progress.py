@@ -19,11 +19,14 @@ __author__ = 'Sean Lip (sll@google.com)'
 import datetime
 import logging
 import os
+import threading
 from collections import defaultdict
 
 import transforms
 
 from common import utils
+from models import CourseContentVersion
+from models import MemcacheManager
 from models import QuestionDAO
 from models import QuestionGroupDAO
 from models import StudentPropertyEntity
@@ -38,11 +41,94 @@ TRACKABLE_COMPONENTS = [
 ]
 
 
+class ProgressTransaction(object):
+    """Records several progress events of one student with a single put().
+
+    Returned by UnitLessonCompletionTracker.progress_transaction() and used
+    as a context manager. While the block runs, the tracker applies each
+    event and its derived events to one in-memory progress entity and calls
+    POST_UPDATE_PROGRESS_HOOK as usual; the entity is put once on leaving the
+    block, even if it raised, just as the events recorded before an error
+    would have been stored one by one. Progress read through the tracker's
+    get_*_progress() methods inside the block does not include pending
+    events. Transactions for the same student do not nest; an inner one
+    leaves the put to the outer one.
+    """
+
+    def __init__(self, tracker, student):
+        self._tracker = tracker
+        self._student = student
+        self._is_outermost = False
+        self.progress = None
+        self.is_dirty = False
+
+    def __enter__(self):
+        # pylint: disable=protected-access
+        if (not self._student.is_transient and
+            self._student.user_id not in self._tracker._transactions):
+            self._is_outermost = True
+            self._tracker._transactions[self._student.user_id] = self
+        return self
+
+    def __exit__(self, *unused_exc_info):
+        if not self._is_outermost:
+            return
+        # pylint: disable=protected-access
+        del self._tracker._transactions[self._student.user_id]
+        if self.is_dirty:
+            self.progress.put()
+
+
+class CompletionMatrix(object):
+    """Unit and lesson completion of many students in one course.
+
+    Built by UnitLessonCompletionTracker.get_completion_matrix(). Columns
+    follow the course structure and rows follow the students passed in:
+    - unit_ids: ids of the assessments and units, in course order.
+    - lesson_columns: (unit_id, lesson_id, has_activity) of every lesson of
+      every unit of type UNIT.
+    - unit_percent[row][col]: completion of unit_ids[col] in [0.0, 1.0], as
+      computed by get_unit_percent_complete().
+    - lesson_html[row][col] and lesson_activity[row][col]: the html and
+      activity states of lesson_columns[col], as in get_lesson_progress().
+    Transient students get rows of zeros.
+    """
+
+    def __init__(self, unit_ids, lesson_columns, lesson_columns_by_unit):
+        self.unit_ids = unit_ids
+        self.lesson_columns = lesson_columns
+        self._lesson_columns_by_unit = lesson_columns_by_unit
+        self.unit_percent = []
+        self.lesson_html = []
+        self.lesson_activity = []
+
+    def get_unit_percent_complete(self, row):
+        """Returns the row as get_unit_percent_complete() would."""
+        return dict(zip(self.unit_ids, self.unit_percent[row]))
+
+    def get_lesson_progress(self, row, unit_id):
+        """Returns the row's lessons of a unit as get_lesson_progress() would."""
+        result = {}
+        for col in self._lesson_columns_by_unit.get(str(unit_id), []):
+            unused_unit_id, lesson_id, has_activity = self.lesson_columns[col]
+            result[lesson_id] = {
+                'html': self.lesson_html[row][col],
+                'activity': self.lesson_activity[row][col],
+                'has_activity': has_activity,
+            }
+        return result
+
+
 class UnitLessonCompletionTracker(object):
     """Tracks student completion for a unit/lesson-based linear course."""
 
     PROPERTY_KEY = 'linear-course-completion'
 
+    # Course-wide question tables are cached in memcache for this long under
+    # the course content version, so a course save makes them be rebuilt.
+    MATERIALIZED_MEMCACHE_KEY = 'progress:%s:%s'
+    MATERIALIZED_TTL_SECS = 60 * 60
+
     # Here are representative examples of the keys for the various entities
     # used in this class:
     #   Unit 1: u.1
@@ -105,10 +191,52 @@ class UnitLessonCompletionTracker(object):
 
     def __init__(self, course):
         self._course = course
+        self._local = threading.local()
+
+    @property
+    def _transactions(self):
+        # Courses, and so their trackers, may be shared by concurrent requests.
+        if not hasattr(self._local, 'transactions'):
+            self._local.transactions = {}
+        return self._local.transactions
 
     def _get_course(self):
         return self._course
 
+    def progress_transaction(self, student):
+        """Returns a context manager that batches the student's progress puts.
+
+        For example, when a page records several events:
+
+            with tracker.progress_transaction(student):
+                tracker.put_html_accessed(student, unit_id, lesson_id)
+                tracker.put_component_completed(
+                    student, unit_id, lesson_id, cpt_id)
+        """
+        return ProgressTransaction(self, student)
+
+    def _get_progress_for_update(self, student):
+        """Returns the progress entity the student's next event applies to."""
+        transaction = self._transactions.get(student.user_id)
+        if not transaction:
+            return self.get_or_create_progress(student)
+        if transaction.progress is None:
+            transaction.progress = StudentPropertyEntity.get(
+                student, self.PROPERTY_KEY)
+            if not transaction.progress:
+                transaction.progress = StudentPropertyEntity.create(
+                    student=student, property_name=self.PROPERTY_KEY)
+        return transaction.progress
+
+    def _put_progress(self, student, progress):
+        """Puts updated progress now, or when the open transaction ends."""
+        progress.updated_on = datetime.datetime.now()
+        transaction = self._transactions.get(student.user_id)
+        if transaction:
+            transaction.is_dirty = True
+        else:
+            progress.put()
+
     def get_activity_as_python(self, unit_id, lesson_id):
         """Gets the corresponding activity as a Python object."""
         root_name = 'activity'
@@ -188,6 +316,22 @@ class UnitLessonCompletionTracker(object):
         return self.get_entity_type_from_key(
             progress_entity_key) in self.COMPOSITE_ENTITIES
 
+    def _get_materialized(self, name, build):
+        """Returns build() as cached for the current course content version.
+
+        Callers get their own copy, which they may change.
+        """
+        namespace = self._get_course().app_context.get_namespace_name()
+        key = self.MATERIALIZED_MEMCACHE_KEY % (
+            name, CourseContentVersion.get(namespace=namespace))
+        value = MemcacheManager.get(key, namespace=namespace, mutable=True)
+        if value is None:
+            value = build()
+            MemcacheManager.set(
+                key, value, ttl=self.MATERIALIZED_TTL_SECS,
+                namespace=namespace)
+        return value
+
     def get_valid_component_ids(self, unit_id, lesson_id):
         """Returns a list of cpt ids representing trackable components."""
         components = []
@@ -243,10 +387,16 @@ class UnitLessonCompletionTracker(object):
             - score: int. Aggregated value of the scores.
             - label: str. Human readable identifier for this question.
         """
+        return self._get_materialized(
+            'id-to-questions', self._build_id_to_questions_dict)
+
+    def _build_id_to_questions_dict(self):
         id_to_questions = {}
         for unit in self._get_course().get_units_of_type(verify.UNIT_TYPE_UNIT):
             unit_id = unit.unit_id
-            for lesson in self._get_course().get_lessons(unit_id):
+            lessons = self._get_course().get_lessons(unit_id)
+            self._get_course().prefetch_content_files(lessons=lessons)
+            for lesson in lessons:
                 lesson_id = lesson.lesson_id
                 # Add mapping dicts for questions in old-style activities.
                 if lesson.activity:
@@ -305,7 +455,15 @@ class UnitLessonCompletionTracker(object):
             - score: int. Aggregated value of the scores.
             - label: str. Human readable identifier for this question.
         """
+        return self._get_materialized(
+            'id-to-assessments', self._build_id_to_assessments_dict)
+
+    def _build_id_to_assessments_dict(self):
         id_to_assessments = {}
+        self._get_course().prefetch_content_files(units=[
+            assessment
+            for assessment in self._get_course().get_assessment_list()
+            if not self._get_course().needs_human_grader(assessment)])
         for assessment in self._get_course().get_assessment_list():
             if not self._get_course().needs_human_grader(assessment):
                 assessment_components = self._get_course(
@@ -662,13 +820,12 @@ class UnitLessonCompletionTracker(object):
         """Update custom unit."""
         if student.is_transient:
             return
-        progress = self.get_or_create_progress(student)
+        progress = self._get_progress_for_update(student)
         current_state = self._get_entity_value(progress, event_key)
         if current_state == state or current_state == self.COMPLETED_STATE:
             return
         self._set_entity_value(progress, event_key, state)
-        progress.updated_on = datetime.datetime.now()
-        progress.put()
+        self._put_progress(student, progress)
 
     UPDATER_MAPPING = {
         'activity': _update_activity,
@@ -825,13 +982,12 @@ class UnitLessonCompletionTracker(object):
         if student.is_transient or event_entity not in self.EVENT_CODE_MAPPING:
             return
 
-        progress = self.get_or_create_progress(student)
+        progress = self._get_progress_for_update(student)
 
         self._update_event(
             student, progress, event_entity, event_key, direct_update=True)
 
-        progress.updated_on = datetime.datetime.now()
-        progress.put()
+        self._put_progress(student, progress)
 
     def _update_event(self, student, progress, event_entity, event_key,
                       direct_update=False):
@@ -935,7 +1091,8 @@ class UnitLessonCompletionTracker(object):
         
         if student:
 #            logging.warning('***RAM*** get_component_status DATASTORE OP ' + str(cpt_id) + ' = ' + str(attempts) + ',' + str(score))
-            student_answers = StudentAnswersEntity.get_answers_dict_for_student(student)
+            student_answers = StudentAnswersEntity.get_unit_answers_for_request(
+                student, unit_id)
         if student_answers:
 #            logging.warning('***RAM*** cpt_id ' + str(cpt_id) + ' ' + str(lesson_id) + ' ' + str(unit_id))
 #            logging.warning('***RAM*** answers ' + str(student_answers))
@@ -984,6 +1141,20 @@ class UnitLessonCompletionTracker(object):
             progress.put()
         return progress
 
+    @classmethod
+    def get_progress_multi(cls, students):
+        """Returns a dict of user_id to progress for many students at once.
+
+        Unlike get_or_create_progress(), nothing is stored: students without
+        progress get an empty, unsaved entity.
+        """
+        progress = StudentPropertyEntity.get_multi(students, cls.PROPERTY_KEY)
+        for student in students:
+            if student.user_id not in progress:
+                progress[student.user_id] = StudentPropertyEntity.create(
+                    student=student, property_name=cls.PROPERTY_KEY)
+        return progress
+
     def get_course_progress(self, student):
         """Return [NOT_STARTED|IN_PROGRESS|COMPLETED]_STATE for course."""
         progress = self.get_or_create_progress(student)
@@ -1012,17 +1183,19 @@ class UnitLessonCompletionTracker(object):
 
         return result
 
-    def get_unit_percent_complete(self, student):
+    def get_unit_percent_complete(self, student, progress=None):
         """Returns a dict with each unit's completion in [0.0, 1.0]."""
         if student.is_transient:
             return {}
 
+        if progress is None:
+            progress = self.get_or_create_progress(student)
         course = self._get_course()
         units = course.get_units()
-        assessment_scores = {int(s['id']): s['score'] / 100.0
-                             for s in course.get_all_scores(student)}
+        assessment_scores = {
+            int(s['id']): s['score'] / 100.0
+            for s in course.get_all_scores(student, student_progress=progress)}
         result = {}
-        progress = self.get_or_create_progress(student)
         for unit in units:
             # Assessments are scored as themselves.
             if unit.type == verify.UNIT_TYPE_ASSESSMENT:
@@ -1077,6 +1250,94 @@ class UnitLessonCompletionTracker(object):
 #        logging.warning('***RAM*** get_unit_progress lesson ' + str(result))
         return result
 
+    def get_completion_matrix(self, students, progress_by_user_id=None):
+        """Computes the progress of many students in one pass.
+
+        This gives the same numbers as calling get_unit_percent_complete()
+        and get_lesson_progress() for each student, but looks the course
+        structure up and builds the progress keys only once.
+
+        Args:
+            students: the students, one per row of the result.
+            progress_by_user_id: the students' progress entities, as returned
+                by get_progress_multi(), if the caller has already loaded them.
+
+        Returns:
+            A CompletionMatrix.
+        """
+        if progress_by_user_id is None:
+            progress_by_user_id = self.get_progress_multi(
+                [student for student in students if not student.is_transient])
+
+        # Columns: one plan per unit, and html/activity keys per lesson.
+        course = self._get_course()
+        unit_ids = []
+        unit_plans = []
+        lesson_columns = []
+        lesson_columns_by_unit = {}
+        html_keys = []
+        activity_keys = []
+        for unit in course.get_units():
+            if unit.type == verify.UNIT_TYPE_ASSESSMENT:
+                unit_ids.append(unit.unit_id)
+                unit_plans.append((str(unit.unit_id), None, None))
+            elif unit.type == verify.UNIT_TYPE_UNIT:
+                first = len(lesson_columns)
+                for lesson in course.get_lessons(unit.unit_id):
+                    lesson_columns.append(
+                        (unit.unit_id, lesson.lesson_id, lesson.has_activity))
+                    html_keys.append(
+                        self._get_html_key(unit.unit_id, lesson.lesson_id))
+                    activity_keys.append(self._get_activity_key(
+                        unit.unit_id, lesson.lesson_id))
+                columns = range(first, len(lesson_columns))
+                lesson_columns_by_unit[str(unit.unit_id)] = columns
+                pre_assessment = (
+                    str(unit.pre_assessment) if unit.pre_assessment else None)
+                unit_ids.append(unit.unit_id)
+                unit_plans.append((None, pre_assessment, columns))
+        has_activity = [column[2] for column in lesson_columns]
+
+        matrix = CompletionMatrix(
+            unit_ids, lesson_columns, lesson_columns_by_unit)
+        for student in students:
+            progress = None
+            if not student.is_transient:
+                progress = progress_by_user_id.get(student.user_id)
+            values = progress.get_value_dict() if progress else {}
+            scores = transforms.loads(student.scores) if (
+                not student.is_transient and student.scores) else {}
+
+            html = [values.get(key) or 0 for key in html_keys]
+            activity = [values.get(key) or 0 for key in activity_keys]
+            completed = [
+                html_state == self.COMPLETED_STATE and (
+                    not needs_activity or
+                    activity_state == self.COMPLETED_STATE)
+                for html_state, activity_state, needs_activity in zip(
+                    html, activity, has_activity)]
+
+            percent = []
+            for assessment_id, pre_assessment, columns in unit_plans:
+                if assessment_id:
+                    # Assessments are scored as themselves.
+                    percent.append(scores.get(assessment_id, 0) / 100.0)
+                elif (pre_assessment and
+                      scores.get(pre_assessment, 0) / 100.0 >= 1.0):
+                    # Use pre-assessment iff it exists and student scored 100%
+                    percent.append(1.0)
+                elif not columns:
+                    percent.append(0.0)
+                else:
+                    num_completed = sum(1 for col in columns if completed[col])
+                    percent.append(
+                        round(num_completed / float(len(columns)), 3))
+
+            matrix.unit_percent.append(percent)
+            matrix.lesson_html.append(html)
+            matrix.lesson_activity.append(activity)
+        return matrix
+
     def get_component_progress(self, student, unit_id, lesson_id, cpt_id):
         """Returns the progress status of the given component."""
         if student.is_transient:
@@ -1089,9 +1350,7 @@ class UnitLessonCompletionTracker(object):
 #             progress, unit_id, lesson_id, cpt_id, student) or 0
 
     def _get_entity_value(self, progress, event_key):
-        if not progress.value:
-            return None
-        return transforms.loads(progress.value).get(event_key)
+        return progress.get_value_dict().get(event_key)
 
     def _set_entity_value(self, student_property, key, value):
         """Sets the integer value of a student property.
@@ -1105,13 +1364,8 @@ class UnitLessonCompletionTracker(object):
           value: the value to increment this property by
         """
 #        logging.warning('***RAM*** set value ' + str(key) + ' =  ' + str(value))
-        try:
-            progress_dict = transforms.loads(student_property.value)
-        except (AttributeError, TypeError):
-            progress_dict = {}
-
-        progress_dict[key] = value
-        student_property.value = transforms.dumps(progress_dict)
+        student_property.get_value_dict()[key] = value
+        student_property.mark_value_dict_changed()
 
     def _inc(self, student_property, key, value=1):
         """Increments the integer value of a student property.
@@ -1124,16 +1378,12 @@ class UnitLessonCompletionTracker(object):
           key: the student property whose value should be incremented
           value: the value to increment this property by
         """
-        try:
-            progress_dict = transforms.loads(student_property.value)
-        except (AttributeError, TypeError):
-            progress_dict = {}
-
+        progress_dict = student_property.get_value_dict()
         if key not in progress_dict:
             progress_dict[key] = 0
 
         progress_dict[key] += value
-        student_property.value = transforms.dumps(progress_dict)
+        student_property.mark_value_dict_changed()
 
     @classmethod
     def get_elements_from_key(cls, key):
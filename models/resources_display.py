@@ -373,7 +373,7 @@ class ResourceCourseSettings(resource.AbstractResourceHandler):
         schema = cls.get_schema(course, key)
         json_entity = {}
         schema.convert_entity_to_json_entity(
-            course.get_environ(course.app_context), json_entity)
+            course.get_environ(course.app_context, mutable=False), json_entity)
         return json_entity[key]
 
     @classmethod
@@ -18,12 +18,14 @@ __author__ = 'Pavel Simakov (psimakov@google.com)'
 
 import datetime
 import os
+import random
 import re
 import sys
 import threading
 import unittest
 
 from config import ConfigProperty
+from config import ValidateIntegerRange
 from counters import PerfCounter
 from entities import BaseEntity
 from entities import put as entities_put
@@ -43,9 +45,20 @@ MAX_GLOBAL_CACHE_SIZE_BYTES = 16 * 1024 * 1024
 # max size of each item; no point in storing images for example
 MAX_GLOBAL_CACHE_ITEM_SIZE_BYTES = 256 * 1024
 
+# max size of all items of one namespace; no course may push out all others.
+# A course that is the only one cached may use the whole cache.
+MAX_GLOBAL_CACHE_NAMESPACE_SIZE_BYTES = MAX_GLOBAL_CACHE_SIZE_BYTES / 2
+
 # The maximum number of bytes stored per VFS cache shard.
 _MAX_VFS_SHARD_SIZE = 1000 * 1000
 
+# Number of file names read per datastore batch when listing a directory.
+_LIST_BATCH_SIZE = 1000
+
+# Max number of files whose metadata is put in one cross-group transaction;
+# the log of their changes needs one more entity group.
+_MAX_FILES_PER_TRANSACTION = 20
+
 # Max number of shards for a single VFS cached file.
 _MAX_VFS_NUM_SHARDS = 4
 
@@ -55,6 +68,16 @@ CAN_USE_VFS_IN_PROCESS_CACHE = ConfigProperty(
     messages.SITE_SETTINGS_CACHE_CONTENT, default_value=True,
     label='Cache Content')
 
+# Files larger than this are read in shards as they are served, not cached.
+MAX_CACHED_FILE_SIZE_BYTES = ConfigProperty(
+    'gcb_vfs_max_cached_file_size_bytes', int,
+    messages.SITE_SETTINGS_MAX_CACHED_CONTENT_SIZE,
+    default_value=MAX_GLOBAL_CACHE_ITEM_SIZE_BYTES,
+    label='Max Cached Content Size',
+    validator=ValidateIntegerRange(
+        lower_bound_inclusive=0,
+        upper_bound_inclusive=MAX_GLOBAL_CACHE_ITEM_SIZE_BYTES).validate)
+
 
 class AbstractFileSystem(object):
     """A generic file system interface that forwards to an implementation."""
@@ -103,6 +126,14 @@ class AbstractFileSystem(object):
         """Returns a stream with the file content, similar to open(...)."""
         return self._impl.get(filename)
 
+    def open_multi(self, filenames):
+        """Returns a dict of {filename: stream}; stream is None if missing."""
+        return self._impl.open_multi(filenames)
+
+    def prefetch(self, filenames):
+        """Reads files ahead of use, so later open(...) calls are cheap."""
+        self._impl.prefetch(filenames)
+
     def get(self, filename):
         """Returns bytes with the file content, but no metadata."""
         return self.open(filename).read()
@@ -180,6 +211,13 @@ class LocalReadOnlyFileSystem(object):
             return None
         return open(self._logical_to_physical(filename), 'rb')
 
+    def open_multi(self, filenames):
+        return {filename: self.get(filename) for filename in filenames}
+
+    def prefetch(self, unused_filenames):
+        """Local files are cheap to open one by one; nothing to do."""
+        pass
+
     def put(self, unused_filename, unused_stream):
         raise Exception('Not implemented.')
 
@@ -233,12 +271,106 @@ class FileDataEntity(BaseEntity):
     data = db.BlobProperty()
 
 
+class FileChangeLogEntity(BaseEntity):
+    """A shard of the change log of all files in a namespace.
+
+    Its generation grows by one with every batch of file changes recorded in
+    this shard. Each changed file has a FileChangeEntity child that records
+    the generation of its last change, so that all files changed since a given
+    generation can be found with one strongly consistent ancestor query.
+
+    Writes pick a shard at random, so that concurrent writes to files of one
+    namespace rarely contend for the same entity group.
+    """
+    KEY_NAME = 'vfs'
+
+    generation = db.IntegerProperty(indexed=False, default=0)
+
+
+class FileChangeEntity(BaseEntity):
+    """The last change of a file; absolute file name is a key.
+
+    Deleted files keep their record as a tombstone, so that other instances
+    learn about the deletion.
+    """
+    generation = db.IntegerProperty(indexed=True)
+    is_deleted = db.BooleanProperty(indexed=False)
+
+
+class FileChangeLog(object):
+    """Records file changes of a namespace and reads them back.
+
+    The state of the log is a tuple with the generation of each shard; it is
+    read with one batch get.
+    """
+
+    NUM_SHARDS = 10
+
+    @classmethod
+    def _make_key(cls, namespace, shard):
+        return db.Key.from_path(
+            FileChangeLogEntity.kind(),
+            '%s:%s' % (FileChangeLogEntity.KEY_NAME, shard),
+            namespace=namespace)
+
+    @classmethod
+    def get_generations(cls, namespace):
+        """Returns a tuple with the latest generation of each shard."""
+        logs = FileChangeLogEntity.get([
+            cls._make_key(namespace, shard)
+            for shard in xrange(cls.NUM_SHARDS)])
+        return tuple(log.generation if log else 0 for log in logs)
+
+    @classmethod
+    @db.transactional(propagation=db.ALLOWED)
+    def record(cls, namespace, filenames, is_deleted=False):
+        """Records changes of files; joins the current transaction, if any.
+
+        The log shard is one more entity group in the caller's transaction,
+        so the changes are logged if and only if the files are written.
+        """
+        key = cls._make_key(namespace, random.randrange(cls.NUM_SHARDS))
+        log = FileChangeLogEntity.get(key)
+        if not log:
+            log = FileChangeLogEntity(key=key)
+        log.generation += 1
+        changes = [
+            FileChangeEntity(
+                parent=key, key_name=filename, generation=log.generation,
+                is_deleted=is_deleted)
+            for filename in filenames]
+        entities_put([log] + changes)
+
+    @classmethod
+    def get_changes_since(cls, namespace, since, until):
+        """Returns {filename: FileChangeEntity} changed after since.
+
+        Args:
+            namespace: the namespace of the files
+            since: a tuple of generations, as returned by get_generations()
+            until: a later tuple of generations; only shards that changed
+                between since and until are queried
+        """
+        changes = {}
+        for shard in xrange(cls.NUM_SHARDS):
+            if until[shard] == since[shard]:
+                continue
+            query = FileChangeEntity.all(namespace=namespace).ancestor(
+                cls._make_key(namespace, shard)).filter(
+                    'generation >', since[shard])
+            for change in caching.iter_all(query):
+                changes[change.key().name()] = change
+        return changes
+
+
 class FileStreamWrapped(object):
     """A class that wraps a file stream, but adds extra attributes to it."""
 
     def __init__(self, metadata, data):
         self._metadata = metadata
+        self._content = data
         self._data = data
+        self._size = len(data)
 
     def read(self):
         """Emulates stream.read(). Returns all bytes and emulates EOF."""
@@ -250,6 +382,64 @@ class FileStreamWrapped(object):
     def metadata(self):
         return self._metadata
 
+    @property
+    def size(self):
+        return self._size
+
+    def iter_chunks(self, start=0, stop=None):
+        """Yields the bytes in [start, stop) without consuming the stream."""
+        yield self._content[start:stop]
+
+
+class FileStreamChunked(object):
+    """A stream of a file too large to cache; its shards are read lazily.
+
+    read() returns the whole file once and then emulates EOF, as other
+    streams do; iter_chunks() reads only the shards that overlap the
+    requested range, one at a time.
+    """
+
+    def __init__(self, namespace, metadata, key_names):
+        self._namespace = namespace
+        self._metadata = metadata
+        self._key_names = key_names
+        self._is_read = False
+
+    @property
+    def metadata(self):
+        return self._metadata
+
+    @property
+    def size(self):
+        return self._metadata.size
+
+    def _get_shards(self, key_names):
+        keys = [
+            db.Key.from_path(
+                FileDataEntity.kind(), key_name, namespace=self._namespace)
+            for key_name in key_names]
+        return [shard.data for shard in FileDataEntity.get(keys)]
+
+    def read(self):
+        """Emulates stream.read(). Returns all bytes and emulates EOF."""
+        if self._is_read:
+            return ''
+        self._is_read = True
+        return ''.join(self._get_shards(self._key_names))
+
+    def iter_chunks(self, start=0, stop=None):
+        """Yields the bytes in [start, stop), reading one shard at a time."""
+        if stop is None:
+            stop = self.size
+        for index, key_name in enumerate(self._key_names):
+            shard_start = index * _MAX_VFS_SHARD_SIZE
+            if shard_start >= stop:
+                break
+            if shard_start + _MAX_VFS_SHARD_SIZE <= start:
+                continue
+            data = self._get_shards([key_name])[0]
+            yield data[max(start - shard_start, 0):stop - shard_start]
+
 
 class StringStream(object):
     """A wrapper to pose a string as a UTF-8 byte stream."""
@@ -316,16 +506,49 @@ class ProcessScopedVfsCache(caching.ProcessScopedSingleton):
     def __init__(self):
         self._cache = caching.LRUCache(
             max_size_bytes=MAX_GLOBAL_CACHE_SIZE_BYTES,
-            max_item_size_bytes=MAX_GLOBAL_CACHE_ITEM_SIZE_BYTES)
+            max_item_size_bytes=MAX_GLOBAL_CACHE_ITEM_SIZE_BYTES,
+            max_namespace_size_bytes=MAX_GLOBAL_CACHE_NAMESPACE_SIZE_BYTES,
+            name='models-VfsCacheConnection-cache')
         self._cache.get_entry_size = self._get_entry_size
+        self._cache.get_namespace = self._get_namespace
+        self._generations = {}
+        self._listings = {}
 
     def _get_entry_size(self, key, value):
-        return sys.getsizeof(key) + value.getsizeof() if value else 0
+        return sys.getsizeof(key) + (value.getsizeof() if value else 0)
+
+    def _get_namespace(self, key):
+        # Keys are made by VfsCacheConnection.make_key().
+        return key.split(':', 2)[1]
 
     @property
     def cache(self):
         return self._cache
 
+    def get_generations(self, namespace):
+        """Returns the change log generations the namespace was synced to."""
+        return self._generations.get(namespace)
+
+    def set_generations(self, namespace, generations):
+        self._generations[namespace] = generations
+
+    def get_listing(self, namespace, dir_name, generations):
+        """Returns the file names in a directory, if cached at generations."""
+        cached_generations, listings = self._listings.get(
+            namespace, (None, {}))
+        if cached_generations != generations:
+            return None
+        return listings.get(dir_name)
+
+    def set_listing(self, namespace, dir_name, generations, filenames):
+        """Caches directory contents read at the given change log state."""
+        cached_generations, listings = self._listings.get(
+            namespace, (None, {}))
+        if cached_generations != generations:
+            listings = {}
+            self._listings[namespace] = (generations, listings)
+        listings[dir_name] = filenames
+
 
 VFS_CACHE_LEN = PerfCounter(
     'gcb-models-VfsCacheConnection-cache-len',
@@ -369,11 +592,20 @@ class CacheFileEntry(caching.AbstractCacheEntry):
 
     @classmethod
     def externalize(cls, key, entry):
+        if entry.body is None:
+            VfsCacheConnection.CACHE_CHUNKED.inc()
+            return FileStreamChunked(
+                entry.metadata.key().namespace(), entry.metadata,
+                DatastoreBackedFileSystem._generate_file_key_names(
+                    key, entry.metadata.size))
         return FileStreamWrapped(entry.metadata, entry.body)
 
     @classmethod
     def internalize(cls, key, metadata, data):
-        if metadata and data:
+        # Files too large to cache keep only their metadata here, so opening
+        # them again does not read the metadata from the datastore.
+        if metadata and (
+                data or metadata.size > MAX_CACHED_FILE_SIZE_BYTES.value):
             return CacheFileEntry(key, metadata, data)
         return None
 
@@ -394,6 +626,16 @@ class VfsCacheConnection(caching.AbstractCacheConnection):
         cls.CACHE_INHERITED = PerfCounter(
             'gcb-models-VfsCacheConnection-cache-inherited',
             'A number of times an object was obtained from the inherited vfs.')
+        cls.CACHE_CHUNKED = PerfCounter(
+            'gcb-models-VfsCacheConnection-cache-chunked',
+            'A number of times a file too large to cache was opened for '
+            'reading in shards.')
+        cls.CACHE_LISTING_HIT = PerfCounter(
+            'gcb-models-VfsCacheConnection-cache-listing-hit',
+            'A number of times a directory listing was found in cache.')
+        cls.CACHE_LISTING_MISS = PerfCounter(
+            'gcb-models-VfsCacheConnection-cache-listing-miss',
+            'A number of times a directory listing was not found in cache.')
 
     @classmethod
     def is_enabled(cls):
@@ -403,6 +645,38 @@ class VfsCacheConnection(caching.AbstractCacheConnection):
         super(VfsCacheConnection, self).__init__(namespace)
         self.cache = ProcessScopedVfsCache.instance().cache
 
+    def _get_cached_keys(self):
+        prefix = self.make_key_prefix(self.namespace) + ':'
+        return [
+            key[len(prefix):] for key in self.cache.items.keys()
+            if key.startswith(prefix)]
+
+    def _get_incremental_updates(self):
+        """Gets files changed since this process last synced the namespace.
+
+        This costs one datastore get when nothing has changed. Every file in
+        the result has changed or was deleted, so its update is None, which
+        evicts it from the cache.
+
+        Returns:
+          a dict of {key: None} for files that changed since the last sync
+        """
+        vfs_cache = ProcessScopedVfsCache.instance()
+        synced = vfs_cache.get_generations(self.namespace)
+        generations = FileChangeLog.get_generations(self.namespace)
+        if synced is None or generations == synced:
+            changed = []
+        elif len(synced) != len(generations) or any(
+                current < old for current, old in zip(generations, synced)):
+            # The log was lost, e.g., the course was deleted; trust nothing.
+            changed = self._get_cached_keys()
+        else:
+            changed = FileChangeLog.get_changes_since(
+                self.namespace, synced, generations).keys()
+        vfs_cache.set_generations(self.namespace, generations)
+        self.CACHE_UPDATE_COUNT.inc(len(changed))
+        return dict.fromkeys(changed)
+
 
 VfsCacheConnection.init_counters()
 
@@ -553,32 +827,86 @@ class DatastoreBackedFileSystem(object):
 
     def open(self, afilename):
         """Gets a file from a datastore. Raw bytes stream, no encodings."""
-        filename = self._logical_to_physical(afilename)
-        found, stream = self.cache.get(filename)
-        if found and stream:
-            return stream
-        if not found:
-            metadata = FileMetadataEntity.get_by_key_name(filename)
-            if metadata:
-                keys = self._generate_file_key_names(filename, metadata.size)
-                data_shards = []
-                for data_entity in FileDataEntity.get_by_key_name(keys):
-                    data_shards.append(data_entity.data)
-                data = ''.join(data_shards)
-                # TODO: Note that this will ask the cache to accept
-                # potentially very large items.  The caching strategy both
-                # for in-memory and Memcache should be revisited to
-                # determine how best to address chunking strategies.
-                self.cache.put(filename, metadata, data)
-                return FileStreamWrapped(metadata, data)
-
-            # lets us cache the (None, None) so next time we asked for this key
-            # we fall right into the inherited section without trying to load
-            # the metadata/data from the datastore; if a new object with this
-            # key is added in the datastore, we will see it in the update list
-            VfsCacheConnection.CACHE_NO_METADATA.inc()
-            self.cache.put(filename, None, None)
+        return self.open_multi([afilename])[afilename]
 
+    def open_multi(self, afilenames):
+        """Gets several files from a datastore; see prefetch().
+
+        Args:
+            afilenames: A list of logical file names.
+
+        Returns:
+            A dict of {logical file name: stream}; the stream is None if the
+            file is not found here nor in the parent file system.
+        """
+        streams = self._load_multi(afilenames)
+        result = {}
+        for afilename in afilenames:
+            result[afilename] = (
+                streams.get(afilename) or self._open_inherited(afilename))
+        return result
+
+    def prefetch(self, afilenames):
+        """Reads files not yet in cache into cache.
+
+        All such files have their metadata read in one datastore get, and the
+        data of all that are small enough to cache in one more.
+
+        Args:
+            afilenames: A list of logical file names.
+        """
+        self._load_multi(afilenames)
+
+    def _load_multi(self, afilenames):
+        """Returns a dict of {logical file name: stream} of files found here."""
+        streams = {}
+        filenames = {}
+        for afilename in afilenames:
+            filename = self._logical_to_physical(afilename)
+            found, stream = self.cache.get(filename)
+            if not found:
+                filenames[afilename] = filename
+            elif stream:
+                streams[afilename] = stream
+        if not filenames:
+            return streams
+
+        to_read = []
+        afilenames_to_get = filenames.keys()
+        metadatas = FileMetadataEntity.get_by_key_name(
+            [filenames[afilename] for afilename in afilenames_to_get])
+        for afilename, metadata in zip(afilenames_to_get, metadatas):
+            filename = filenames[afilename]
+            if not metadata:
+                # lets us cache the (None, None) so next time we asked for
+                # this key we fall right into the inherited section without
+                # trying to load the metadata/data from the datastore; if a
+                # new object with this key is added in the datastore, we will
+                # see it in the update list
+                VfsCacheConnection.CACHE_NO_METADATA.inc()
+                self.cache.put(filename, None, None)
+                continue
+            keys = self._generate_file_key_names(filename, metadata.size)
+            if metadata.size > MAX_CACHED_FILE_SIZE_BYTES.value:
+                VfsCacheConnection.CACHE_CHUNKED.inc()
+                self.cache.put(filename, metadata, None)
+                streams[afilename] = FileStreamChunked(
+                    self._ns, metadata, keys)
+                continue
+            to_read.append((afilename, filename, metadata, keys))
+        if not to_read:
+            return streams
+
+        data_entities = iter(FileDataEntity.get_by_key_name(
+            [key for _, _, _, keys in to_read for key in keys]))
+        for afilename, filename, metadata, keys in to_read:
+            data = ''.join([data_entities.next().data for _ in keys])
+            self.cache.put(filename, metadata, data)
+            streams[afilename] = FileStreamWrapped(metadata, data)
+        return streams
+
+    def _open_inherited(self, afilename):
+        filename = self._logical_to_physical(afilename)
         result = None
         if self._inherits_from and self._can_inherit(filename):
             result = self._inherits_from.get(afilename)
@@ -669,16 +997,18 @@ class DatastoreBackedFileSystem(object):
             entities_put(shard_entities)
 
         metadata.put()
+        FileChangeLog.record(self._ns, [filename])
         self.cache.delete(filename)
 
     def put_multi_async(self, filedata_list):
         """Initiate an async put of the given files.
 
         This method initiates an asynchronous put of a list of file data
-        (presented as pairs of the form (filename, data_source)). It is not
-        transactional, and does not block, and instead immediately returns a
-        callback function. When this function is called it will block until
-        the puts are confirmed to have completed. For maximum efficiency it's
+        (presented as pairs of the form (filename, data_source)). It does not
+        block, and instead immediately returns a callback function. When this
+        function is called it will block until the data puts are confirmed to
+        have completed, and then put the metadata of the files and log their
+        changes, a few files per transaction. For maximum efficiency it's
         advisable to defer calling the callback until all other request handling
         has completed, but in any event, it MUST be called before the request
         handler can exit successfully.
@@ -693,13 +1023,11 @@ class DatastoreBackedFileSystem(object):
             be called at some point before the request handler exists, in order
             to confirm that the puts have succeeded.
         """
-        filename_list = []
         data_list = []
         metadata_list = []
 
         for filename, stream in filedata_list:
             filename = self._logical_to_physical(filename)
-            filename_list.append(filename)
 
             metadata = FileMetadataEntity.get_by_key_name(filename)
             if not metadata:
@@ -722,14 +1050,22 @@ class DatastoreBackedFileSystem(object):
             self.cache.delete(filename)
 
         data_future = db.put_async(data_list)
-        metadata_future = db.put_async(metadata_list)
 
         def wait_and_finalize():
             data_future.check_success()
-            metadata_future.check_success()
+            for index in xrange(
+                    0, len(metadata_list), _MAX_FILES_PER_TRANSACTION):
+                self._put_metadata_and_record_changes(
+                    metadata_list[index:index + _MAX_FILES_PER_TRANSACTION])
 
         return wait_and_finalize
 
+    @db.transactional(xg=True)
+    def _put_metadata_and_record_changes(self, metadata_list):
+        db.put(metadata_list)
+        FileChangeLog.record(
+            self._ns, [metadata.key().name() for metadata in metadata_list])
+
     @db.transactional(xg=True)
     def delete(self, filename):
         filename = self._logical_to_physical(filename)
@@ -739,6 +1075,7 @@ class DatastoreBackedFileSystem(object):
         data = FileDataEntity(key_name=filename)
         if data:
             data.delete()
+        FileChangeLog.record(self._ns, [filename], is_deleted=True)
         self.cache.delete(filename)
 
     def isfile(self, afilename):
@@ -765,12 +1102,19 @@ class DatastoreBackedFileSystem(object):
             recursively found in dir_name.
         """
         dir_name = self._logical_to_physical(dir_name)
-        result = set()
-        keys = FileMetadataEntity.all(keys_only=True)
-        for key in keys.fetch(1000):
-            filename = key.name()
-            if filename.startswith(dir_name):
-                result.add(self._physical_to_logical(filename))
+        filenames = None
+        if VfsCacheConnection.is_enabled():
+            # Any change to the files of the namespace, made here or by
+            # another instance, changes the generations of its change log.
+            generations = FileChangeLog.get_generations(self._ns)
+            filenames = self._get_cached_listing(dir_name, generations)
+        if filenames is None:
+            filenames = self._list_physical(dir_name)
+            if VfsCacheConnection.is_enabled():
+                ProcessScopedVfsCache.instance().set_listing(
+                    self._ns, dir_name, generations, filenames)
+        result = set(
+            self._physical_to_logical(filename) for filename in filenames)
         if include_inherited and self._inherits_from:
             for inheritable_folder in self._inheritable_folders:
                 logical_folder = self._physical_to_logical(inheritable_folder)
@@ -779,6 +1123,34 @@ class DatastoreBackedFileSystem(object):
                     include_inherited)))
         return sorted(list(result))
 
+    def _get_cached_listing(self, dir_name, generations):
+        filenames = ProcessScopedVfsCache.instance().get_listing(
+            self._ns, dir_name, generations)
+        if filenames is None:
+            VfsCacheConnection.CACHE_LISTING_MISS.inc()
+        else:
+            VfsCacheConnection.CACHE_LISTING_HIT.inc()
+        return filenames
+
+    @classmethod
+    def _list_physical(cls, dir_name):
+        """Returns names of all files whose physical name starts with dir_name.
+
+        File names are the key names of FileMetadataEntity, so the files in a
+        directory are a contiguous key range; this reads only that range, in
+        batches, using cursors. The range ends at dir_name with its last
+        character incremented, which sorts after every name it prefixes.
+        """
+        kind = FileMetadataEntity.kind()
+        query = FileMetadataEntity.all(keys_only=True).filter(
+            '__key__ >=', db.Key.from_path(kind, dir_name))
+        if dir_name:
+            query.filter('__key__ <', db.Key.from_path(
+                kind, dir_name[:-1] + unichr(ord(dir_name[-1]) + 1)))
+        return tuple(
+            key.name() for key in caching.iter_all(
+                query, batch_size=_LIST_BATCH_SIZE))
+
     def get_jinja_environ(self, dir_names, autoescape=True):
         return jinja_utils.create_jinja_environment(
             loader=VirtualFileSystemTemplateLoader(
@@ -18,6 +18,7 @@ __author__ = ['Michael Gainer (mgainer@google.com)']
 
 import messages
 from common import schema_fields
+from controllers import utils
 from models import analytics
 from models import courses
 from models import custom_modules
@@ -26,7 +27,6 @@ from models import data_removal
 from models import services
 from modules.analytics import answers_aggregator
 from modules.analytics import clustering
-from modules.analytics import gradebook
 from modules.analytics import location_aggregator
 from modules.analytics import page_event_aggregator
 from modules.analytics import rest_providers
@@ -43,6 +43,10 @@ ANALYTICS = 'analytics'
 # interaction with course: page views, widget interactions, question answers.
 CAN_RECORD_STUDENT_EVENTS = 'can_record_student_events'
 
+# Same as gradebook.CsvDownloadHandler.URI; gradebook is imported on the first
+# download rather than at startup.
+GRADEBOOK_CSV_URI = '/gradebook/csv'
+
 custom_module = None
 
 def register_tabs():
@@ -159,7 +163,8 @@ def add_actions():
 def get_namespaced_handlers():
     return [
         (clustering.ClusterRESTHandler.URI, clustering.ClusterRESTHandler),
-        (gradebook.CsvDownloadHandler.URI, gradebook.CsvDownloadHandler),
+        (GRADEBOOK_CSV_URI, utils.LazyHandlerFactory(
+            'modules.analytics.gradebook.CsvDownloadHandler')),
         ]
 
 
@@ -158,7 +158,7 @@ class AvailabilityRESTHandler(utils.BaseRESTHandler):
 
         course = self.get_course()
         course_availability = course.get_course_availability()
-        settings = course.get_environ(self.app_context)
+        settings = course.get_environ(self.app_context, mutable=False)
         entity = {
             'course_availability': course_availability,
             'whitelist': settings['reg_form']['whitelist'],
@@ -348,16 +348,18 @@ class UnitHandler(utils.BaseHandler):
                 student, unit, course.find_unit_by_id(unit.pre_assessment),
                 student_view, {}))
 
-        for lesson in course.get_lessons(unit.unit_id):
-            self.lesson_id = lesson.lesson_id
-            self.lesson_is_scored = lesson.scored
-            template_values = copy.copy(self.template_value)
-            self.set_lesson_content(student, unit, lesson, student_view,
-                                    template_values)
-            display_content.append(self.render_template_to_html(
-                template_values, 'lesson_common.html'))
-            del self.lesson_id
-            del self.lesson_is_scored
+        # Each lesson marks itself as accessed; store that progress once.
+        with course.get_progress_tracker().progress_transaction(student):
+            for lesson in course.get_lessons(unit.unit_id):
+                self.lesson_id = lesson.lesson_id
+                self.lesson_is_scored = lesson.scored
+                template_values = copy.copy(self.template_value)
+                self.set_lesson_content(student, unit, lesson, student_view,
+                                        template_values)
+                display_content.append(self.render_template_to_html(
+                    template_values, 'lesson_common.html'))
+                del self.lesson_id
+                del self.lesson_is_scored
 
         if unit.post_assessment:
             display_content.append(self.get_assessment_display_content(
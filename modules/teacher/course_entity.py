@@ -55,6 +55,7 @@ class CourseSectionEntity(entities.BaseEntity):
     labels = db.StringProperty(indexed=False)
 
     memcache_key = 'sections'
+    by_student_memcache_key = 'sections:by_student'
 
     @classmethod
     def get_sections(cls, allow_cached=True):
@@ -64,6 +65,23 @@ class CourseSectionEntity(entities.BaseEntity):
             MemcacheManager.set(cls.memcache_key, sections)
         return sections
 
+    @classmethod
+    def get_section_keys_by_student(cls):
+        """Returns a dict email -> [keys of the sections the student is in].
+
+           Progress events need the sections of one student, so the rosters
+           are split into this index once, not on every event.
+        """
+        by_student = MemcacheManager.get(cls.by_student_memcache_key)
+        if by_student is None:
+            by_student = {}
+            for section in cls.get_sections():
+                for email in (section.students or '').split(','):
+                    if email:
+                        by_student.setdefault(email, []).append(str(section.key()))
+            MemcacheManager.set(cls.by_student_memcache_key, by_student)
+        return by_student
+
     @classmethod
     def make(cls, name, acadyr, description, is_active):
         entity = cls()
@@ -79,13 +97,19 @@ class CourseSectionEntity(entities.BaseEntity):
     def put(self):
         """Do the normal put() and also invalidate memcache."""
         result = super(CourseSectionEntity, self).put()
-        MemcacheManager.delete(self.memcache_key)
+        MemcacheManager.delete_multi(
+            [self.memcache_key, self.by_student_memcache_key])
         return result
 
     def delete(self):
         """Do the normal delete() and invalidate memcache."""
         super(CourseSectionEntity, self).delete()
-        MemcacheManager.delete(self.memcache_key)
+        MemcacheManager.delete_multi(
+            [self.memcache_key, self.by_student_memcache_key])
+
+# The list of sections is read on every Teacher Dashboard page, and the
+# sections:by_student index on every progress event.
+MemcacheManager.add_l1_key_prefix(CourseSectionEntity.memcache_key)
 
 class SectionItemRESTHandler(utils.BaseRESTHandler):
     """Provides REST API for adding a section."""
@@ -0,0 +1,115 @@
+# Copyright 2016 Mobile CSP Project. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Contains the SectionRosterEntity
+
+import datetime
+import hashlib
+import logging
+
+from google.appengine.ext import db
+
+from models import entities
+from models import transforms
+from models.models import MemcacheManager
+
+GLOBAL_DEBUG = False
+
+class SectionRosterEntity(entities.BaseEntity):
+
+    """A precomputed snapshot of the Roster view for one course section.
+
+       Computing every student's unit and lesson progress is expensive, so
+       the Roster page shows the most recent snapshot instead.  A snapshot is
+       keyed by the section and by a roster version, which is a digest of the
+       course's units and lessons and of the section's students.  When either
+       changes, the old snapshot is no longer found, and it is deleted when
+       the snapshot of the new version is saved.
+
+       Snapshots are refreshed in the background when a student's progress
+       changes and on demand from the Roster page.
+    """
+    section_key = db.StringProperty(indexed=True)
+    roster_version = db.StringProperty(indexed=False)
+    updated_on = db.DateTimeProperty(indexed=False)
+    students = db.TextProperty(indexed=False)   # json string
+
+    memcache_key = 'sectionroster'
+
+    @classmethod
+    def get_roster_version(cls, lessons_json, section):
+        """Returns a digest of the course structure and the section's students."""
+        return hashlib.md5(
+            '%s|%s' % (lessons_json, section.students or '')).hexdigest()
+
+    @classmethod
+    def _key_name(cls, section_key, roster_version):
+        return '%s:%s' % (section_key, roster_version)
+
+    @classmethod
+    def _memcache_key(cls, key_name):
+        return '%s:%s' % (cls.memcache_key, key_name)
+
+    @classmethod
+    def get_snapshot(cls, section_key, roster_version):
+        """Returns the snapshot for this version of the section or None."""
+        key_name = cls._key_name(section_key, roster_version)
+        snapshot = MemcacheManager.get(cls._memcache_key(key_name))
+        if not snapshot:
+            snapshot = cls.get_by_key_name(key_name)
+            if snapshot:
+                MemcacheManager.set(cls._memcache_key(key_name), snapshot)
+        return snapshot
+
+    @classmethod
+    def save_snapshot(cls, section_key, roster_version, students):
+        snapshot = cls(key_name=cls._key_name(section_key, roster_version))
+        snapshot.section_key = section_key
+        snapshot.roster_version = roster_version
+        snapshot.updated_on = datetime.datetime.now()
+        snapshot.students = transforms.dumps(students)
+        snapshot.put()
+        cls.delete_for_section(section_key, keep_key=snapshot.key())
+        if GLOBAL_DEBUG:
+            logging.debug('***RAM*** saved roster snapshot ' + snapshot.key().name())
+        return snapshot
+
+    @classmethod
+    def delete_for_section(cls, section_key, keep_key=None):
+        """Deletes every snapshot of a section, except keep_key if given.
+
+           This is used when the section is deleted and to drop the
+           snapshots of outdated roster versions.
+        """
+        keys = [key for key in cls.all(keys_only=True).filter('section_key', section_key)
+                if key != keep_key]
+        if keys:
+            entities.delete(keys)
+            MemcacheManager.delete_multi([cls._memcache_key(key.name()) for key in keys])
+
+    def get_students(self):
+        if not self.students:
+            return []
+        return transforms.loads(self.students)
+
+    def put(self):
+        """Do the normal put() and also add the object to memcache."""
+        result = super(SectionRosterEntity, self).put()
+        MemcacheManager.set(self._memcache_key(self.key().name()), self)
+        return result
+
+    def delete(self):
+        """Do the normal delete() and also remove the object from memcache."""
+        super(SectionRosterEntity, self).delete()
+        MemcacheManager.delete(self._memcache_key(self.key().name()))
@@ -6,6 +6,13 @@ import logging
 import random
 import traceback
 
+from google.appengine.api import memcache
+from google.appengine.ext import db
+from google.appengine.ext import deferred
+
+from common import utils as common_utils
+from controllers import sites
+from models import entities
 from models import transforms
 from models.models import Student
 from models.models import EventEntity
@@ -16,9 +23,12 @@ from models import event_transforms
 from models.models import QuestionDAO
 from models.models import QuestionGroupDAO
 from models.models import MemcacheManager
+from models.models import CourseContentVersion
 
 from models.progress import UnitLessonCompletionTracker
 
+from student_scores import StudentScoresEntity
+
 GLOBAL_DEBUG = False
 
 class ActivityScoreParser(jobs.MapReduceJob):
@@ -34,12 +44,22 @@ class ActivityScoreParser(jobs.MapReduceJob):
 
     CUTOFF_DATE = datetime.datetime(2016,8,1)
 
+    PARAMS_MEMCACHE_KEY = 'activityscores:params'
+
+    # The datastore accepts at most 30 values in an IN filter
+    MAX_USER_IDS_PER_QUERY = 30
+
+    # A student's first answer schedules a backfill of their scores row from
+    # the event log this many seconds later; answers in between are in the
+    # log by then.
+    BACKFILL_DELAY_SECS = 10
 
     def __init__(self):
         """holds activity score info unit -> lesson -> question"""
         self.activity_scores = { }
         self.params = {}
         self.num_attempts_dict = { }
+        self.user_ids = { }          # email -> user_id of the students parsed
        
         # This is a table of all the Quizly exercises currently in the course.  It is used to provide a
         #  description in the Student Dashboard and also to validate that an instance_id is still 
@@ -298,6 +318,9 @@ class ActivityScoreParser(jobs.MapReduceJob):
             group_to_questions = self.params['group_to_questions']
 
             student = Student.get_by_user_id(activity_attempt.user_id)
+            if not student:        # e.g., the student has unenrolled
+                return self.activity_scores
+            self.user_ids[student.email] = student.user_id
 
             #  Get this student's answers so far
             student_answers = self.activity_scores.get(student.email, {})
@@ -469,19 +492,166 @@ class ActivityScoreParser(jobs.MapReduceJob):
 #             logging.debug('***RAM*** key: ' + q)
 #             logging.debug('***RAM*** dict ' + str(questions_dict[q]))
 
+    @classmethod
+    def get_mapper_params(cls, app_context):
+        """Returns the course's question tables, cached in memcache until
+           the course content version changes.
+
+           build_additional_mapper_params() walks the whole course and loads
+           every question, so it is far too expensive to repeat every time a
+           single tag-assessment event is recorded.
+        """
+        key = '%s:%s' % (cls.PARAMS_MEMCACHE_KEY, CourseContentVersion.get())
+        params = MemcacheManager.get(key, mutable=True)
+        if not params:
+            params = ActivityScoreParser().build_additional_mapper_params(app_context)
+            MemcacheManager.set(key, params)
+        return params
+
+    @classmethod
+    def _parse_student_events(cls, parser, user_id):
+        """Runs one student's tag-assessment events through the parser."""
+        cls._parse_events_for_students(parser, [user_id])
+
+    @classmethod
+    def _parse_events_for_students(cls, parser, user_ids):
+        """Streams the events of a whole set of students through the parser.
+
+           Rather than one query per student, this issues a single query for
+           every MAX_USER_IDS_PER_QUERY students and feeds its results, oldest
+           first, straight into parse_activity_scores().  Returns the number
+           of events parsed.
+        """
+        user_ids = [user_id for user_id in user_ids if user_id]
+        num_events = 0
+        for i in xrange(0, len(user_ids), cls.MAX_USER_IDS_PER_QUERY):
+            query = EventEntity.all().filter(
+                'user_id in', user_ids[i:i + cls.MAX_USER_IDS_PER_QUERY])   \
+                    .filter('recorded_on  >= ', cls.CUTOFF_DATE)             \
+                    .order('recorded_on')
+            for activity_attempt in query.run(batch_size=1000):
+                parser.parse_activity_scores(activity_attempt)
+                num_events += 1
+        return num_events
+
+    @classmethod
+    def _load_student_scores(cls, parser, student):
+        """Seeds the parser with the student's row from the scores table.
+
+           If the student has no row yet, it is backfilled from the student's
+           events.  Returns the row or None if there wasn't one.
+        """
+        row = StudentScoresEntity.get_by_emails([student.email]).get(student.email)
+        if row:
+            scores = row.get_scores()
+            if scores:
+                parser.activity_scores[student.email] = scores
+            parser.num_attempts_dict[student.email] = row.get_attempts()
+        else:
+            cls._parse_student_events(parser, student.user_id)
+        return row
+
+    @classmethod
+    def _make_scores_row(cls, parser, email, user_id, row=None):
+        if not row:
+            row = StudentScoresEntity.make(user_id, email)
+        row.set_scores(parser.activity_scores.get(email, {}),
+                       parser.num_attempts_dict.get(email, {}))
+        return row
+
+    @classmethod
+    def record_activity_score(cls, app_context, user, data):
+        """Folds a single tag-assessment event into the student's scores row.
+
+           This is called from the EventEntity listener before the event
+           itself is stored.  The row is updated in a transaction, so
+           concurrent answers of a student are all counted.  A student with
+           no row yet gets one built from the event log by a deferred task,
+           rather than while they wait for their answer to be checked; the
+           log includes this event by then.
+        """
+        student = Student.get_by_user_id(user.user_id())
+        if not student:
+            return
+        params = cls.get_mapper_params(app_context)
+        event = EventEntity(source='tag-assessment', user_id=user.user_id(),
+                            data=data, recorded_on=datetime.datetime.now())
+        key = db.Key.from_path(StudentScoresEntity.kind(), student.email)
+
+        def _update():
+            row = entities.get(key)
+            if not row:
+                return False
+            parser = ActivityScoreParser()
+            parser.params = params
+            if row.get_scores():
+                parser.activity_scores[student.email] = row.get_scores()
+            parser.num_attempts_dict[student.email] = row.get_attempts()
+            # The student was loaded above, so parsing finds them in the
+            # request's StudentCache rather than querying in the transaction.
+            parser.parse_activity_scores(event)
+            entities.put(cls._make_scores_row(parser, student.email, student.user_id, row))
+            return True
+
+        if db.run_in_transaction_options(
+                db.create_transaction_options(xg=True), _update):
+            return
+
+        # The flag expires before the backfill runs, so an answer that
+        # arrives after the backfill has read the log schedules another one.
+        namespace = app_context.get_namespace_name()
+        if memcache.add('activityscores:backfill:%s' % student.email, True,
+                        time=cls.BACKFILL_DELAY_SECS / 2, namespace=namespace):
+            deferred.defer(cls.backfill_in_namespace, namespace, student.user_id,
+                           _countdown=cls.BACKFILL_DELAY_SECS)
+
+    @classmethod
+    def backfill_in_namespace(cls, namespace, user_id):
+        """Task queue callback that builds a student's scores row from the event log."""
+        with common_utils.Namespace(namespace):
+            app_context = sites.get_app_context_for_namespace(namespace)
+            student = Student.get_by_user_id(user_id)
+            if not app_context or not student:
+                return
+            parser = ActivityScoreParser()
+            parser.params = cls.get_mapper_params(app_context)
+            cls._parse_student_events(parser, user_id)
+            entities.put(cls._make_scores_row(parser, student.email, user_id))
+
+    @classmethod
+    def get_student_scores(cls, student, course):
+        """Retrieve one student's activity data from the StudentScoresEntity table.
+
+           Returns the same score_data dict as get_activity_scores() but reads
+           a single entity rather than querying the student's EventEntities.
+        """
+        parser = ActivityScoreParser()
+        parser.params = cls.get_mapper_params(course.app_context)
+        row = cls._load_student_scores(parser, student)
+        if not row:
+            row = cls._make_scores_row(parser, student.email, student.user_id)
+            entities.put(row)
+
+        #  Fill in the questions the student has not attempted yet
+        parser.build_missing_scores()
+
+        score_data = {}
+        score_data['date'] = row.updated_on
+        score_data['scores'] = parser.activity_scores
+        score_data['attempts'] = parser.num_attempts_dict
+        return score_data
+
     @classmethod
     def get_activity_scores(cls, student_user_ids, course, force_refresh = True):
         """Retrieve activity data for student using EventEntity.
 
-           For each student, launch a Query of EventEntities to retrieve student
-           scores.  The Query is launched as a map-reduce background process that
-           will return up to 500 results, reporting back every second.  It reports
-           back by calling the map_fn callback, which in turn calls parse_activity
-           scores.
+           The EventEntities of all the students are scanned together, with one
+           Query per batch of up to 30 students rather than one per student.
+           The events are streamed, oldest first, through parse_activity_scores(),
+           which fills in the results for every student in the set at once.
 
-           As soon as the Query is launched (in the background) the foreground
-           process calls build_missing_scores() to construct a student_answer.dict
-           that will be updated as score data for that student is received.
+           After the scan build_missing_scores() constructs a student_answer.dict
+           entry for each question the student has not yet attempted.
 
            Events properties include a userid (a number) and a source (e.g.,
            tag-assessement), a  recorded-on date (timestamp) and data (a dictionary).
@@ -504,22 +674,8 @@ class ActivityScoreParser(jobs.MapReduceJob):
         if force_refresh:
             activityParser.params = activityParser.build_additional_mapper_params(course.app_context)
 
-            #  Launch a background Query for each student's activity data.  This is expensive.
-            for user_id in student_user_ids:
-#                if GLOBAL_DEBUG:
-#                     logging.debug('***RAM*** launching a query for student ' + str(user_id))
-                mapper = models_utils.QueryMapper(
-                    EventEntity.all().filter('user_id in', [user_id])       \
-                                     .filter('recorded_on  >= ', cls.CUTOFF_DATE), \
-                                        batch_size=1000, report_every=1000)
-
-                # Callback function -- e.g., 45-50 callbacks per query
-                def map_fn(activity_attempt):
-#                    if GLOBAL_DEBUG:
-#                     logging.debug('***RAM*** map_fn ' + str(activity_attempt))
-                    activityParser.parse_activity_scores(activity_attempt)
-
-                mapper.run(map_fn)
+            #  Scan the activity data of all the students in one pass.  This is expensive.
+            cls._parse_events_for_students(activityParser, student_user_ids)
 
             #  In the foreground create the student_answer_dict, which is stored at:
             #   activity_scores[student][unit][lesson][sequence]  where sequence is
@@ -544,7 +700,7 @@ class ActivityScoreParser(jobs.MapReduceJob):
                     student = Student.get_by_user_id(student_id)
                     temp_email = student.email
                     temp_mem = cls._memcache_key_for_student(temp_email)
-                    scores_for_student = MemcacheManager.get(temp_mem)
+                    scores_for_student = MemcacheManager.get(temp_mem, mutable=True)
                     if scores_for_student:
                         cached_date = scores_for_student['date']
                         activityParser.activity_scores[student_id] = scores_for_student['scores']
@@ -557,16 +713,7 @@ class ActivityScoreParser(jobs.MapReduceJob):
 
                 activityParser.params = activityParser.build_additional_mapper_params(course.app_context)
 
-                for user_id in uncached_students:
-                    mapper = models_utils.QueryMapper(
-                        EventEntity.all().filter('user_id in', [user_id])       \
-                                     .filter('recorded_on  >= ', cls.CUTOFF_DATE), \
-                                        batch_size=1000, report_every=1000)
-
-                    def map_fn(activity_attempt):
-                        activityParser.parse_activity_scores(activity_attempt)
-
-                    mapper.run(map_fn)
+                cls._parse_events_for_students(activityParser, uncached_students)
 
                 activityParser.build_missing_scores()
 
@@ -592,3 +739,41 @@ class ActivityScoreParser(jobs.MapReduceJob):
     @classmethod
     def _memcache_key_for_student(cls, user_id):
         return ('activityscores:%s' % user_id)
+
+
+class ActivityScoresRebuildJob(jobs.DurableJob):
+    """Rebuilds the StudentScoresEntity table from the tag-assessment events.
+
+       The table is normally kept up to date one event at a time by the
+       EventEntity listener.  This job makes a single pass over all events
+       since the CUTOFF_DATE and rewrites every student's row, e.g., after
+       the course's questions have been reorganized.
+    """
+
+    PUT_BATCH_SIZE = 100
+
+    @staticmethod
+    def get_description():
+        return 'activity scores table'
+
+    def run(self):
+        parser = ActivityScoreParser()
+        parser.params = ActivityScoreParser.get_mapper_params(self._app_context)
+        mapper = models_utils.QueryMapper(
+            EventEntity.all().filter('recorded_on  >= ', ActivityScoreParser.CUTOFF_DATE),
+            batch_size=1000, report_every=1000)
+        num_events = mapper.run(parser.parse_activity_scores)
+
+        rows = []
+        num_students = 0
+        for email in parser.activity_scores:
+            rows.append(ActivityScoreParser._make_scores_row(
+                parser, email, parser.user_ids[email]))
+            if len(rows) >= self.PUT_BATCH_SIZE:
+                entities.put(rows)
+                num_students += len(rows)
+                rows = []
+        if rows:
+            entities.put(rows)
+            num_students += len(rows)
+        return {'events': num_events, 'students': num_students}
@@ -17,18 +17,24 @@
 import datetime
 import logging
 import json
+import time
 import random 
 import copy
 
+from google.appengine.api import memcache
 from google.appengine.ext import db
+from google.appengine.ext import deferred
 
+from common import caching
 from common import schema_fields
 from common import utils as common_utils
 
 #from controllers import utils
 
 from models import entities
+from models import jobs
 from models import models
+from models import utils as models_utils
 #from models import resources_display
 #from models import roles
 #from models import transforms
@@ -36,10 +42,25 @@ from models import models
 
 #from models.models import QuestionDAO
 #from models.models import QuestionGroupDAO
+from models.counters import PerfCounter
 from models.models import MemcacheManager
 
 GLOBAL_DEBUG = False
 
+ANSWERS_FETCH = PerfCounter(
+    'gcb-teacher-student-answers-fetch',
+    'A number of times a unit of a student\'s answers was loaded for a '
+    'status check.')
+ANSWERS_FETCH_REUSED = PerfCounter(
+    'gcb-teacher-student-answers-fetch-reused',
+    'A number of times a unit of a student\'s answers already loaded in the '
+    'current request was reused for a status check.')
+ANSWERS_DROPPED = PerfCounter(
+    'gcb-teacher-student-answers-dropped',
+    'A number of buffered student answers that were evicted from memcache '
+    'or fell out of the buffer before they were flushed.')
+
+
 class StudentAnswersEntity(entities.BaseEntity):
 
     """A class that represents a persistent database entity for student answers."""
@@ -48,113 +69,267 @@ class StudentAnswersEntity(entities.BaseEntity):
     email = db.StringProperty(indexed=True) 
     answers_dict = db.TextProperty(indexed=False)   #json string
     
+    flushed_seq = db.IntegerProperty(indexed=False, default=0)  # last buffered answer applied
+
     memcache_key = 'studentanswers'
 
+    # Answers are buffered in memcache and written to the datastore by a
+    # deferred flush, so that a burst of answers from a student costs one
+    # put() rather than one per answer.  A flush applies at most
+    # MAX_BUFFERED_ANSWERS per student, so one is also started right away
+    # whenever half that many answers have been buffered.  Answers can only
+    # be lost if memcache evicts them, or the flushes fall behind, and they
+    # are counted in ANSWERS_DROPPED when that happens.
+    FLUSH_DELAY_SECS = 30
+    MAX_BUFFERED_ANSWERS = 100
+    BUFFER_TTL_SECS = 60 * 60
+
+    # Answer numbers start from the clock in milliseconds; see _buffer_answer().
+    SEQS_PER_SECOND = 1000
+
     @classmethod
     def record(cls, user, data):
         """Records a student tag-assessment into a datastore.
   
            A tag-assessment includes a student attempt at a quiz question.
-           The user's email is used as the key for the StudentAnswersEntity. 
+           The user's email is used as the key for the StudentAnswersEntity,
+           so recording an attempt is a single key get() and put().
 
            Initially an randomly generated numeric id was used as the key
            for StudentAnswersEntity.  That made it difficult to lookup 
            student data from the datastore without having to perform a
-           very expensive query. So, we switched to an email-based key, which 
-           lets us retrieve a single record from the db with a key.get(). 
-
-           However, the datastore already had a couple of thousand records
-           in it and we were unable to revise it.  So this code works with
-           both the legacy and new formats.
-
-           Algorithm:
-              First try to get the Entity using the student's key.  If
-              that succeeds then proceed with updating the answers_dict.
-              If that fails, then try getting the Entity using a query
-              on the student's email (expensive).  If that succeeds, 
-              create a new Entity as a copy of the existing one with 
-              the email as its key.  If that fails, then this is the
-              occurrence for the student -- make a new Entity. 
-
-          For some students this will leave 2 Entities with the
-          same email. However, only the entity with the email-based
-          key is updated. 
-
-          We will eventually delete all numeric-based keys.
+           very expensive query. So, we switched to an email-based key.
+           The legacy numeric-key entities are moved over to email keys
+           by StudentAnswersMigrationJob, which merges their answers into
+           any email-keyed entity recorded in the meantime.
+
+           The attempt is first buffered in memcache, and a flush of the
+           student's buffer is scheduled if one isn't already pending.  If
+           memcache is unavailable the attempt is written immediately.
         """
-        # Try to get the student's data by email key from datastore
         email = user.email()
-        key = db.Key.from_path('StudentAnswersEntity', email)
-        if GLOBAL_DEBUG:
-            logging.debug('***RAM*** email ' + email + ' key = ' + str(key))
-        student = db.get(key)
-
-        if student: 
-            #  If student (with email key) found
+        user_id = user.user_id()
+        RequestScopedStudentAnswers.instance().forget(email)
+        timestamp = int((datetime.datetime.now() - datetime.datetime(1970, 1, 1)).total_seconds())
+        seq = cls._buffer_answer(email, user_id, data, timestamp)
+        if not seq:
             if GLOBAL_DEBUG:
-                logging.warning('***RAM*** existing student key =  ' + email)
-            student.answers_dict = cls.update_answers_dict(student, data, user)
-            student.recorded_on = datetime.datetime.now()
-            student.put()
-        else:
-            # Try to query the db by email to get student       
-            student = cls.get_student_by_email(email, user)
+                logging.warning('***RAM*** writing through for ' + email)
+            cls._write_answers(email, [(user_id, data, timestamp)])
+            return
+
+        # Numbering starts at a multiple of SEQS_PER_SECOND, so this is true
+        # of every (MAX_BUFFERED_ANSWERS / 2)th answer since the counter was
+        # created.
+        namespace = MemcacheManager.get_namespace()
+        if seq % (cls.MAX_BUFFERED_ANSWERS / 2) == 0:
+            deferred.defer(cls.flush_in_namespace, namespace, email)
+
+        # The flag expires before the flush runs, so an answer that arrives
+        # after the flush has read the buffer always schedules another one.
+        if memcache.add(cls._buffer_key(email) + ':scheduled', True,
+                        time=cls.FLUSH_DELAY_SECS / 2, namespace=namespace):
+            deferred.defer(cls.flush_in_namespace, namespace, email,
+                           _countdown=cls.FLUSH_DELAY_SECS)
+
+    @classmethod
+    def _buffer_key(cls, email, seq=None):
+        if seq is None:
+            return '%s:buffer:%s' % (cls.memcache_key, email)   # the counter
+        return '%s:buffer:%s:%d' % (cls.memcache_key, email, seq)
+
+    @classmethod
+    def _buffer_answer(cls, email, user_id, data, timestamp):
+        """Adds an answer to the student's memcache buffer.
+
+           Returns the answer's number, or None if it wasn't buffered.
+           Answers are numbered by a memcache counter.  Its initial value is
+           taken from the clock so that, if it is ever evicted, the numbers
+           keep increasing past the last one flushed.
+        """
+        if not models.CAN_USE_MEMCACHE.value:
+            return None
+        namespace = MemcacheManager.get_namespace()
+        seq = memcache.incr(cls._buffer_key(email), namespace=namespace,
+                            initial_value=int(time.time()) * cls.SEQS_PER_SECOND)
+        if seq is None:
+            return None
+        if not memcache.set(cls._buffer_key(email, seq), (user_id, data, timestamp),
+                            time=cls.BUFFER_TTL_SECS, namespace=namespace):
+            return None
+        return seq
+
+    @classmethod
+    def _get_buffered_answers(cls, email, flushed_seq):
+        """Returns (last_seq, answers) for the answers buffered after flushed_seq."""
+        if not models.CAN_USE_MEMCACHE.value:
+            return None, []
+        namespace = MemcacheManager.get_namespace()
+        last_seq = memcache.get(cls._buffer_key(email), namespace=namespace)
+        if not last_seq or last_seq <= flushed_seq:
+            return None, []
+        first_seq = max(flushed_seq + 1, last_seq - cls.MAX_BUFFERED_ANSWERS + 1)
+        keys = [cls._buffer_key(email, seq) for seq in xrange(first_seq, last_seq + 1)]
+        values = memcache.get_multi(keys, namespace=namespace)
+        return last_seq, [values[key] for key in keys if key in values]
+
+    @classmethod
+    def _apply_answers(cls, answers_dict, email, answers):
+        """Returns answers_dict with the (user_id, data, timestamp) answers added."""
+        for user_id, data, timestamp in answers:
+            answers_dict = cls.build_dict(answers_dict, data, email, user_id, timestamp)
+        return answers_dict
+
+    @classmethod
+    def _get_units(cls, key, unit_ids=None):
+        """Returns the student's entity and a dict unit_id -> StudentUnitAnswersEntity.
+
+           The entity and the requested units are fetched with one multi-get.
+           If unit_ids is None, all the student's units are fetched.
+        """
+        if unit_ids is None:
+            student = entities.get(key)
+            units = []
             if student:
-                if GLOBAL_DEBUG:
-                    logging.warning('***RAM*** updating for ' + email)
-                student.answers_dict = cls.update_answers_dict(student, data, user)
-                student.recorded_on = datetime.datetime.now()
-                student.put()
-            else:           
-                # No student with that email in Db -- create a new Entity
-                if GLOBAL_DEBUG:
-                    logging.warning('***RAM*** creating new ' + email)
-                student = cls(key_name = email)
-                dict = cls.update_answers_dict(None, data, user)
-                student.answers_dict = dict
-                student.user_id = user.user_id()
-                student.email = user.email() 
-                student.put()
+                units = StudentUnitAnswersEntity.all().ancestor(key).fetch(1000)
+        else:
+            results = entities.get(
+                [key] + [StudentUnitAnswersEntity.make_key(key, unit_id) for unit_id in unit_ids])
+            student = results[0]
+            units = [unit for unit in results[1:] if unit]
+        return student, dict([(unit.key().name(), unit) for unit in units])
 
     @classmethod
-    def get_student_by_email(cls, email, user):
-        if GLOBAL_DEBUG:
-            logging.warning('***RAM*** get by email ' + email)
-        
-        # Fetch the student by query on the email
-        # If no hit, return None which will cause a new Entity
-        student = cls.all().filter('email',email).get()
+    def _to_answers_dict(cls, student, units, unit_ids=None):
+        """Assembles the stored answers into {'email', 'user_id', 'answers'}."""
         if not student:
-            if GLOBAL_DEBUG:
-                logging.warning('***RAM***  no hit for email ' + email)
-            return None 
-        else:
-            # Here were are converting the student's answers entity
-            # from using an integer key to using the email as key.
-            # THis will make retrievals way more efficient. 
+            return None
+        if student.answers_dict:     # Not split into units yet
+            return cls._filter_units(json.loads(student.answers_dict), unit_ids)
+        answers = {}
+        for unit_id, unit in units.items():
+            answers[unit_id] = unit.get_lessons()
+        return {'email': student.email, 'user_id': student.user_id, 'answers': answers}
+
+    @classmethod
+    def _filter_units(cls, answers_dict, unit_ids):
+        if answers_dict and unit_ids is not None:
+            answers = answers_dict['answers']
+            answers_dict['answers'] = dict(
+                [(unit_id, answers[unit_id]) for unit_id in unit_ids if unit_id in answers])
+        return answers_dict
+
+    @classmethod
+    def _store_answers(cls, student, units, answers_dict, unit_ids):
+        """Stores the given units of answers_dict, and the student entity, with one put().
+
+           A student whose answers are still in the single answers_dict blob
+           has them split into one entity per unit.
+        """
+        if student.answers_dict:
+            unit_ids = answers_dict['answers'].keys()
+            student.answers_dict = None
+        to_put = [student]
+        for unit_id in unit_ids:
+            unit = units.get(unit_id)
+            if not unit:
+                unit = StudentUnitAnswersEntity(parent=student.key(), key_name=unit_id)
+            unit.set_lessons(answers_dict['answers'].get(unit_id, {}))
+            to_put.append(unit)
+        entities.put(to_put)
+        MemcacheManager.delete(cls.memcache_key)
+        RequestScopedStudentAnswers.instance().forget(student.email)
+
+    @classmethod
+    def _write_answers(cls, email, answers, last_seq=None):
+        """Adds answers to the student's entities, rewriting only the units they touch."""
+        key = db.Key.from_path(cls.kind(), email)
+        unit_ids = set([cls._parse_location(json.loads(data))[0] for _, data, _ in answers])
+        student, units = cls._get_units(key, unit_ids)
+        if not student:
+            # No student with that email in Db -- create a new Entity
             if GLOBAL_DEBUG:
                 logging.warning('***RAM*** creating new ' + email)
-            new_student = cls(key_name = email)
-            new_student.answers_dict = student.answers_dict
-            new_student.user_id = student.user_id
-            new_student.email = email
-            return new_student
+            student = cls(key_name = email)
+            student.user_id = answers[0][0]
+            student.email = email
+        answers_dict = cls._apply_answers(cls._to_answers_dict(student, units), email, answers)
+        student.recorded_on = datetime.datetime.now()
+        if last_seq:
+            student.flushed_seq = last_seq
+        cls._store_answers(student, units, answers_dict, unit_ids)
 
     @classmethod
-    def update_answers_dict(cls, student, data, user):
-        if student:    # Student dict already exists
-            data_json = json.loads(data)
-            dict = json.loads(student.answers_dict)
-            dict = cls.build_dict(dict, data, user)
-            return json.dumps(dict)
-        else:
-            dict = cls.build_dict(None, data, user)  # New student Dict
+    def flush_buffered_answers(cls, email):
+        """Writes the student's buffered answers to the datastore.
+
+           This runs in a transaction and only applies answers numbered
+           after the entity's flushed_seq, so overlapping or retried flushes
+           never apply an answer twice.
+        """
+        key = db.Key.from_path(cls.kind(), email)
+
+        def _flush():
+            student = entities.get(key)
+            flushed_seq = student.flushed_seq if student else 0
+            last_seq, answers = cls._get_buffered_answers(email, flushed_seq)
+            if answers:
+                cls._write_answers(email, answers, last_seq)
             if GLOBAL_DEBUG:
-                logging.debug('***RAM*** dict ' + str(dict))
-            return json.dumps(dict)
+                logging.debug('***RAM*** flushed ' + str(len(answers)) + ' answers for ' + email)
+            return cls._count_dropped(flushed_seq, last_seq, answers)
+
+        num_dropped = db.run_in_transaction(_flush)
+        if num_dropped:
+            ANSWERS_DROPPED.inc(num_dropped)
+            logging.warning('Dropped %d buffered answers of %s.', num_dropped, email)
+
+    @classmethod
+    def _count_dropped(cls, flushed_seq, last_seq, answers):
+        """Returns how many answers numbered after flushed_seq a flush didn't get.
+
+           Nothing is known about the answers of a student never flushed
+           before.  Neither is it when the counter was evicted and restarted
+           from the clock, which makes the numbers jump by at least a
+           second's worth, far more than the flushes could fall behind.
+        """
+        if not flushed_seq or not last_seq:
+            return 0
+        num_dropped = last_seq - flushed_seq - len(answers)
+        if num_dropped <= 0 or num_dropped >= cls.SEQS_PER_SECOND:
+            return 0
+        return num_dropped
+
+    @classmethod
+    def flush_in_namespace(cls, namespace, email):
+        """Task queue callback that flushes a student's buffered answers."""
+        with common_utils.Namespace(namespace):
+            cls.flush_buffered_answers(email)
 
     @classmethod
-    def build_dict(cls, dict, data, user):
+    def merge_answers(cls, answers, legacy_answers):
+        """ Merges a legacy answers dict into an email-keyed one.
+
+            Both dicts take the form {unit_id: {lesson_id: {instance_id: {...}}}}.
+            Questions found only in the legacy dict are copied over.  For
+            questions found in both, the current answer and score are kept
+            and the attempts are added up.
+        """
+        for unit_id, legacy_unit in legacy_answers.items():
+            unit = answers.setdefault(unit_id, {})
+            for lesson_id, legacy_lesson in legacy_unit.items():
+                lesson = unit.setdefault(lesson_id, {})
+                for instance_id, legacy_attempt in legacy_lesson.items():
+                    if instance_id in lesson:
+                        lesson[instance_id]['attempts'] = (
+                            lesson[instance_id].get('attempts', 0) +
+                            legacy_attempt.get('attempts', 0))
+                    else:
+                        lesson[instance_id] = legacy_attempt
+        return answers
+
+    @classmethod
+    def build_dict(cls, dict, data, email, user_id, timestamp=None):
         """ Builds a dict for recording student performance on questions.
 
            The dict is indexed by student email and id and contains a complete
@@ -167,9 +342,7 @@ class StudentAnswersEntity(entities.BaseEntity):
            Should this be changed?
         """
         data_json = json.loads(data)
-        url = data_json['location']
-        unit_id =  str(url[url.find('unit=') + len('unit=') : url.find('&lesson=')])
-        lesson_id = str(url[ url.find('&lesson=') + len('&lesson=') : ])
+        unit_id, lesson_id = cls._parse_location(data_json)
         instance_id = data_json['instanceid']
         if 'answer' in data_json:           # Takes care of SA_questions? that are missing answer?
              answers = data_json['answer']
@@ -182,16 +355,24 @@ class StudentAnswersEntity(entities.BaseEntity):
             quid = data_json['quid']
         if not dict:
             dict = {}
-            dict['email'] = user.email()
-            dict['user_id'] = user.user_id()
-            dict['answers'] = cls.build_answers_dict(None, unit_id, lesson_id, instance_id, quid, answers, score, type)
+            dict['email'] = email
+            dict['user_id'] = user_id
+            dict['answers'] = cls.build_answers_dict(None, unit_id, lesson_id, instance_id, quid, answers, score, type, timestamp)
         else:
             answers_dict = dict['answers']
-            dict['answers'] = cls.build_answers_dict(answers_dict, unit_id, lesson_id, instance_id, quid, answers, score, type)
+            dict['answers'] = cls.build_answers_dict(answers_dict, unit_id, lesson_id, instance_id, quid, answers, score, type, timestamp)
         return dict
 
     @classmethod
-    def build_answers_dict(cls, answers_dict, unit_id, lesson_id, instance_id, quid, answers, score, type):
+    def _parse_location(cls, data_json):
+        """Returns the (unit_id, lesson_id) strings from the event's location URL."""
+        url = data_json['location']
+        unit_id =  str(url[url.find('unit=') + len('unit=') : url.find('&lesson=')])
+        lesson_id = str(url[ url.find('&lesson=') + len('&lesson=') : ])
+        return unit_id, lesson_id
+
+    @classmethod
+    def build_answers_dict(cls, answers_dict, unit_id, lesson_id, instance_id, quid, answers, score, type, timestamp=None):
         """ Builds the answers dict.
 
             Takes the form:
@@ -201,7 +382,8 @@ class StudentAnswersEntity(entities.BaseEntity):
             are sent to the client.
         """
 
-        timestamp = int((datetime.datetime.now() - datetime.datetime(1970, 1, 1)).total_seconds())
+        if timestamp is None:
+            timestamp = int((datetime.datetime.now() - datetime.datetime(1970, 1, 1)).total_seconds())
         attempt = {'question_id': quid, 'answers': answers, 'score': score, 
                    'attempts': 1, 'question_type':type, 'timestamp': timestamp,
                    # Not sure whether the rest are needed
@@ -235,19 +417,39 @@ class StudentAnswersEntity(entities.BaseEntity):
         return answers_dict
 
     @classmethod
-    def get_answers_dict_for_student(cls, student):
-        """ Retrieve the answers dict for a student. """
+    def get_answers_dict_for_student(cls, student, unit_ids=None):
+        """ Retrieve the answers dict for a student.
+
+            If unit_ids is given only those units are fetched and returned.
+        """
         email = student.email
         if GLOBAL_DEBUG:
             logging.warning('***RAM*** get answers dict for student, email = ' + email)
-        key = db.Key.from_path('StudentAnswersEntity', email)
+        key = db.Key.from_path(cls.kind(), email)
         if GLOBAL_DEBUG:
             logging.debug('***RAM*** email ' + email + ' key = ' + str(key))
-        student_answers = db.get(key)
-        dict = {}
-        if student_answers:
-            dict = json.loads(student_answers.answers_dict)
-        return dict
+        if unit_ids is not None:
+            unit_ids = [str(unit_id) for unit_id in unit_ids]
+        student_answers, units = cls._get_units(key, unit_ids)
+        answers_dict = cls._to_answers_dict(student_answers, units, unit_ids)
+
+        # Include the answers still waiting in the buffer
+        flushed_seq = student_answers.flushed_seq if student_answers else 0
+        _, answers = cls._get_buffered_answers(email, flushed_seq)
+        if answers:
+            answers_dict = cls._filter_units(
+                cls._apply_answers(answers_dict, email, answers), unit_ids)
+        return answers_dict or {}
+
+    @classmethod
+    def get_unit_answers_for_request(cls, student, unit_id):
+        """Like get_answers_dict_for_student() for one unit, loaded once per request.
+
+           Progress rollups check the status of every component of a lesson
+           or unit, so the same answers would otherwise be fetched and
+           decoded once per component.  The result must not be changed.
+        """
+        return RequestScopedStudentAnswers.instance().get(student, unit_id)
 
     def put(self):
         """Do the normal put() and also invalidate memcache."""
@@ -256,7 +458,152 @@ class StudentAnswersEntity(entities.BaseEntity):
         return result
 
     def delete(self):
-        """Do the normal delete() and invalidate memcache."""
+        """Do the normal delete(), also of the units, and invalidate memcache."""
+        entities.delete(StudentUnitAnswersEntity.all(keys_only=True).ancestor(self.key()).fetch(1000))
         super(StudentAnswersEntity, self).delete()
         MemcacheManager.delete(self.memcache_key)
+        RequestScopedStudentAnswers.instance().forget(self.email)
+
+
+class RequestScopedStudentAnswers(caching.RequestScopedSingleton):
+
+    """The units of students' answers already loaded during the current request.
+
+       Entries are dropped whenever the student's answers are recorded or
+       stored, so a status check made after an answer in the same request
+       sees it.
+    """
+
+    def __init__(self):
+        self.answers = {}
+        self.num_fetches = 0
+
+    def get(self, student, unit_id):
+        key = (MemcacheManager.get_namespace(), student.email, str(unit_id))
+        if key in self.answers:
+            ANSWERS_FETCH_REUSED.inc()
+            return self.answers[key]
+        ANSWERS_FETCH.inc()
+        self.num_fetches += 1
+        if GLOBAL_DEBUG:
+            logging.debug('***RAM*** answers fetch #' + str(self.num_fetches) +
+                          ' in this request: ' + str(key))
+        answers = StudentAnswersEntity.get_answers_dict_for_student(
+            student, unit_ids=[unit_id])
+        self.answers[key] = answers
+        return answers
+
+    def forget(self, email):
+        namespace = MemcacheManager.get_namespace()
+        for key in self.answers.keys():
+            if key[0] == namespace and key[1] == email:
+                del self.answers[key]
+
+
+class StudentUnitAnswersEntity(entities.BaseEntity):
+
+    """One unit of a student's answers, stored as a child of their StudentAnswersEntity.
+
+       Keeping each unit in its own small entity means recording an answer only
+       rewrites that unit, and a dashboard view fetches just the units it shows.
+       The key name is the unit_id and the answers are stored as compact json:
+
+          {lesson_id: {instance_id: [question_id, answers, score, attempts, question_type, timestamp]}}
+
+       The constant fields of an attempt are filled back in by get_lessons().
+    """
+    answers = db.TextProperty(indexed=False)   #json string
+
+    ATTEMPT_FIELDS = ('question_id', 'answers', 'score', 'attempts', 'question_type', 'timestamp')
+
+    @classmethod
+    def make_key(cls, parent_key, unit_id):
+        return db.Key.from_path(cls.kind(), str(unit_id), parent=parent_key)
+
+    def get_lessons(self):
+        """Returns {lesson_id: {instance_id: attempt}} in the answers_dict format."""
+        lessons = {}
+        if not self.answers:
+            return lessons
+        unit_id = self.key().name()
+        for lesson_id, attempts in json.loads(self.answers).items():
+            lesson = {}
+            for instance_id, values in attempts.items():
+                attempt = dict(zip(self.ATTEMPT_FIELDS, values))
+                attempt.update({'weighted_score': 1, 'lesson_id': lesson_id, 'unit_id': unit_id,
+                                'possible_points': 1, 'tallied': False})
+                lesson[instance_id] = attempt
+            lessons[lesson_id] = lesson
+        return lessons
+
+    def set_lessons(self, lessons):
+        compact = {}
+        for lesson_id, attempts in lessons.items():
+            compact[lesson_id] = dict(
+                [(instance_id, [attempt.get(field) for field in self.ATTEMPT_FIELDS])
+                 for instance_id, attempt in attempts.items()])
+        self.answers = json.dumps(compact, separators=(',', ':'))
+
+
+class StudentAnswersMigrationJob(jobs.DurableJob):
+    """Moves the legacy numeric-key StudentAnswersEntities to email keys.
+
+       Each legacy entity is merged into the student's email-keyed entity,
+       which is created if needed and stored one unit per child entity, and
+       then deleted.  After this has run,
+       StudentAnswersEntity.record() never has to query by email.
+    """
+
+    @staticmethod
+    def get_description():
+        return 'student answers migration'
+
+    def run(self):
+        counts = {'moved': 0, 'merged': 0}
+
+        def migrate(legacy_key):
+            """Merges one legacy entity; returns 'moved', 'merged' or None.
+
+               The legacy entity is read again, and deleted, in the same
+               transaction that stores the merged answers, so a retry can
+               never add its attempts twice, and a concurrent flush of
+               buffered answers either sees the merged entity or makes this
+               transaction retry with its flushed_seq.
+            """
+            legacy = entities.get(legacy_key)
+            if not legacy:
+                return None    # Migrated by an earlier try
+            key = db.Key.from_path(StudentAnswersEntity.kind(), legacy.email)
+            student, units = StudentAnswersEntity._get_units(key)
+            legacy_dict = json.loads(legacy.answers_dict or '{}')
+            legacy_dict.setdefault('answers', {})
+            if student:
+                answers_dict = StudentAnswersEntity._to_answers_dict(student, units)
+                answers_dict['answers'] = StudentAnswersEntity.merge_answers(
+                    answers_dict.get('answers', {}), legacy_dict['answers'])
+                outcome = 'merged'
+            else:
+                student = StudentAnswersEntity(key_name=legacy.email)
+                student.user_id = legacy.user_id
+                student.email = legacy.email
+                student.recorded_on = legacy.recorded_on
+                answers_dict = legacy_dict
+                outcome = 'moved'
+            StudentAnswersEntity._store_answers(
+                student, units, answers_dict, answers_dict['answers'].keys())
+            legacy.delete()
+            return outcome
+
+        def map_fn(legacy):
+            if not legacy.email or legacy.key().name() == legacy.email:
+                return    # Already email-keyed
+            outcome = db.run_in_transaction_options(
+                db.create_transaction_options(xg=True), migrate, legacy.key())
+            if outcome:
+                counts[outcome] += 1
+            if GLOBAL_DEBUG:
+                logging.debug('***RAM*** migrated answers for ' + legacy.email)
 
+        models_utils.QueryMapper(
+            StudentAnswersEntity.all(), batch_size=100, report_every=1000).run(map_fn)
+        return counts
@@ -0,0 +1,94 @@
+# Copyright 2016 Mobile CSP Project. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Contains the StudentScoresEntity
+
+import datetime
+import logging
+
+from google.appengine.ext import db
+
+from models import entities
+from models import transforms
+
+GLOBAL_DEBUG = False
+
+class StudentScoresEntity(entities.BaseEntity):
+
+    """A per-student table of the scores and attempts shown on the Student Dashboard.
+
+       The table holds the same data that ActivityScoreParser extracts from
+       the tag-assessment EventEntities, i.e., before build_missing_scores()
+       fills in the questions the student has not attempted:
+
+          scores =   {unit_id: {lesson_id: {sequence: question_answer_dict}}}
+          attempts = {question_id: num_attempts}
+
+       It is kept up to date one event at a time by record_tag_assessment()
+       so the dashboard reads a single entity instead of scanning the
+       event log.  Like StudentAnswersEntity, the student's email is the key.
+    """
+    updated_on = db.DateTimeProperty(indexed=True)
+    user_id = db.StringProperty(indexed=True)
+    email = db.StringProperty(indexed=True)
+    scores = db.TextProperty(indexed=False)     # json string
+    attempts = db.TextProperty(indexed=False)   # json string
+
+    @classmethod
+    def get_by_emails(cls, emails):
+        """Returns a dict email -> StudentScoresEntity using a single multi-get."""
+        if not emails:
+            return {}
+        rows = entities.get(
+            [db.Key.from_path(cls.kind(), email) for email in emails])
+        return dict([(row.email, row) for row in rows if row])
+
+    @classmethod
+    def make(cls, user_id, email):
+        entity = cls(key_name=email)
+        entity.user_id = user_id
+        entity.email = email
+        entity.set_scores({}, {})
+        return entity
+
+    @classmethod
+    def _int_keys(cls, adict, depth):
+        """Restores the integer unit, lesson and sequence keys lost by JSON."""
+        if depth == 0 or not isinstance(adict, dict):
+            return adict
+        result = {}
+        for key, value in adict.iteritems():
+            try:
+                key = int(key)
+            except ValueError:
+                pass
+            result[key] = cls._int_keys(value, depth - 1)
+        return result
+
+    def get_scores(self):
+        if not self.scores:
+            return {}
+        return self._int_keys(transforms.loads(self.scores), 3)
+
+    def get_attempts(self):
+        if not self.attempts:
+            return {}
+        return transforms.loads(self.attempts)
+
+    def set_scores(self, scores, attempts):
+        self.scores = transforms.dumps(scores)
+        self.attempts = transforms.dumps(attempts)
+        self.updated_on = datetime.datetime.now()
+        if GLOBAL_DEBUG:
+            logging.debug('***RAM*** scores table for ' + str(self.email) + ' = ' + self.scores)
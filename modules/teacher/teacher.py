@@ -34,8 +34,10 @@ from common import tags
 from common import utils as common_utils
 from common import schema_fields
 from common import jinja_utils
+from controllers import sites
 from controllers import utils
 from models import resources_display
+from models import courses
 from models import custom_modules
 from models import entities
 from models import models
@@ -45,12 +47,15 @@ from models import utils as models_utils
 from models.models import MemcacheManager
 from models.models import Student
 from models.models import EventEntity
+from models.progress import UnitLessonCompletionTracker
 from modules.teacher import messages
 from modules.dashboard import dashboard
 from modules.oeditor import oeditor
 
 from google.appengine.ext import db
+from google.appengine.api import memcache
 from google.appengine.api import users
+from google.appengine.ext import deferred
 
 # Our modules classes
 from course_entity import CourseSectionEntity
@@ -59,7 +64,10 @@ from teacher_entity import TeacherEntity
 from teacher_entity import TeacherItemRESTHandler
 from teacher_entity import TeacherRights
 from student_activites import ActivityScoreParser
+from student_activites import ActivityScoresRebuildJob
 from student_answers import StudentAnswersEntity
+from student_answers import StudentAnswersMigrationJob
+from section_roster import SectionRosterEntity
 
 GLOBAL_DEBUG = False
 
@@ -77,6 +85,9 @@ STUDENT_ROSTER_TEMPLATE = os.path.join(TEMPLATE_DIR, 'student_roster.html')
 STUDENT_DASHBOARD_TEMPLATE = os.path.join(TEMPLATE_DIR, 'student_dashboard.html')
 QUESTION_PREVIEW_TEMPLATE = os.path.join(TEMPLATE_DIR, 'question_preview.html')
 
+# How long after a student's progress changes their sections' rosters are refreshed
+ROSTER_REFRESH_DELAY_SECS = 60
+
 class TeacherHandlerMixin(object):
     def get_admin_action_url(self, action, key=None):
         args = {'action': action}
@@ -131,6 +142,14 @@ class TeacherHandlerMixin(object):
                 AdminDashboardHandler.ADMIN_ADD_ACTION)
             output['add_action'] = self.get_admin_action_url(
                 AdminDashboardHandler.ADMIN_ADD_ACTION)
+            output['rebuild_scores_xsrf_token'] = self.create_xsrf_token(
+                AdminDashboardHandler.ADMIN_REBUILD_SCORES_ACTION)
+            output['rebuild_scores_action'] = self.get_admin_action_url(
+                AdminDashboardHandler.ADMIN_REBUILD_SCORES_ACTION)
+            output['migrate_answers_xsrf_token'] = self.create_xsrf_token(
+                AdminDashboardHandler.ADMIN_MIGRATE_ANSWERS_ACTION)
+            output['migrate_answers_action'] = self.get_admin_action_url(
+                AdminDashboardHandler.ADMIN_MIGRATE_ANSWERS_ACTION)
 
         return output
 
@@ -186,8 +205,220 @@ class TeacherHandlerMixin(object):
                 AdminDashboardHandler.ADMIN_LIST_ACTION)
         return output
 
+class RosterMixin(object):
+
+    """ Computes the student progress data shown on the Roster and Student Dashboard.
+
+        These methods only need the course, so they are shared by
+        TeacherDashboardHandler and by the background task that refreshes
+        the section roster snapshots.
+    """
+
+    def get_lessons_for_roster(self, units, course):
+        lessons = {}
+        for unit in units:
+            unit_lessons = course.get_lessons(unit.unit_id)
+            unit_lessons_filtered = []
+            for lesson in unit_lessons:
+                unit_lessons_filtered.append({
+                    'title': lesson.title,
+                    'unit_id': lesson.unit_id,
+                    'lesson_id': lesson.lesson_id
+                })
+            lessons[unit.unit_id] = unit_lessons_filtered
+        
+        # Convert to JSON
+        return transforms.dumps(lessons, {}) 
+
+    def calculate_lessons_progress(self, lessons_progress):
+        """ Returns a dict summarizing student progress on the lessons in each unit."""
+
+        if GLOBAL_DEBUG:
+            logging.debug('***RAM*** lessons_progress ' + str(lessons_progress))
+        lessons = {}
+        total = 0
+        for key in lessons_progress:
+            progress = lessons_progress[key]['html']
+            if  progress == 2:  # 2=complete, 1= inprogress, 0=unstarted
+                total += 1
+            lessons[str(key)] = progress
+        lessons['progress'] = str(round(total / len(lessons) * 100, 2))
+        if GLOBAL_DEBUG:
+            logging.debug('***RAM*** calc lessons = ' + str(lessons))
+        return lessons
+                            
+    def calculate_student_progress_data(self, student, course, tracker, units, progress=None,
+                                        completion=None):
+        """ Returns a dict that summarizes student progress for course, units, and lessons.
+
+           The dict takes the form: {'course_progress': c, 'unit_completion': u, 'lessons_progress': p}
+           where 'course_progress' is a number giving the overall percentage of lessons completed
+           as calculated by GCB, 'unit_completion' gives the completion percentage of each unit, 
+           as calculated by GCB, and 'lessons_progress', gives a summary of the lesson progress
+           for each unit, as calculated by us.
+
+           If the student's progress entity has already been loaded, pass it
+           in as progress so that no datastore calls are made.  If the whole
+           section's progress has been computed with get_completion_matrix(),
+           pass the (matrix, row) of this student in as completion instead.
+        """
+
+        if completion:
+            matrix, row = completion
+            unit_progress_raw = matrix.get_unit_percent_complete(row)
+        else:
+            # An object that summarizes student progress
+            if progress is None:
+                progress = tracker.get_or_create_progress(student)
+            student_progress = progress
+            if GLOBAL_DEBUG:
+                logging.debug('***RAM*** student_progress ' + str(student_progress))
+
+            # Progress on each unit in the course -- an unitid index dict
+            unit_progress_raw = tracker.get_unit_percent_complete(student, student_progress)
+        unit_progress_data = {}
+        for key in unit_progress_raw:
+            unit_progress_data[str(key)] = str(round(unit_progress_raw[key] * 100,2));
+        if GLOBAL_DEBUG:
+            logging.debug('***RAM*** unit_progress_data ' + str(unit_progress_data))
+
+        # Overall progress in the course -- a per cent, rounded to 3 digits
+        course_progress = 0
+        for value in unit_progress_raw.values():
+            course_progress += value
+        course_progress = str(round(course_progress / len(unit_progress_data) * 100,2))
+
+        # Progress on each lesson in the coure -- a tuple-index dict:  dict[(unitid,lessonid)] 
+        units_lessons_progress = {}
+        for unit in units:
+            if GLOBAL_DEBUG:
+                logging.debug('***RAM*** unit = ' + str(unit.unit_id))
+            # Don't show assessments that are part of unit
+            if course.get_parent_unit(unit.unit_id):
+                continue
+            if unit.unit_id in unit_progress_raw:
+                if completion:
+                    lessons_progress = matrix.get_lesson_progress(row, unit.unit_id)
+                else:
+                    lessons_progress = tracker.get_lesson_progress(student, unit.unit_id, student_progress)
+                if GLOBAL_DEBUG:
+                    logging.debug('***RAM*** lesson_status = ' + str(lessons_progress))
+                units_lessons_progress[str(unit.unit_id)] = self.calculate_lessons_progress(lessons_progress)
+        return {'unit_completion':unit_progress_data, 'course_progress':course_progress, 'lessons_progress': units_lessons_progress }
+
+    def retrieve_student_scores_and_attempts(self, student_email, course):
+        scores = {}
+
+        student = Student.get_first_by_email(student_email)[0]  # returns a tuple
+
+        scores = ActivityScoreParser.get_student_scores(student, course)
+        if GLOBAL_DEBUG:
+            logging.debug('***RAM*** get activity scores ' + str(scores))
+      
+        return scores
+
+    def calculate_performance_ratio(self, aggregate_scores, email): 
+        if email not in aggregate_scores.keys():
+            return aggregate_scores         
+        scores = aggregate_scores[email]
+        for unit in scores:
+            for lesson in scores[unit]:
+                n_questions = 0
+                n_correct = 0
+                for quest in scores[unit][lesson]:
+                    n_questions += 1
+                    n_correct += scores[unit][lesson][quest]['score']
+                scores[unit][lesson]['ratio'] = str(n_correct) + "/" + str(n_questions)
+        return scores
+
+    def get_students_by_emails(self, emails):
+        """ Returns a dict email -> Student for the given emails in a few RPCs.
+
+            This is a batched version of Student.get_first_by_email().  Legacy
+            Students are keyed by email, so a single multi-get is tried first.
+            The email queries for the remaining students are then all started
+            before any of their results are read, so they run in parallel.
+        """
+        students = {}
+        if not emails:
+            return students
+        for email, student in zip(emails, Student.get_by_key_name(emails)):
+            if student:
+                students[email] = student
+
+        queries = []
+        for email in emails:
+            if email not in students:
+                queries.append((email, Student.all().filter(
+                    Student.email.name, email).run(limit=1)))
+        for email, results in queries:
+            for student in results:
+                students[email] = student
+        return students
+
+    def create_student_table(self, email, course, tracker, units, get_scores=False,
+                             student=None, progress=None, completion=None):
+        student_dict = {}
+        if not student:
+            student = Student.get_first_by_email(email)[0]  # returns a tuple
+        if student:
+            progress_dict = self.calculate_student_progress_data(
+                student, course, tracker, units, progress, completion)
+            if get_scores:
+                scores = self.retrieve_student_scores_and_attempts(email, course)
+                student_dict['attempts'] = scores['attempts']
+#                    student_dict['scores'] = scores['scores']
+                student_dict['scores'] = self.calculate_performance_ratio(scores['scores'], email)
+            student_dict['name'] = student.name
+            student_dict['email'] = student.email
+            student_dict['progress_dict'] = progress_dict
+            student_dict['has_scores'] = get_scores
+        return student_dict
+
+    def create_student_data_table(self, course, section, tracker, units, student_email = None):
+        """ Creates a lookup table containing all student progress data 
+            for every unit, lesson, and quiz. 
+        """
+        # If called from get_student_dashboad to get stats for a single student
+        if student_email:
+            return self.create_student_table(student_email, course, tracker, units, get_scores=True)
+
+        if section.students:
+            index = [email for email in section.students.split(',') if email]   # comma-delimited emails
+        else:
+            index = []
+
+        if GLOBAL_DEBUG:
+            logging.debug('***RAM*** students index : ' + str(index))
+
+        # Fetch every student and their progress up front in a few batched
+        #  RPCs, then compute the whole section's progress in one pass.
+        students_by_email = self.get_students_by_emails(index)
+        section_students = [students_by_email[email] for email in index
+                            if email in students_by_email]
+        matrix = tracker.get_completion_matrix(
+            section_students,
+            tracker.get_progress_multi(students_by_email.values()))
+
+        students = []
+        for row, student in enumerate(section_students):
+            student_dict = self.create_student_table(student.email, course, tracker, units,
+                get_scores=False, student=student, completion=(matrix, row))
+            if student_dict:
+                students.append(student_dict)
+        return students
+
+    def refresh_roster_snapshot(self, course, section, section_key):
+        """ Recomputes the Roster data for a section and stores it as a snapshot."""
+        tracker = course.get_progress_tracker()
+        units = filter(lambda x: x.type == 'U', course.get_units()) #filter out assessments
+        lessons = self.get_lessons_for_roster(units, course)
+        students = self.create_student_data_table(course, section, tracker, units)
+        return SectionRosterEntity.save_snapshot(
+            section_key, SectionRosterEntity.get_roster_version(lessons, section), students)
+
 class TeacherDashboardHandler(
-        TeacherHandlerMixin, utils.BaseHandler,
+        TeacherHandlerMixin, RosterMixin, utils.BaseHandler,
         utils.ReflectiveRequestHandler):
 
     """  Handle all Teacher (non-Admin) functions for the Teacher Dashboard.
@@ -383,6 +614,7 @@ class TeacherDashboardHandler(
         entity = CourseSectionEntity.get(key)
         if entity:
             entity.delete()
+            SectionRosterEntity.delete_for_section(key)
         self.redirect('/{}'.format(self.DASHBOARD_LIST_URL))
 
     def _get_delete_url(self, base_url, key, xsrf_token_name):
@@ -394,148 +626,6 @@ class TeacherDashboardHandler(
                     self.create_xsrf_token(xsrf_token_name)),
             }))
 
-    def get_lessons_for_roster(self, units, course):
-        lessons = {}
-        for unit in units:
-            unit_lessons = course.get_lessons(unit.unit_id)
-            unit_lessons_filtered = []
-            for lesson in unit_lessons:
-                unit_lessons_filtered.append({
-                    'title': lesson.title,
-                    'unit_id': lesson.unit_id,
-                    'lesson_id': lesson.lesson_id
-                })
-            lessons[unit.unit_id] = unit_lessons_filtered
-        
-        # Convert to JSON
-        return transforms.dumps(lessons, {}) 
-
-    def calculate_lessons_progress(self, lessons_progress):
-        """ Returns a dict summarizing student progress on the lessons in each unit."""
-
-        if GLOBAL_DEBUG:
-            logging.debug('***RAM*** lessons_progress ' + str(lessons_progress))
-        lessons = {}
-        total = 0
-        for key in lessons_progress:
-            progress = lessons_progress[key]['html']
-            if  progress == 2:  # 2=complete, 1= inprogress, 0=unstarted
-                total += 1
-            lessons[str(key)] = progress
-        lessons['progress'] = str(round(total / len(lessons) * 100, 2))
-        if GLOBAL_DEBUG:
-            logging.debug('***RAM*** calc lessons = ' + str(lessons))
-        return lessons
-                            
-    def calculate_student_progress_data(self, student, course, tracker, units):
-        """ Returns a dict that summarizes student progress for course, units, and lessons.
-
-           The dict takes the form: {'course_progress': c, 'unit_completion': u, 'lessons_progress': p}
-           where 'course_progress' is a number giving the overall percentage of lessons completed
-           as calculated by GCB, 'unit_completion' gives the completion percentage of each unit, 
-           as calculated by GCB, and 'lessons_progress', gives a summary of the lesson progress
-           for each unit, as calculated by us.
-        """
-
-        # Progress on each unit in the course -- an unitid index dict
-        unit_progress_raw = tracker.get_unit_percent_complete(student)
-        unit_progress_data = {}
-        for key in unit_progress_raw:
-            unit_progress_data[str(key)] = str(round(unit_progress_raw[key] * 100,2));
-        if GLOBAL_DEBUG:
-            logging.debug('***RAM*** unit_progress_data ' + str(unit_progress_data))
-
-        # An object that summarizes student progress
-        student_progress = tracker.get_or_create_progress(student)
-        if GLOBAL_DEBUG:
-            logging.debug('***RAM*** student_progress ' + str(student_progress))
-
-        # Overall progress in the course -- a per cent, rounded to 3 digits
-        course_progress = 0
-        for value in unit_progress_raw.values():
-            course_progress += value
-        course_progress = str(round(course_progress / len(unit_progress_data) * 100,2))
-
-        # Progress on each lesson in the coure -- a tuple-index dict:  dict[(unitid,lessonid)] 
-        units_lessons_progress = {}
-        for unit in units:
-            if GLOBAL_DEBUG:
-                logging.debug('***RAM*** unit = ' + str(unit.unit_id))
-            # Don't show assessments that are part of unit
-            if course.get_parent_unit(unit.unit_id):
-                continue
-            if unit.unit_id in unit_progress_raw:
-                lessons_progress = tracker.get_lesson_progress(student, unit.unit_id, student_progress)
-                if GLOBAL_DEBUG:
-                    logging.debug('***RAM*** lesson_status = ' + str(lessons_progress))
-                units_lessons_progress[str(unit.unit_id)] = self.calculate_lessons_progress(lessons_progress)
-        return {'unit_completion':unit_progress_data, 'course_progress':course_progress, 'lessons_progress': units_lessons_progress }
-
-    def retrieve_student_scores_and_attempts(self, student_email, course):
-        scores = {}
-
-        student = Student.get_first_by_email(student_email)[0]  # returns a tuple
-
-        scores = ActivityScoreParser.get_activity_scores([student.user_id], course, True)
-        if GLOBAL_DEBUG:
-            logging.debug('***RAM*** get activity scores ' + str(scores))
-      
-        return scores
-
-    def calculate_performance_ratio(self, aggregate_scores, email): 
-        if email not in aggregate_scores.keys():
-            return aggregate_scores         
-        scores = aggregate_scores[email]
-        for unit in scores:
-            for lesson in scores[unit]:
-                n_questions = 0
-                n_correct = 0
-                for quest in scores[unit][lesson]:
-                    n_questions += 1
-                    n_correct += scores[unit][lesson][quest]['score']
-                scores[unit][lesson]['ratio'] = str(n_correct) + "/" + str(n_questions)
-        return scores
-
-    def create_student_table(self, email, course, tracker, units, get_scores=False):
-        student_dict = {}
-        student = Student.get_first_by_email(email)[0]  # returns a tuple
-        if student:
-            progress_dict = self.calculate_student_progress_data(student,course,tracker,units)
-            if get_scores:
-                scores = self.retrieve_student_scores_and_attempts(email, course)
-                student_dict['attempts'] = scores['attempts']
-#                    student_dict['scores'] = scores['scores']
-                student_dict['scores'] = self.calculate_performance_ratio(scores['scores'], email)
-            student_dict['name'] = student.name
-            student_dict['email'] = student.email
-            student_dict['progress_dict'] = progress_dict
-            student_dict['has_scores'] = get_scores
-        return student_dict
-
-    def create_student_data_table(self, course, section, tracker, units, student_email = None):
-        """ Creates a lookup table containing all student progress data 
-            for every unit, lesson, and quiz. 
-        """
-        # If called from get_student_dashboad to get stats for a single student
-        if student_email:
-            return self.create_student_table(student_email, course, tracker, units, get_scores=True)
-
-        if section.students:
-            index = section.students.split(',')   # comma-delimited emails
-        else:
-            index = []
-
-        if GLOBAL_DEBUG:
-            logging.debug('***RAM*** students index : ' + str(index))
-
-        students = []
-        if len(index) > 0:
-            for email in index:
-                student_dict = self.create_student_table(email, course, tracker, units, get_scores=False)
-                if student_dict:
-                    students.append(student_dict)
-        return students
-
     def get_display_roster(self):
         """Callback method to display the Roster view. 
 
@@ -543,6 +633,10 @@ class TeacherDashboardHandler(
            from the main Teacher Dashboard page.  It displays all students 
            in a single course section and their progress in the course.
            Also allows the teacher to manage the section.
+
+           The progress data comes from the section's roster snapshot, which
+           is refreshed in the background as students make progress.  Passing
+           refresh=true recomputes it now.
         """
         key = self.request.get('key')
         course_section = CourseSectionEntity.get(key)
@@ -558,8 +652,15 @@ class TeacherDashboardHandler(
         # And lessons
         lessons = self.get_lessons_for_roster(units_filtered, this_course)
 
-        # Get students and progress data for this section 
-        students = self.create_student_data_table(this_course, course_section, tracker, units_filtered)
+        # Get students and progress data for this section, from the snapshot if it's current
+        roster_version = SectionRosterEntity.get_roster_version(lessons, course_section)
+        snapshot = None
+        if not self.request.get('refresh'):
+            snapshot = SectionRosterEntity.get_snapshot(key, roster_version)
+        if not snapshot:
+            students = self.create_student_data_table(this_course, course_section, tracker, units_filtered)
+            snapshot = SectionRosterEntity.save_snapshot(key, roster_version, students)
+        students = snapshot.get_students()
 
         if GLOBAL_DEBUG:
             logging.debug('***RAM*** Units  : ' + str(units_filtered))
@@ -573,6 +674,7 @@ class TeacherDashboardHandler(
         self.template_value['lessons'] = lessons 
         self.template_value['students'] = students
         self.template_value['students_json'] = transforms.dumps(students, {})  # for use with javascript
+        self.template_value['roster_updated_on'] = snapshot.updated_on.strftime('%Y-%m-%d %H:%M UTC')
 
         self._render_roster()
 
@@ -619,10 +721,13 @@ class AdminDashboardHandler(TeacherHandlerMixin, dashboard.DashboardHandler):
     ADMIN_EDIT_ACTION = 'edit_teacher'
     ADMIN_DELETE_ACTION = 'delete_teacher'
     ADMIN_ADD_ACTION = 'add_teacher'
+    ADMIN_REBUILD_SCORES_ACTION = 'rebuild_scores'
+    ADMIN_MIGRATE_ANSWERS_ACTION = 'migrate_answers'
 
     # Not sure what these do?
     get_actions = [ADMIN_EDIT_ACTION, ADMIN_LIST_ACTION]
-    post_actions = [ADMIN_ADD_ACTION, ADMIN_DELETE_ACTION]
+    post_actions = [ADMIN_ADD_ACTION, ADMIN_DELETE_ACTION, ADMIN_REBUILD_SCORES_ACTION,
+                    ADMIN_MIGRATE_ANSWERS_ACTION]
 
     ADMIN_LINK_URL = 'mcsp_admin'
     URL = '/{}'.format(ADMIN_LINK_URL)
@@ -722,6 +827,28 @@ class AdminDashboardHandler(TeacherHandlerMixin, dashboard.DashboardHandler):
         self.redirect(self.get_admin_action_url(
             self.ADMIN_EDIT_ACTION, key=entity.key()))
 
+    def post_rebuild_scores(self):
+        """Starts a job that rebuilds the students' activity scores table."""
+        if not TeacherRights.can_edit(self):
+            self.error(401)
+            return
+
+        if GLOBAL_DEBUG:
+            logging.debug('***RAM** post_rebuild_scores')
+        ActivityScoresRebuildJob(self.app_context).submit()
+        self.redirect('/{}'.format(self.ADMIN_LIST_URL))
+
+    def post_migrate_answers(self):
+        """Starts a job that moves legacy student answers to email keys."""
+        if not TeacherRights.can_edit(self):
+            self.error(401)
+            return
+
+        if GLOBAL_DEBUG:
+            logging.debug('***RAM** post_migrate_answers')
+        StudentAnswersMigrationJob(self.app_context).submit()
+        self.redirect('/{}'.format(self.ADMIN_LIST_URL))
+
     def _get_delete_url(self, base_url, key, xsrf_token_name):
         return '%s?%s' % (
             self.canonicalize_url(base_url),
@@ -745,9 +872,46 @@ def record_tag_assessment(source, user, data):
 
     if source == 'tag-assessment':
         StudentAnswersEntity.record(user, data)
+        app_context = sites.get_course_for_current_request()
+        if app_context:
+            ActivityScoreParser.record_activity_score(app_context, user, data)
         if GLOBAL_DEBUG:
             logging.debug('***RAM*** data = ' + str(data))
 
+def schedule_roster_refresh(course, student, progress, event_entity, event_key):
+    """ Callback function when a student's progress is updated.
+
+        Schedules a background refresh of the roster snapshot of every
+        section the student belongs to.  A memcache flag makes sure that
+        a burst of progress events results in one refresh per section.
+    """
+    try:
+        if not student.email:
+            return
+        namespace = course.app_context.get_namespace_name()
+        section_keys = CourseSectionEntity.get_section_keys_by_student().get(
+            student.email, [])
+        for section_key in section_keys:
+            # The flag expires before the refresh runs, so progress made
+            # after the refresh has read it schedules another one.
+            if memcache.add('sectionroster:pending:%s' % section_key, True,
+                            time=ROSTER_REFRESH_DELAY_SECS / 2,
+                            namespace=MemcacheManager.get_namespace()):
+                deferred.defer(refresh_roster_snapshot, namespace, section_key,
+                               _countdown=ROSTER_REFRESH_DELAY_SECS)
+    except Exception:  # On purpose. pylint: disable=broad-except
+        logging.exception('Failed to schedule roster refresh for %s', student.email)
+
+def refresh_roster_snapshot(namespace, section_key):
+    """ Task queue callback that recomputes a section's roster snapshot."""
+    with common_utils.Namespace(namespace):
+        app_context = sites.get_app_context_for_namespace(namespace)
+        section = CourseSectionEntity.get(section_key)
+        if not app_context or not section:
+            return
+        course = courses.Course(None, app_context=app_context)
+        RosterMixin().refresh_roster_snapshot(course, section, section_key)
+
 def notify_module_enabled():
     """Handles things after module has been enabled.
 
@@ -759,6 +923,8 @@ def notify_module_enabled():
        data.
     """
     EventEntity.EVENT_LISTENERS.append(record_tag_assessment)
+    UnitLessonCompletionTracker.POST_UPDATE_PROGRESS_HOOK.append(
+        schedule_roster_refresh)
 
 custom_module = None
 
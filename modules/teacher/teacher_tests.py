@@ -0,0 +1,292 @@
+# Copyright 2016 Mobile CSP Project. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Functional tests for the teacher module."""
+
+__author__ = 'ram8647@gmail.com'
+
+import datetime
+import json
+
+from common import utils as common_utils
+from google.appengine.ext import db
+from models import config
+from models import courses
+from models import models
+from modules.teacher import student_activites
+from modules.teacher import student_answers
+from modules.teacher import teacher
+from modules.teacher.course_entity import CourseSectionEntity
+from modules.teacher.section_roster import SectionRosterEntity
+from modules.teacher.student_activites import ActivityScoreParser
+from modules.teacher.student_answers import StudentAnswersEntity
+from modules.teacher.student_scores import StudentScoresEntity
+from tests.functional import actions
+
+COURSE_NAME = 'teacher_course'
+ADMIN_EMAIL = 'admin@example.com'
+NAMESPACE = 'ns_%s' % COURSE_NAME
+STUDENT_EMAIL = 'student@example.com'
+QUIZLY_ID = 'LXgF4NO50hNM'
+
+
+def make_answer(unit_id, lesson_id, instance_id, score=1):
+    """Returns the data of a tag-assessment event, as record() gets it."""
+    return json.dumps({
+        'location': 'unit?unit=%s&lesson=%s' % (unit_id, lesson_id),
+        'instanceid': instance_id, 'quid': 'q-%s' % instance_id,
+        'answer': [0], 'score': score, 'type': 'McQuestion'})
+
+
+def make_quizly_answer(score=1):
+    """Returns the data of a Quizly exercise's tag-assessment event."""
+    return json.dumps({
+        'location': 'unit?unit=2&lesson=3', 'instanceid': QUIZLY_ID,
+        'answer': True, 'score': score, 'type': 'SaQuestion'})
+
+
+def make_attempt(attempts):
+    return {'question_id': 'q', 'answers': [0], 'score': 1,
+            'attempts': attempts, 'question_type': 'McQuestion',
+            'timestamp': 0}
+
+
+class BaseTeacherTests(actions.TestBase):
+
+    def setUp(self):
+        super(BaseTeacherTests, self).setUp()
+        self.app_context = actions.simple_add_course(
+            COURSE_NAME, ADMIN_EMAIL, 'Teacher Course')
+
+    def get_answers(self, email):
+        """Returns the student's stored answers in the answers_dict format."""
+        with common_utils.Namespace(NAMESPACE):
+            key = db.Key.from_path(StudentAnswersEntity.kind(), email)
+            student, units = StudentAnswersEntity._get_units(key)
+            answers_dict = StudentAnswersEntity._to_answers_dict(
+                student, units)
+        return answers_dict['answers'] if answers_dict else None
+
+
+class StudentAnswersMigrationTests(BaseTeacherTests):
+
+    def test_merge_answers_adds_up_attempts_of_common_questions(self):
+        answers = {'1': {'2': {'a': make_attempt(2)}}}
+        legacy = {'1': {'2': {'a': make_attempt(3), 'b': make_attempt(1)},
+                        '3': {'c': make_attempt(4)}}}
+        merged = StudentAnswersEntity.merge_answers(answers, legacy)
+        self.assertEquals(5, merged['1']['2']['a']['attempts'])
+        self.assertEquals(1, merged['1']['2']['b']['attempts'])
+        self.assertEquals(4, merged['1']['3']['c']['attempts'])
+
+    def test_job_moves_and_merges_legacy_answers_once(self):
+        with common_utils.Namespace(NAMESPACE):
+            StudentAnswersEntity._write_answers(
+                'a@example.com',
+                [('ua', make_answer(1, 2, 'a'), 0),
+                 ('ua', make_answer(1, 2, 'a'), 0)], last_seq=7)
+            for email, answers in [
+                    ('a@example.com', {'1': {'2': {'a': make_attempt(3)}}}),
+                    ('b@example.com', {'1': {'2': {'b': make_attempt(1)}}})]:
+                StudentAnswersEntity(
+                    email=email, user_id='legacy', answers_dict=json.dumps(
+                        {'email': email, 'answers': answers})).put()
+
+        # Running the job again, as a retry would, changes nothing.
+        for _ in xrange(2):
+            student_answers.StudentAnswersMigrationJob(
+                self.app_context).submit()
+            self.execute_all_deferred_tasks()
+
+            self.assertEquals(
+                5, self.get_answers('a@example.com')['1']['2']['a'][
+                    'attempts'])
+            self.assertEquals(
+                1, self.get_answers('b@example.com')['1']['2']['b'][
+                    'attempts'])
+            with common_utils.Namespace(NAMESPACE):
+                self.assertEquals(
+                    ['a@example.com', 'b@example.com'],
+                    sorted(key.name() for key in StudentAnswersEntity.all(
+                        keys_only=True)))
+                self.assertEquals(7, StudentAnswersEntity.get_by_key_name(
+                    'a@example.com').flushed_seq)
+
+
+class StudentAnswersBufferTests(BaseTeacherTests):
+
+    def setUp(self):
+        super(StudentAnswersBufferTests, self).setUp()
+        config.Registry.test_overrides[models.CAN_USE_MEMCACHE.name] = True
+        self.user = actions.login(STUDENT_EMAIL)
+
+    def tearDown(self):
+        del config.Registry.test_overrides[models.CAN_USE_MEMCACHE.name]
+        super(StudentAnswersBufferTests, self).tearDown()
+
+    def answer(self, num_answers=1):
+        with common_utils.Namespace(NAMESPACE):
+            for _ in xrange(num_answers):
+                StudentAnswersEntity.record(self.user, make_answer(1, 2, 'a'))
+
+    def get_attempts(self):
+        answers = self.get_answers(STUDENT_EMAIL)
+        return answers['1']['2']['a']['attempts'] if answers else None
+
+    def get_attempts_with_buffer(self):
+        student = models.Student(user_id=self.user.user_id(), email=STUDENT_EMAIL)
+        with common_utils.Namespace(NAMESPACE):
+            answers = StudentAnswersEntity.get_answers_dict_for_student(student)
+        return answers['answers']['1']['2']['a']['attempts']
+
+    def test_answers_are_buffered_until_flushed_once(self):
+        self.answer(3)
+        self.assertIsNone(self.get_attempts())
+        self.assertEquals(3, self.get_attempts_with_buffer())
+
+        self.execute_all_deferred_tasks()
+        self.assertEquals(3, self.get_attempts())
+
+        # The buffer still holds the answers, but they are never applied again.
+        self.assertEquals(3, self.get_attempts_with_buffer())
+        with common_utils.Namespace(NAMESPACE):
+            StudentAnswersEntity.flush_buffered_answers(STUDENT_EMAIL)
+        self.assertEquals(3, self.get_attempts())
+
+    def test_full_buffer_is_flushed_right_away(self):
+        self.swap(StudentAnswersEntity, 'MAX_BUFFERED_ANSWERS', 4)
+        self.answer()
+        self.assertEquals(1, len(self.taskq.GetTasks('default')))
+        self.answer()
+        self.assertEquals(2, len(self.taskq.GetTasks('default')))
+
+        self.execute_all_deferred_tasks()
+        self.assertEquals(2, self.get_attempts())
+
+    def test_answers_falling_out_of_the_buffer_are_counted(self):
+        self.swap(StudentAnswersEntity, 'MAX_BUFFERED_ANSWERS', 4)
+        self.answer()
+        self.execute_all_deferred_tasks()
+
+        num_dropped = student_answers.ANSWERS_DROPPED.value
+        self.answer(6)
+        self.execute_all_deferred_tasks()
+        self.assertEquals(5, self.get_attempts())
+        self.assertEquals(2, student_answers.ANSWERS_DROPPED.value - num_dropped)
+
+
+class ActivityScoresTests(BaseTeacherTests):
+
+    def setUp(self):
+        super(ActivityScoresTests, self).setUp()
+        self.user = actions.login(STUDENT_EMAIL)
+        with common_utils.Namespace(NAMESPACE):
+            models.Student(
+                key_name=self.user.user_id(), user_id=self.user.user_id(),
+                email=STUDENT_EMAIL, is_enrolled=True).put()
+
+    def answer(self, score=1):
+        """Records a Quizly answer the way the EventEntity listener does."""
+        data = make_quizly_answer(score)
+        with common_utils.Namespace(NAMESPACE):
+            ActivityScoreParser.record_activity_score(
+                self.app_context, self.user, data)
+            models.EventEntity(
+                source='tag-assessment', user_id=self.user.user_id(),
+                data=data, recorded_on=datetime.datetime.now()).put()
+
+    def get_attempts(self):
+        with common_utils.Namespace(NAMESPACE):
+            row = StudentScoresEntity.get_by_key_name(STUDENT_EMAIL)
+        return row.get_attempts().get(QUIZLY_ID) if row else None
+
+    def test_first_answers_are_backfilled_by_one_task(self):
+        self.answer()
+        self.answer()
+        self.assertIsNone(self.get_attempts())
+
+        self.execute_all_deferred_tasks()
+        self.assertEquals(2, self.get_attempts())
+
+    def test_answers_are_added_to_existing_row(self):
+        self.answer()
+        self.execute_all_deferred_tasks()
+
+        self.answer(score=0)
+        self.answer()
+        self.assertEquals(3, self.get_attempts())
+        self.execute_all_deferred_tasks()
+        self.assertEquals(3, self.get_attempts())
+
+    def test_rebuild_job_does_not_look_up_students_by_email(self):
+        for _ in xrange(3):
+            self.answer()
+
+        def get_first_by_email(unused_email):
+            raise AssertionError('Students are looked up one at a time.')
+
+        self.swap(models.Student, 'get_first_by_email',
+                  staticmethod(get_first_by_email))
+        student_activites.ActivityScoresRebuildJob(self.app_context).submit()
+        self.execute_all_deferred_tasks()
+        self.assertEquals(3, self.get_attempts())
+
+
+class RosterRefreshTests(BaseTeacherTests):
+
+    def setUp(self):
+        super(RosterRefreshTests, self).setUp()
+        self.course = courses.Course(None, app_context=self.app_context)
+        with common_utils.Namespace(NAMESPACE):
+            self.section_key = str(CourseSectionEntity(
+                name='Section', students='a@example.com,%s' % STUDENT_EMAIL
+            ).put())
+            CourseSectionEntity(name='Other', students='b@example.com').put()
+
+    def make_progress(self, email):
+        with common_utils.Namespace(NAMESPACE):
+            teacher.schedule_roster_refresh(
+                self.course, models.Student(email=email), None, None, None)
+
+    def get_snapshot_keys(self):
+        with common_utils.Namespace(NAMESPACE):
+            return [key.name() for key in SectionRosterEntity.all(
+                keys_only=True).filter('section_key', self.section_key)]
+
+    def test_progress_schedules_one_refresh_of_the_students_sections(self):
+        self.make_progress(STUDENT_EMAIL)
+        self.make_progress(STUDENT_EMAIL)
+        self.make_progress('nobody@example.com')
+        tasks = self.taskq.GetTasks('default')
+        self.assertEquals(1, len(tasks))
+
+        with common_utils.Namespace(NAMESPACE):
+            old_key_name = SectionRosterEntity.save_snapshot(
+                self.section_key, 'old_version', []).key().name()
+        self.execute_all_deferred_tasks()
+
+        key_names = self.get_snapshot_keys()
+        self.assertEquals(1, len(key_names))
+        self.assertNotEquals(old_key_name, key_names[0])
+
+    def test_section_index_follows_roster_changes(self):
+        with common_utils.Namespace(NAMESPACE):
+            self.assertEquals(
+                [self.section_key],
+                CourseSectionEntity.get_section_keys_by_student()[STUDENT_EMAIL])
+            section = CourseSectionEntity.get(self.section_key)
+            section.students = 'a@example.com'
+            section.put()
+            self.assertNotIn(
+                STUDENT_EMAIL, CourseSectionEntity.get_section_keys_by_student())
@@ -67,9 +67,10 @@ ALL_TEST_CLASSES = {
     'tests.functional.model_analytics.CronCleanupTest': 14,
     'tests.functional.model_analytics.MapReduceSimpleTest': 1,
     'tests.functional.model_analytics.ProgressAnalyticsTest': 9,
-    'tests.functional.model_analytics.QuestionAnalyticsTest': 3,
+    'tests.functional.model_analytics.QuestionAnalyticsTest': 4,
     'tests.functional.model_config.ValueLoadingTests': 2,
-    'tests.functional.model_courses.CourseCachingTest': 5,
+    'tests.functional.model_courses.ComponentsCacheTest': 1,
+    'tests.functional.model_courses.CourseCachingTest': 10,
     'tests.functional.model_courses.PermissionsTest': 4,
     'tests.functional.model_data_sources.PaginatedTableTest': 17,
     'tests.functional.model_data_sources.PiiExportTest': 4,
@@ -80,13 +81,15 @@ ALL_TEST_CLASSES = {
     'tests.functional.model_models.BaseJsonDaoTestCase': 1,
     'tests.functional.model_models.ContentChunkTestCase': 16,
     'tests.functional.model_models.EventEntityTestCase': 1,
-    'tests.functional.model_models.MemcacheManagerTestCase': 4,
+    'tests.functional.model_models.MemcacheManagerBenchmark': 1,
+    'tests.functional.model_models.MemcacheManagerTestCase': 9,
     'tests.functional.model_models.PersonalProfileTestCase': 1,
     'tests.functional.model_models.QuestionDAOTestCase': 3,
     'tests.functional.model_models.StudentAnswersEntityTestCase': 1,
     'tests.functional.model_models.StudentLifecycleObserverTestCase': 13,
     'tests.functional.model_models.StudentProfileDAOTestCase': 6,
-    'tests.functional.model_models.StudentPropertyEntityTestCase': 1,
+    'tests.functional.model_models.StudentPropertyEntityBenchmark': 1,
+    'tests.functional.model_models.StudentPropertyEntityTestCase': 3,
     'tests.functional.model_models.StudentTestCase': 11,
     'tests.functional.model_permissions.PermissionsTests': 4,
     'tests.functional.model_permissions.SimpleSchemaPermissionTests': 16,
@@ -94,7 +97,9 @@ ALL_TEST_CLASSES = {
     'tests.functional.model_student_work.ReviewTest': 3,
     'tests.functional.model_student_work.SubmissionTest': 3,
     'tests.functional.model_utils.QueryMapperTest': 4,
-    'tests.functional.model_vfs.VfsLargeFileSupportTest': 6,
+    'tests.functional.model_vfs.VfsChangeLogTest': 4,
+    'tests.functional.model_vfs.VfsLargeFileSupportTest': 8,
+    'tests.functional.model_vfs.VfsOpenMultiTest': 3,
     'tests.functional.module_config_test.ManipulateAppYamlFileTest': 8,
     'tests.functional.module_config_test.ModuleIncorporationTest': 12,
     'tests.functional.module_config_test.ModuleManifestTest': 7,
@@ -108,7 +113,7 @@ ALL_TEST_CLASSES = {
     'tests.functional.student_last_location.RootCourse': 3,
     'tests.functional.student_tracks.StudentTracksTest': 10,
     'tests.functional.roles.RolesTest': 24,
-    'tests.functional.test_classes.ActivityTest': 1,
+    'tests.functional.test_classes.ActivityTest': 3,
     'tests.functional.test_classes.AdminAspectTest': 10,
     'tests.functional.test_classes.AssessmentPolicyTests': 6,
     'tests.functional.test_classes.AssessmentTest': 2,
@@ -123,12 +128,14 @@ ALL_TEST_CLASSES = {
     'tests.functional.test_classes.ExtensionSwitcherTests': 2,
     'tests.functional.test_classes.InfrastructureTest': 21,
     'tests.functional.test_classes.I18NTest': 2,
+    'tests.functional.test_classes.LazyHandlerFactoryTests': 2,
     'tests.functional.test_classes.LegacyEMailAsKeyNameTest': 47,
     'tests.functional.test_classes.LessonComponentsTest': 3,
     'tests.functional.test_classes.MemcacheTest': 68,
+    'tests.functional.test_classes.ModuleStartupMillisTests': 1,
     'tests.functional.test_classes.MultipleCoursesTest': 1,
     'tests.functional.test_classes.NamespaceTest': 2,
-    'tests.functional.test_classes.StaticHandlerTest': 3,
+    'tests.functional.test_classes.StaticHandlerTest': 4,
     'tests.functional.test_classes.StudentAspectTest': 19,
     'tests.functional.test_classes.StudentKeyNameTest': 8,
     'tests.functional.test_classes.StudentUnifiedProfileTest': 19,
@@ -112,7 +112,7 @@ class OverriddenEnvironment(object):
         self._old_get_environ = courses.Course.get_environ
         self._new_env = new_env
 
-    def _get_environ(self, app_context):
+    def _get_environ(self, app_context, unused_mutable=True):
         return courses.deep_dict_merge(
             self._new_env, self._old_get_environ(app_context))
 
@@ -45,6 +45,7 @@ from modules.analytics import analytics
 from modules.analytics import rest_providers
 from modules.analytics import synchronous_providers
 from modules.mapreduce import mapreduce_module
+from tools import verify
 
 from google.appengine.ext import db
 
@@ -729,6 +730,45 @@ class QuestionAnalyticsTest(actions.TestBase):
             }
         )
 
+    def test_id_to_question_dicts_are_cached_until_course_is_saved(self):
+        config.Registry.test_overrides[models.CAN_USE_MEMCACHE.name] = True
+        course = self._get_sample_v15_course()
+        course.save()
+
+        builds = []
+        build = UnitLessonCompletionTracker._build_id_to_questions_dict
+
+        def counting_build(tracker):
+            builds.append(1)
+            return build(tracker)
+
+        self.swap(UnitLessonCompletionTracker, '_build_id_to_questions_dict',
+                  counting_build)
+        try:
+            id_to_questions = UnitLessonCompletionTracker(
+                course).get_id_to_questions_dict()
+            self.assertEquals(3, len(id_to_questions))
+            self.assertEquals(1, len(builds))
+
+            # Callers may change their copy without affecting the cache.
+            id_to_questions['u.1.l.2.c.QN']['score'] = 5
+            id_to_questions = UnitLessonCompletionTracker(
+                course).get_id_to_questions_dict()
+            self.assertEquals(0, id_to_questions['u.1.l.2.c.QN']['score'])
+            self.assertEquals(1, len(builds))
+
+            # Saving the course starts a new content version.
+            unit = course.get_units_of_type(verify.UNIT_TYPE_UNIT)[0]
+            lesson = course.get_lessons(unit.unit_id)[0]
+            lesson.objectives = ''
+            course.update_lesson(lesson)
+            course.save()
+            self.assertEquals({}, UnitLessonCompletionTracker(
+                course).get_id_to_questions_dict())
+            self.assertEquals(2, len(builds))
+        finally:
+            del config.Registry.test_overrides[models.CAN_USE_MEMCACHE.name]
+
 
 COURSE_ONE = 'course_one'
 COURSE_TWO = 'course_two'
@@ -60,8 +60,16 @@ class CourseCachingTest(actions.TestBase):
         actions.login(self.ADMIN_EMAIL)
         config.Registry.test_overrides[models.CAN_USE_MEMCACHE.name] = True
 
+        # Repeated text compresses too well to span shards; most tests below
+        # store courses uncompressed.
+        self.old_compression_level = courses.CachedCourse13.COMPRESSION_LEVEL
+        courses.CachedCourse13.COMPRESSION_LEVEL = 0
+
     def tearDown(self):
+        courses.CachedCourse13.COMPRESSION_LEVEL = self.old_compression_level
         del config.Registry.test_overrides[models.CAN_USE_MEMCACHE.name]
+        config.Registry.test_overrides.pop(
+            courses.COURSE_CACHE_SHARDS.name, None)
         super(CourseCachingTest, self).tearDown()
 
     def _add_large_unit(self, num_lessons):
@@ -156,10 +164,8 @@ class CourseCachingTest(actions.TestBase):
             self.assertEquals(lesson.objectives, LOREM_IPSUM)
 
     def test_course_that_is_too_large_to_cache_is_not_cached(self):
-        num_lessons = courses.CachedCourse13._max_size() / len(LOREM_IPSUM)
-        # Fudge factor to get size of course as saved to under the VFS limit
-        # but over the memcache limit.
-        num_lessons -= 19
+        config.Registry.test_overrides[courses.COURSE_CACHE_SHARDS.name] = 1
+        num_lessons = 2 * models.MEMCACHE_MAX / len(LOREM_IPSUM)
         unit = self._add_large_unit(num_lessons)
         memcache_keys = courses.CachedCourse13._make_keys()
 
@@ -186,6 +192,180 @@ class CourseCachingTest(actions.TestBase):
             memcache_values.keys(),
             'Only shard zero should be present in memcache.')
 
+    def test_compressed_course_occupies_fewer_shards(self):
+        courses.CachedCourse13.COMPRESSION_LEVEL = 6
+        num_lessons = 2 * models.MEMCACHE_MAX / len(LOREM_IPSUM)
+        unit = self._add_large_unit(num_lessons)
+        memcache_keys = courses.CachedCourse13._make_keys()
+
+        courses.Course(handler=None, app_context=self.app_context)
+        memcache_values = models.MemcacheManager.get_multi(
+            memcache_keys, self.NAMESPACE)
+        self.assertEquals(memcache_keys[0:1], memcache_values.keys())
+
+        loads_before = courses.COURSE_CACHE_LOAD.value
+        course = courses.Course(handler=None, app_context=self.app_context)
+        self.assertEquals(loads_before + 1, courses.COURSE_CACHE_LOAD.value)
+        lessons = course.get_lessons(unit.unit_id)
+        self.assertEquals(num_lessons, len(lessons))
+        for lesson in lessons:
+            self.assertEquals(lesson.objectives, LOREM_IPSUM)
+
+    def test_course_with_bad_checksum_is_not_loaded(self):
+        self._add_large_unit(num_lessons=1)
+        memcache_keys = courses.CachedCourse13._make_keys()
+        courses.Course(handler=None, app_context=self.app_context)
+
+        shard_0 = models.MemcacheManager.get(memcache_keys[0], self.NAMESPACE)
+        models.MemcacheManager.set(
+            memcache_keys[0], shard_0[:-1] + chr(ord(shard_0[-1]) ^ 1),
+            namespace=self.NAMESPACE)
+
+        corrupt_before = courses.COURSE_CACHE_LOAD_CORRUPT.value
+        self.assertIsNone(courses.CachedCourse13.load(self.app_context))
+        self.assertEquals(
+            corrupt_before + 1, courses.COURSE_CACHE_LOAD_CORRUPT.value)
+
+    def test_lookups_on_course_loaded_from_memcache(self):
+        unit = self._add_large_unit(num_lessons=3)
+        pre = self.course.add_assessment()
+        post = self.course.add_assessment()
+        unit = self.course.find_unit_by_id(unit.unit_id)
+        unit.pre_assessment = pre.unit_id
+        unit.post_assessment = post.unit_id
+        self.course.save()
+
+        # Load once to populate memcache, then again to load from it.
+        courses.Course(handler=None, app_context=self.app_context)
+        loads_before = courses.COURSE_CACHE_LOAD.value
+        course = courses.Course(handler=None, app_context=self.app_context)
+        self.assertEquals(loads_before + 1, courses.COURSE_CACHE_LOAD.value)
+
+        # Lookups must return the very objects held in the unit and lesson
+        # lists, so that edits made through either are saved.
+        units = course.get_units()
+        loaded_unit = course.find_unit_by_id(unit.unit_id)
+        self.assertTrue(any(loaded_unit is u for u in units))
+        self.assertIs(loaded_unit, course.find_unit_by_id(str(unit.unit_id)))
+        self.assertIs(loaded_unit, course.get_parent_unit(pre.unit_id))
+        self.assertIs(loaded_unit, course.get_parent_unit(post.unit_id))
+        self.assertIsNone(course.get_parent_unit(unit.unit_id))
+        self.assertIsNone(course.find_unit_by_id(9999))
+
+        lessons = course.get_lessons(unit.unit_id)
+        self.assertEquals(3, len(lessons))
+        for lesson in lessons:
+            self.assertIs(
+                lesson, course.find_lesson_by_id(None, lesson.lesson_id))
+
+        # Detaching an assessment via update_unit() re-indexes its parent.
+        loaded_unit.post_assessment = None
+        course.update_unit(loaded_unit)
+        self.assertIsNone(course.get_parent_unit(post.unit_id))
+        self.assertIs(loaded_unit, course.get_parent_unit(pre.unit_id))
+
+    def test_read_only_environ_is_shared_and_not_copied(self):
+        get_environ = courses.Course.get_environ
+        get_environ(self.app_context)  # Populate the local cache.
+        shared_before = courses.ENVIRON_READ_SHARED.value
+        copy_before = courses.ENVIRON_READ_COPY.value
+
+        env = get_environ(self.app_context, mutable=False)
+        self.assertIs(env, get_environ(self.app_context, mutable=False))
+        self.assertEquals(shared_before + 2, courses.ENVIRON_READ_SHARED.value)
+        with self.assertRaises(TypeError):
+            env['course']['title'] = 'Changed'
+
+        # By default, callers still get their own copy to change.
+        mutable_env = get_environ(self.app_context)
+        self.assertEquals(copy_before + 1, courses.ENVIRON_READ_COPY.value)
+        self.assertEquals(env, mutable_env)
+        mutable_env['course']['title'] = 'Changed'
+        self.assertEquals('Test Course', env['course']['title'])
+        self.assertEquals(
+            'Test Course', self.course.get_course_setting('title'))
+
+    def test_course_is_shared_by_requests_until_saved(self):
+        courses.ProcessScopedCourseCache.clear_instance()
+        courses.Course.clear_current()
+        course = courses.Course.get(self.app_context)
+
+        hits_before = courses.COURSE_PROCESS_CACHE_HIT.value
+        courses.Course.clear_current()
+        self.assertIs(course, courses.Course.get(self.app_context))
+        self.assertEquals(
+            hits_before + 1, courses.COURSE_PROCESS_CACHE_HIT.value)
+
+        # Saving the course makes the next request load it again.
+        fresh = courses.Course(None, app_context=self.app_context)
+        fresh.add_unit()
+        fresh.save()
+        stale_before = courses.COURSE_PROCESS_CACHE_STALE.value
+        courses.Course.clear_current()
+        reloaded = courses.Course.get(self.app_context)
+        self.assertIsNot(course, reloaded)
+        self.assertEquals(
+            stale_before + 1, courses.COURSE_PROCESS_CACHE_STALE.value)
+        self.assertEquals(1, len(reloaded.get_units()))
+        courses.Course.clear_current()
+        courses.ProcessScopedCourseCache.clear_instance()
+
+
+class ComponentsCacheTest(actions.TestBase):
+
+    COURSE_NAME = 'test_course'
+    ADMIN_EMAIL = 'admin@foo.com'
+
+    def setUp(self):
+        super(ComponentsCacheTest, self).setUp()
+        app_context = actions.simple_add_course(
+            self.COURSE_NAME, self.ADMIN_EMAIL, 'Test Course')
+        self.course = courses.Course(handler=None, app_context=app_context)
+        self.unit = self.course.add_unit()
+        self.lesson = self.course.add_lesson(self.unit)
+        self.lesson.objectives = (
+            '<question quid="1" instanceid="a"></question>'
+            '<question-group qgid="2" instanceid="b"></question-group>')
+        self.course.save()
+        courses.ProcessScopedComponentsCache.clear_instance()
+
+    def tearDown(self):
+        courses.ProcessScopedComponentsCache.clear_instance()
+        super(ComponentsCacheTest, self).tearDown()
+
+    def test_lesson_is_parsed_once_until_changed(self):
+        hits = courses.COMPONENTS_CACHE_HIT.value
+        misses = courses.COMPONENTS_CACHE_MISS.value
+        unit_id = self.unit.unit_id
+        lesson_id = self.lesson.lesson_id
+
+        self.assertEquals(
+            [{'cpt_name': 'question', 'quid': '1', 'instanceid': 'a'}],
+            self.course.get_question_components(unit_id, lesson_id))
+        self.assertEquals(
+            [{'cpt_name': 'question-group', 'qgid': '2', 'instanceid': 'b'}],
+            self.course.get_question_group_components(unit_id, lesson_id))
+        self.assertEquals(misses + 1, courses.COMPONENTS_CACHE_MISS.value)
+        self.assertEquals(hits + 1, courses.COMPONENTS_CACHE_HIT.value)
+
+        # Callers get copies they may change.
+        components = self.course.get_components(unit_id, lesson_id)
+        components[0]['quid'] = '3'
+        del components[1]
+        self.assertEquals(
+            2, len(self.course.get_components(unit_id, lesson_id)))
+        self.assertEquals(
+            '1', self.course.get_components(unit_id, lesson_id)[0]['quid'])
+
+        # Changing the lesson body parses it again.
+        self.lesson.objectives = '<question quid="4" instanceid="c"></question>'
+        self.course.update_lesson(self.lesson)
+        self.course.save()
+        self.assertEquals(
+            [{'cpt_name': 'question', 'quid': '4', 'instanceid': 'c'}],
+            self.course.get_components(unit_id, lesson_id))
+        self.assertEquals(misses + 2, courses.COMPONENTS_CACHE_MISS.value)
+
 
 class PermissionsTest(actions.TestBase):
 
@@ -151,7 +151,7 @@ class VfsLargeFileSupportTest(actions.TestBase):
         actual = fs.get(filename).read()
         self.assertEquals(orig_data, actual)
 
-        # And again, this time from cache.
+        # And again; a file this large is not cached, so it is re-read.
         actual = fs.get(filename).read()
         self.assertEquals(orig_data, actual)
 
@@ -169,6 +169,47 @@ class VfsLargeFileSupportTest(actions.TestBase):
             shard_1 = vfs.FileDataEntity.get_by_key_name(file_key_names[1])
             self.assertEquals(1, len(shard_1.data))
 
+    def test_large_file_is_read_in_shards_and_only_metadata_cached(self):
+        orig_data = ''.join(
+            [chr(i % 256) for i in xrange(2 * vfs._MAX_VFS_SHARD_SIZE + 10)])
+        namespace = 'ns_foo'
+        fs = vfs.DatastoreBackedFileSystem(namespace, '/')
+        filename = '/foo'
+        fs.put(filename, StringIO.StringIO(orig_data))
+
+        stream = fs.get(filename)
+        self.assertTrue(isinstance(stream, vfs.FileStreamChunked))
+        self.assertEquals(len(orig_data), stream.size)
+
+        # Only the metadata is cached; the data is still read in shards.
+        found, cached = fs.cache.get(filename)
+        self.assertTrue(found)
+        self.assertTrue(isinstance(cached, vfs.FileStreamChunked))
+        self.assertEquals(orig_data, cached.read())
+
+        # A range within the last shard reads only that shard.
+        start = 2 * vfs._MAX_VFS_SHARD_SIZE + 2
+        chunks = list(stream.iter_chunks(start, start + 5))
+        self.assertEquals([orig_data[start:start + 5]], chunks)
+
+        # A range spanning shards yields one chunk per shard it overlaps.
+        start = vfs._MAX_VFS_SHARD_SIZE - 3
+        chunks = list(stream.iter_chunks(start, start + 6))
+        self.assertEquals(2, len(chunks))
+        self.assertEquals(orig_data[start:start + 6], ''.join(chunks))
+
+        self.assertEquals(orig_data, ''.join(stream.iter_chunks()))
+        self.assertEquals(orig_data, stream.read())
+        self.assertEquals('', stream.read())
+        self.assertEquals(len(orig_data), stream.size)
+
+    def test_wrapped_stream_keeps_its_size_and_chunks_after_read(self):
+        stream = vfs.FileStreamWrapped(None, 'file contents')
+        self.assertEquals('file contents', stream.read())
+        self.assertEquals('', stream.read())
+        self.assertEquals(len('file contents'), stream.size)
+        self.assertEquals(['contents'], list(stream.iter_chunks(5)))
+
     def test_illegal_file_name(self):
         namespace = 'ns_foo'
         fs = vfs.DatastoreBackedFileSystem(namespace, '/')
@@ -199,3 +240,215 @@ class VfsLargeFileSupportTest(actions.TestBase):
         # from AppEngine about cross-group transaction having too many
         # entities involved.
         self.course.save()
+
+
+class VfsChangeLogTest(actions.TestBase):
+
+    COURSE_NAME = 'test_course'
+    ADMIN_EMAIL = 'admin@foo.com'
+    NAMESPACE = 'ns_%s' % COURSE_NAME
+    FILENAME = '/assets/img/change_log_test.txt'
+
+    def setUp(self):
+        super(VfsChangeLogTest, self).setUp()
+        self.app_context = actions.simple_add_course(
+            self.COURSE_NAME, self.ADMIN_EMAIL, 'Test Course')
+        self.fs = self.app_context.fs.impl
+        self.filename = self.fs.physical_to_logical(self.FILENAME)
+
+    def _reconnect(self):
+        # Each thread keeps its cache connection; a new one syncs with the log.
+        del self.fs._cache.connection
+
+    def test_changes_made_by_other_instances_evict_cached_files(self):
+        self.fs.put(self.filename, vfs.string_to_stream('text'))
+        self._reconnect()
+        self.assertEquals('text', self.fs.get(self.filename).read())
+
+        # Nothing changed since the last sync, so nothing is evicted.
+        updates_before = vfs.VfsCacheConnection.CACHE_UPDATE_COUNT.value
+        self._reconnect()
+        self.assertEquals('text', self.fs.get(self.filename).read())
+        self.assertEquals(
+            updates_before, vfs.VfsCacheConnection.CACHE_UPDATE_COUNT.value)
+
+        # Delete the file the way another instance would; this instance keeps
+        # serving it from cache until its next sync.
+        with common_utils.Namespace(self.NAMESPACE):
+            since = vfs.FileChangeLog.get_generations(self.NAMESPACE)
+            vfs.FileMetadataEntity.get_by_key_name(self.FILENAME).delete()
+            vfs.FileChangeLog.record(
+                self.NAMESPACE, [self.FILENAME], is_deleted=True)
+            until = vfs.FileChangeLog.get_generations(self.NAMESPACE)
+            self.assertEquals(sum(since) + 1, sum(until))
+            changes = vfs.FileChangeLog.get_changes_since(
+                self.NAMESPACE, since, until)
+            self.assertEquals([self.FILENAME], changes.keys())
+            self.assertTrue(changes[self.FILENAME].is_deleted)
+        self.assertEquals('text', self.fs.get(self.filename).read())
+
+        self._reconnect()
+        self.assertIsNone(self.fs.get(self.filename))
+        self.assertEquals(
+            updates_before + 1,
+            vfs.VfsCacheConnection.CACHE_UPDATE_COUNT.value)
+
+    def test_put_multi_async_logs_changes_with_metadata(self):
+        self.fs.put(self.filename, vfs.string_to_stream('text'))
+        self._reconnect()
+        self.assertEquals('text', self.fs.get(self.filename).read())
+
+        since = vfs.FileChangeLog.get_generations(self.NAMESPACE)
+        other = self.fs.physical_to_logical('/assets/img/other.txt')
+        wait_and_finalize = self.fs.put_multi_async([
+            (self.filename, vfs.string_to_stream('new text')),
+            (other, vfs.string_to_stream('other text'))])
+        wait_and_finalize()
+        until = vfs.FileChangeLog.get_generations(self.NAMESPACE)
+        self.assertEquals(sum(since) + 1, sum(until))
+        self.assertEquals(
+            set([self.FILENAME, '/assets/img/other.txt']),
+            set(vfs.FileChangeLog.get_changes_since(
+                self.NAMESPACE, since, until).keys()))
+
+        self._reconnect()
+        self.assertEquals('new text', self.fs.get(self.filename).read())
+        self.assertEquals('other text', self.fs.get(other).read())
+
+    def test_listing_reads_whole_directory_and_is_cached(self):
+        self.swap(vfs, '_LIST_BATCH_SIZE', 2)
+        dir_name = self.fs.physical_to_logical('/assets/listing/')
+        filenames = [
+            self.fs.physical_to_logical('/assets/listing/%s.txt' % name)
+            for name in ['a', 'b', 'c', 'd', 'e']]
+        for filename in filenames:
+            self.fs.put(filename, vfs.string_to_stream('text'))
+        self.fs.put(
+            self.fs.physical_to_logical('/assets/other.txt'),
+            vfs.string_to_stream('text'))
+
+        misses_before = vfs.VfsCacheConnection.CACHE_LISTING_MISS.value
+        hits_before = vfs.VfsCacheConnection.CACHE_LISTING_HIT.value
+        self.assertEquals(filenames, self.fs.list(dir_name))
+        self.assertEquals(filenames, self.fs.list(dir_name))
+        self.assertEquals(
+            misses_before + 1,
+            vfs.VfsCacheConnection.CACHE_LISTING_MISS.value)
+        self.assertEquals(
+            hits_before + 1, vfs.VfsCacheConnection.CACHE_LISTING_HIT.value)
+
+        # Changes made by this instance are listed right away.
+        self.fs.delete(filenames[0])
+        self.assertEquals(filenames[1:], self.fs.list(dir_name))
+
+        # Changes made by another instance are listed right away, too.
+        with common_utils.Namespace(self.NAMESPACE):
+            vfs.FileMetadataEntity.get_by_key_name(
+                '/assets/listing/b.txt').delete()
+            vfs.FileChangeLog.record(
+                self.NAMESPACE, ['/assets/listing/b.txt'], is_deleted=True)
+        self.assertEquals(filenames[2:], self.fs.list(dir_name))
+
+    def test_listing_includes_names_outside_basic_multilingual_plane(self):
+        dir_name = self.fs.physical_to_logical('/assets/emoji/')
+        filenames = [
+            self.fs.physical_to_logical(u'/assets/emoji/%s.png' % name)
+            for name in [u'a', u'\ufffe', u'\U0001f600']]
+        for filename in filenames:
+            self.fs.put(filename, vfs.string_to_stream(u'image'))
+        self.fs.put(
+            self.fs.physical_to_logical('/assets/emojis.txt'),
+            vfs.string_to_stream(u'text'))
+        self.assertEquals(
+            sorted(filenames, key=lambda name: name.encode('utf-8')),
+            self.fs.list(dir_name))
+
+
+class VfsOpenMultiTest(actions.TestBase):
+
+    COURSE_NAME = 'test_course'
+    ADMIN_EMAIL = 'admin@foo.com'
+
+    def setUp(self):
+        super(VfsOpenMultiTest, self).setUp()
+        self.app_context = actions.simple_add_course(
+            self.COURSE_NAME, self.ADMIN_EMAIL, 'Test Course')
+        self.fs = self.app_context.fs
+        self.filenames = [
+            self.fs.impl.physical_to_logical('/assets/js/%s.js' % name)
+            for name in ['a', 'b', 'c']]
+        for filename in self.filenames:
+            self.fs.put(filename, vfs.string_to_stream(filename))
+
+    def test_open_multi(self):
+        missing = self.fs.impl.physical_to_logical('/assets/js/missing.js')
+        inherited = self.fs.impl.physical_to_logical('/assets/css/main.css')
+        streams = self.fs.open_multi(self.filenames + [missing, inherited])
+
+        self.assertEquals(
+            set(self.filenames + [missing, inherited]), set(streams.keys()))
+        for filename in self.filenames:
+            self.assertEquals(filename, streams[filename].read())
+        self.assertIsNone(streams[missing])
+        self.assertIn('body', streams[inherited].read())
+
+    def test_prefetched_files_are_read_from_cache(self):
+        self.fs.prefetch(self.filenames)
+
+        hits_before = vfs.VfsCacheConnection.CACHE_HIT.value
+        misses_before = vfs.VfsCacheConnection.CACHE_MISS.value
+        for filename in self.filenames:
+            self.assertEquals(filename, self.fs.get(filename))
+        self.assertEquals(
+            hits_before + len(self.filenames),
+            vfs.VfsCacheConnection.CACHE_HIT.value)
+        self.assertEquals(
+            misses_before, vfs.VfsCacheConnection.CACHE_MISS.value)
+
+    def test_prefetch_content_files_reads_metadata_once(self):
+        course = courses.Course(None, app_context=self.app_context)
+        unit = course.add_unit()
+        for unused in range(2):
+            lesson = course.add_lesson(unit)
+            course.set_activity_content(lesson, u'var activity = []', [])
+            course.update_lesson(lesson)
+        js_assessment = course.add_assessment()
+        self.fs.put(
+            os.path.join(self.app_context.get_home(),
+                         course.get_assessment_filename(
+                             js_assessment.unit_id)),
+            vfs.string_to_stream(u'assessment = {}'))
+        html_assessment = course.add_assessment()
+        html_assessment.html_content = '<p>Question</p>'
+        course.update_unit(html_assessment)
+        course.save()
+        course = courses.Course(None, app_context=self.app_context)
+        lessons = course.get_lessons(unit.unit_id)
+
+        requests = []
+        get_by_key_name = vfs.FileMetadataEntity.get_by_key_name
+
+        def recording_get_by_key_name(key_names, *args, **kwargs):
+            if isinstance(key_names, list):
+                requests.append([
+                    key_name for key_name in key_names
+                    if '/assets/js/' in key_name])
+            return get_by_key_name(key_names, *args, **kwargs)
+
+        self.swap(vfs.FileMetadataEntity, 'get_by_key_name',
+                  staticmethod(recording_get_by_key_name))
+        course.prefetch_content_files(
+            units=[js_assessment, html_assessment], lessons=lessons)
+        self.assertEquals(1, len(requests))
+        self.assertEquals(3, len(requests[0]))
+        html_filename = course.get_assessment_filename(
+            html_assessment.unit_id)
+        self.assertFalse(
+            [name for name in requests[0] if name.endswith(html_filename)])
+
+        del requests[:]
+        for lesson in lessons:
+            self.assertIsNotNone(self.fs.get(os.path.join(
+                self.app_context.get_home(),
+                course.get_activity_filename(unit.unit_id, lesson.lesson_id))))
+        self.assertEquals([], [names for names in requests if names])
@@ -442,6 +442,75 @@ class ExtensionSwitcherTests(actions.TestBase):
         self.assertEquals('handler 2', self.get(self._URI).body)
 
 
+class LazilyImportedHandler(utils.ApplicationHandler):
+
+    def get(self):
+        self.response.out.write('lazy handler')
+
+
+class LazyHandlerFactoryTests(actions.TestBase):
+    _ADMIN_EMAIL = 'admin@foo.com'
+    _COURSE_NAME = 'lazy_handler'
+    _URI = 'test/lazy'
+
+    def setUp(self):
+        super(LazyHandlerFactoryTests, self).setUp()
+        self.base = '/' + self._COURSE_NAME
+        actions.simple_add_course(
+            self._COURSE_NAME, self._ADMIN_EMAIL, 'Lazy Handler')
+        self.factory = utils.LazyHandlerFactory(
+            'tests.functional.test_classes.LazilyImportedHandler')
+        sites.ApplicationRequestHandler.urls_map['/' + self._URI] = (
+            self.factory)
+
+    def tearDown(self):
+        del sites.Registry.test_overrides[sites.GCB_COURSES_CONFIG.name]
+        del sites.ApplicationRequestHandler.urls_map['/' + self._URI]
+        super(LazyHandlerFactoryTests, self).tearDown()
+
+    def test_handler_class_is_imported_on_first_request(self):
+        # A lazy handler is not a '*' route.
+        self.assertFalse(
+            sites.ApplicationRequestHandler().is_star_route(self.factory))
+
+        self.assertEquals('lazy handler', self.get(self._URI).body)
+        self.assertIs(LazilyImportedHandler, self.factory.handler_class)
+
+    def test_analytics_gradebook_handler_is_lazy(self):
+        handlers = dict(analytics.get_namespaced_handlers())
+        factory = handlers[analytics.GRADEBOOK_CSV_URI]
+        self.assertIsInstance(factory, utils.LazyHandlerFactory)
+        self.assertEquals(
+            factory.handler_class.URI, analytics.GRADEBOOK_CSV_URI)
+
+
+class ModuleStartupMillisTests(actions.TestBase):
+
+    LOG_LEVEL = logging.INFO
+
+    def test_modules_are_logged_most_expensive_first(self):
+        events = []
+        self.swap(appengine_config, 'MODULE_STARTUP_MILLIS', {
+            'modules.cheap.cheap': {'import': 5, 'register': 1},
+            'modules.costly.costly': {
+                'import': 20, 'register': 2, 'enable': 3}})
+        self.swap(appengine_config, 'log_appstats_event',
+                  lambda label, data=None: events.append((label, data)))
+
+        appengine_config.log_module_startup_millis()
+        log = self.get_log()
+        costly = ('    25ms modules.costly.costly '
+                  '(import 20ms, register 2ms, enable 3ms)')
+        cheap = ('     6ms modules.cheap.cheap '
+                 '(import 5ms, register 1ms, enable -ms)')
+        self.assertIn(costly, log)
+        self.assertIn(cheap, log)
+        self.assertLess(log.index(costly), log.index(cheap))
+        self.assertEquals('modules.startup', events[0][0])
+        self.assertEquals(
+            25, sum(events[0][1]['modules.costly.costly'].values()))
+
+
 class InfrastructureTest(actions.TestBase):
     """Test core infrastructure classes agnostic to specific user roles."""
 
@@ -3053,6 +3122,56 @@ class StaticHandlerTest(actions.TestBase):
         assert_response(self.testapp.get(
             '/static/inputex-3.1.0/src/inputex/assets/skins/sam/inputex.css'))
 
+    def test_asset_byte_ranges(self):
+        """Test AssetHandler serves single byte ranges of a file."""
+        data = self.get('/assets/css/main.css').body
+        size = len(data)
+
+        def get_range(value, expect_errors=False):
+            return self.get(
+                '/assets/css/main.css', headers={'Range': value},
+                expect_errors=expect_errors)
+
+        response = get_range('bytes=0-9')
+        assert_equals(response.status_int, 206)
+        assert_equals(data[:10], response.body)
+        assert_equals(
+            'bytes 0-9/%s' % size, response.headers['Content-Range'])
+        assert_equals('bytes', response.headers['Accept-Ranges'])
+
+        response = get_range('bytes=-5')
+        assert_equals(response.status_int, 206)
+        assert_equals(data[-5:], response.body)
+
+        response = get_range('bytes=10-%s' % (size * 2))
+        assert_equals(response.status_int, 206)
+        assert_equals(data[10:], response.body)
+        assert_equals(
+            'bytes 10-%s/%s' % (size - 1, size),
+            response.headers['Content-Range'])
+
+        # Several ranges, or a malformed Range header, get the whole file.
+        for value in ['bytes=0-1,5-6', 'lines=1-2', 'bytes=9-3']:
+            response = get_range(value)
+            assert_equals(response.status_int, 200)
+            assert_equals(data, response.body)
+
+        response = get_range('bytes=%s-' % size, expect_errors=True)
+        assert_equals(response.status_int, 416)
+        assert_equals('bytes */%s' % size, response.headers['Content-Range'])
+
+        # No suffix range of an empty file can be satisfied.
+        app_context = actions.simple_add_course(
+            'range_course', 'admin@foo.com', 'Range Course')
+        app_context.fs.put(
+            app_context.fs.impl.physical_to_logical('/assets/css/empty.css'),
+            vfs.string_to_stream(u''))
+        response = self.get(
+            '/range_course/assets/css/empty.css',
+            headers={'Range': 'bytes=-5'}, expect_errors=True)
+        assert_equals(response.status_int, 416)
+        assert_equals('bytes */0', response.headers['Content-Range'])
+
     def _assert_handler(self, response, name=None):
         assert_equals(response.status_int, 200)
         assert_equals(
@@ -3232,6 +3351,103 @@ class ActivityTest(actions.TestBase):
         assert not tracker.is_block_completed(
             progress, 5, 2, fake_numeric_id)
 
+    def test_progress_transaction_puts_progress_once(self):
+        """Test that batched progress events are stored with one put()."""
+
+        class FakeHandler(object):
+
+            def __init__(self, app_context):
+                self.app_context = app_context
+
+        course = Course(FakeHandler(sites.get_all_courses()[0]))
+        tracker = course.get_progress_tracker()
+        student = models.Student(key_name='key-test-student')
+
+        puts = []
+        put = models.StudentPropertyEntity.put
+
+        def counting_put(entity):
+            puts.append(entity.name)
+            return put(entity)
+
+        hook_calls = []
+
+        def hook(unused_course, unused_student, progress, event_entity,
+                 unused_event_key):
+            hook_calls.append(event_entity)
+            # Hooks see the events applied so far, before they are stored.
+            assert tracker.get_html_status(progress, 1, 3) == 2
+
+        self.swap(models.StudentPropertyEntity, 'put', counting_put)
+        self.swap(tracker, 'POST_UPDATE_PROGRESS_HOOK', [hook])
+
+        with tracker.progress_transaction(student):
+            for lesson_id in [3, 4, 5, 6]:
+                tracker.put_html_accessed(student, 1, lesson_id)
+                tracker.put_activity_completed(student, 1, lesson_id)
+            with tracker.progress_transaction(student):
+                tracker.put_html_accessed(student, 1, 1)
+                tracker.put_block_completed(student, 1, 2, 3)
+                tracker.put_block_completed(student, 1, 2, 6)
+                tracker.put_html_accessed(student, 1, 2)
+            self.assertEquals([], puts)
+        self.assertEquals([tracker.PROPERTY_KEY], puts)
+        self.assertIn('html', hook_calls)
+        self.assertIn('unit', hook_calls)
+        self.assertEquals(2, tracker.get_unit_progress(student)['1'])
+
+        # Outside of a transaction, each event is stored right away.
+        tracker.put_html_accessed(student, 6, 1)
+        self.assertEquals(2, len(puts))
+
+    def test_completion_matrix_matches_per_student_progress(self):
+        """Test that bulk progress agrees with the per-student methods."""
+        app_context = actions.simple_add_course(
+            'matrix', 'admin@example.com', 'Completion Matrix')
+        course = Course(None, app_context=app_context)
+        pre = course.add_assessment()
+        unit_1 = course.add_unit()
+        unit_1.pre_assessment = pre.unit_id
+        lessons_1 = [course.add_lesson(unit_1) for _ in xrange(3)]
+        unit_2 = course.add_unit()
+        course.add_lesson(unit_2)
+        course.add_unit()  # A unit without lessons.
+        course.save()
+
+        tracker = course.get_progress_tracker()
+        students = [
+            models.Student(key_name='a@example.com', user_id='a'),
+            models.Student(key_name='b@example.com', user_id='b'),
+            models.Student(key_name='c@example.com', user_id='c')]
+
+        # Student a has done some lessons, b has skipped unit 1 by scoring
+        # 100% on its pre-assessment, and c has not started.
+        with Namespace(app_context.get_namespace_name()):
+            for lesson in lessons_1[:2]:
+                tracker.put_html_accessed(
+                    students[0], unit_1.unit_id, lesson.lesson_id)
+            students[1].scores = transforms.dumps({str(pre.unit_id): 100})
+
+            matrix = tracker.get_completion_matrix(students)
+            self.assertEquals(
+                [pre.unit_id, unit_1.unit_id, unit_2.unit_id,
+                 unit_2.unit_id + 2],
+                matrix.unit_ids)
+            self.assertEquals(
+                [0.667, 1.0, 0.0],
+                [matrix.get_unit_percent_complete(row)[unit_1.unit_id]
+                 for row in xrange(3)])
+            for row, student in enumerate(students):
+                progress = tracker.get_or_create_progress(student)
+                self.assertEquals(
+                    tracker.get_unit_percent_complete(student, progress),
+                    matrix.get_unit_percent_complete(row))
+                for unit in course.get_units_of_type('U'):
+                    self.assertEquals(
+                        tracker.get_lesson_progress(
+                            student, unit.unit_id, progress),
+                        matrix.get_lesson_progress(row, unit.unit_id))
+
 
 class AssessmentTest(actions.TestBase):
     """Test for assessments."""